@@ -34,6 +34,11 @@ if [[ $status == "DOWN" ]] ; then
     exit 1
 fi
 
-exec celery worker --app goldstone --queues default --beat --purge \
+# Only drop stale default tasks; queued alert evaluations and deliveries
+# survive a restart.
+celery amqp --app goldstone --workdir ${APPDIR} \
+            --config ${DJANGO_SETTINGS_MODULE} queue.purge default
+
+exec celery worker --app goldstone --queues default,alerts,alert_delivery --beat \
             --workdir ${APPDIR} --config ${DJANGO_SETTINGS_MODULE} \
             --without-heartbeat --loglevel=${CELERY_LOGLEVEL} -s /tmp/celerybeat-schedule "$@"
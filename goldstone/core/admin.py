@@ -15,7 +15,8 @@
 
 from django.contrib import admin
 from goldstone.core.models import SavedSearch, AlertDefinition, \
-    EmailProducer, Alert, MonitoredService, Producer
+    EmailProducer, Alert, MonitoredService, Producer, SearchSchedule, \
+    UndeliveredAlert, ExportJob
 
 
 class SavedSearchAdmin(admin.ModelAdmin):
@@ -23,6 +24,10 @@ class SavedSearchAdmin(admin.ModelAdmin):
                     'index_prefix', 'doc_type', 'timestamp_field')
 
 
+class SearchScheduleAdmin(admin.ModelAdmin):
+    list_display = ('search', 'lease_owner', 'lease_expires')
+
+
 class AlertAdmin(admin.ModelAdmin):
     list_display = ('uuid', 'short_message', 'alert_def')
 
@@ -39,12 +44,24 @@ class EmailProducerAdmin(admin.ModelAdmin):
     list_display = ('uuid', 'alert_def', 'sender', 'receiver')
 
 
+class UndeliveredAlertAdmin(admin.ModelAdmin):
+    list_display = ('uuid', 'alert', 'producer', 'attempts', 'created')
+
+
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ('uuid', 'search', 'start', 'end', 'state', 'rows',
+                    'created')
+
+
 class MonitoredServiceAdmin(admin.ModelAdmin):
     list_display = ('uuid', 'name', 'host', 'state', 'updated')
 
 admin.site.register(SavedSearch, SavedSearchAdmin)
+admin.site.register(SearchSchedule, SearchScheduleAdmin)
 admin.site.register(AlertDefinition, AlertDefinitionAdmin)
 admin.site.register(Alert, AlertAdmin)
 admin.site.register(Producer, ProducerAdmin)
 admin.site.register(EmailProducer, EmailProducerAdmin)
+admin.site.register(UndeliveredAlert, UndeliveredAlertAdmin)
 admin.site.register(MonitoredService, MonitoredServiceAdmin)
+admin.site.register(ExportJob, ExportJobAdmin)
@@ -0,0 +1,138 @@
+"""Compiled alert message templates."""
+# Copyright 2016 Solinea, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import OrderedDict
+import hashlib
+import logging
+import threading
+
+from django.conf import settings
+from jinja2 import Environment, meta
+from jinja2.sandbox import SandboxedEnvironment
+
+logger = logging.getLogger(__name__)
+
+
+class TemplateCache(object):
+    """A process-wide, bounded LRU of compiled alert templates.
+
+    Templates are keyed by a hash of their text, so an edited template never
+    matches a stale entry, and definitions with the same text share one
+    entry.  Entries that are no longer used age out through the LRU.
+
+    If ALERT_TEMPLATE_SANDBOXED is True, templates are compiled in Jinja's
+    sandboxed environment, which blocks access to unsafe attributes of the
+    rendered values.
+
+    """
+
+    def __init__(self, max_size=None, sandboxed=None):
+
+        self.max_size = max_size
+        self.sandboxed = sandboxed
+        self._environment = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def environment(self):
+        """Return the shared Jinja environment, creating it if necessary."""
+
+        if self._environment is None:
+            sandboxed = settings.ALERT_TEMPLATE_SANDBOXED \
+                if self.sandboxed is None else self.sandboxed
+            self._environment = \
+                SandboxedEnvironment() if sandboxed else Environment()
+
+        return self._environment
+
+    @staticmethod
+    def key(source):
+        """Return the cache key of a template's text."""
+
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def _entry(self, source):
+        """Return the (template, variables) entry for a template's text,
+        compiling it on a miss."""
+
+        key = self.key(source)
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+
+        if entry is None:
+            env = self.environment
+            entry = (env.from_string(source),
+                     meta.find_undeclared_variables(env.parse(source)))
+
+            max_size = settings.ALERT_TEMPLATE_CACHE_SIZE \
+                if self.max_size is None else self.max_size
+
+            with self._lock:
+                self._entries[key] = entry
+                while len(self._entries) > max_size:
+                    self._entries.popitem(last=False)
+
+        return entry
+
+    def get(self, source):
+        """Return the compiled template for some template text.
+
+        :param source: the template text
+        :type source: str
+        :rtype: jinja2.Template
+
+        """
+
+        return self._entry(source)[0]
+
+    def variables(self, source):
+        """Return the names of the variables a template uses.
+
+        :param source: the template text
+        :type source: str
+        :rtype: set
+
+        """
+
+        return self._entry(source)[1]
+
+    def render(self, source, context):
+        """Render template text with a context.
+
+        :param source: the template text
+        :type source: str
+        :param context: the template variables
+        :type context: dict
+        :rtype: unicode
+
+        """
+
+        return self.get(source).render(context)
+
+    def clear(self):
+        """Drop all the templates, and the environment."""
+
+        with self._lock:
+            self._entries.clear()
+            self._environment = None
+
+    def __len__(self):
+        return len(self._entries)
+
+# The process-wide instance.
+template_cache = TemplateCache()           # pylint: disable=C0103
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_auto_20160620_1957'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchSchedule',
+            fields=[
+                ('search', models.OneToOneField(related_name='schedule', primary_key=True, serialize=False, to='core.SavedSearch')),
+                ('lease_owner', models.CharField(max_length=64, null=True, blank=True)),
+                ('lease_expires', models.DateTimeField(null=True, blank=True)),
+            ],
+        ),
+    ]
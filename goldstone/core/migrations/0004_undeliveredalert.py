@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_searchschedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UndeliveredAlert',
+            fields=[
+                ('uuid', django_extensions.db.fields.UUIDField(serialize=False, editable=False, primary_key=True, blank=True)),
+                ('error', models.TextField(blank=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, null=True)),
+                ('alert', models.ForeignKey(editable=False, to='core.Alert')),
+                ('producer', models.ForeignKey(editable=False, to='core.Producer')),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+    ]
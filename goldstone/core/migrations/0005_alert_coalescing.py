@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_undeliveredalert'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alert',
+            name='delivered',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='alert',
+            name='first_occurrence',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='alert',
+            name='last_occurrence',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='alert',
+            name='occurrences',
+            field=models.IntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='alertdefinition',
+            name='coalesce_window',
+            field=models.IntegerField(default=0, help_text=b'Seconds during which repeated firings are folded into one alert.  0 disables coalescing'),
+        ),
+        migrations.AddField(
+            model_name='alertdefinition',
+            name='digest',
+            field=models.BooleanField(default=False, help_text=b'True if coalesced alerts should be delivered once, when their window closes'),
+        ),
+    ]
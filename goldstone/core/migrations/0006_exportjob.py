@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_alert_coalescing'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('uuid', django_extensions.db.fields.UUIDField(serialize=False, editable=False, primary_key=True, blank=True)),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('fields', models.TextField(help_text=b'Comma-separated fields to export.  Default is all.', null=True, blank=True)),
+                ('state', models.CharField(default=b'PENDING', max_length=16, editable=False, choices=[(b'PENDING', b'PENDING'), (b'RUNNING', b'RUNNING'), (b'DONE', b'DONE'), (b'FAILED', b'FAILED')])),
+                ('rows', models.BigIntegerField(default=0, editable=False)),
+                ('path', models.CharField(max_length=1024, null=True, editable=False, blank=True)),
+                ('error', models.TextField(null=True, editable=False, blank=True)),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, null=True)),
+                ('updated', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, null=True)),
+                ('search', models.ForeignKey(related_name='export_jobs', to='core.SavedSearch')),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+    ]
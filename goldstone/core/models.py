@@ -14,23 +14,29 @@
 # limitations under the License.
 
 import logging
+import os
 import arrow
 import uuid
 from django.utils import timezone
-from jinja2 import Template
 
-from django.db import models
-from django.db.models import CharField, ForeignKey, DecimalField
+from django.db import models, transaction
+from django.conf import settings
+from django.db.models import CharField, ForeignKey, DecimalField, F, Q
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django_extensions.db.fields import UUIDField, CreationDateTimeField, \
     ModificationDateTimeField
 from elasticsearch_dsl import String, Date, Integer, Nested, Search
 
 
 from polymorphic import PolymorphicModel
+from goldstone.core.alert_templates import template_cache
+from goldstone.drfes.mappings import field_mapping_cache, mapping_has_raw
 from goldstone.drfes.new_models import DailyIndexDocType
-from django.core.mail import send_mail
+from django.core.mail import EmailMessage, get_connection, send_mail
 
-from goldstone.models import es_indices
+from goldstone.models import es_indices, es_indices_for_range, \
+    es_route_search, es_snap_range
 
 from goldstone.user.models import User
 from goldstone.utils import now_micro_ts
@@ -38,6 +44,17 @@ from goldstone.utils import now_micro_ts
 
 logger = logging.getLogger(__name__)
 
+# The protected saved searches behind the dashboard shortcuts in
+# goldstone/core/urls.py, by URL path.
+SHORTCUT_SEARCHES = {
+    'logs': '55b19303-4fd2-4216-95cb-75a4f39b763c',
+    'api-calls': '18936ecd-11f5-413c-9e70-fc9a7dd037e3',
+    'events': '7906893c-16dc-4ab3-96e0-8f0054bd4cc1',
+    'metrics': 'a3f34f00-967b-40a2-913e-ba10afdd611b',
+    'canary': '139851f2-1329-4826-9c70-c154a6c102f2',
+    'hypervisor/spawns': '21f5c6db-5a2e-41d4-9462-c3cdc03a837b',
+}
+
 
 class SavedSearch(models.Model):
     """Defined searches, both system and user-created.  The target_interval
@@ -78,13 +95,12 @@ class SavedSearch(models.Model):
     # update_recent_search_window method.  they can be used to make a series
     # of calls that cover a contiguous time window (such as for dumping
     # data or checking for alerts periodically).
-    # target_interval can be used to trigger a recurring search based on an ES
-    # interval specification such as 5m or 1d.  A celery task that processes
-    # SavedSearches can choose to trigger only if now - interval >= last_end.
-    # BEWARE of multiple tasks using these values since they might step on
-    # each other.  In the long run, these should be refactored into something
-    # a little more protected from side effects by other tasks.  Possibly a
-    # SearchSchedule type with a FK relationship to the search.
+    # target_interval is the number of seconds between runs of a recurring
+    # search.  The process_alerts task only evaluates a search when
+    # now - target_interval >= last_end (see is_due).
+    # Tasks that share these values should hold the search's SearchSchedule
+    # lease while they evaluate a window, so that a window is only evaluated
+    # by one of them.
     last_start = models.DateTimeField(default=timezone.now)
     last_end = models.DateTimeField(default=timezone.now)
     target_interval = models.IntegerField(default=0)
@@ -115,7 +131,8 @@ class SavedSearch(models.Model):
         """Returns a search object that ranged to [last_end, now), and the start
         and end times as strings (suitable for updating the SavedSearch record.
         The caller is responsible for updating the last_start and last_end
-        fields in the SavedSearch.
+        fields in the SavedSearch.  The search only targets the daily indices
+        that overlap the range.
         """
         import arrow
 
@@ -124,42 +141,93 @@ class SavedSearch(models.Model):
 
         start = self.last_end.replace(microsecond=0)
 
-        end = arrow.utcnow().datetime.replace(microsecond=0)
+        # Round the end down to ES_RANGE_GRANULARITY, leaving the rest for the
+        # next window, so that concurrent evaluations send the same search.
+        # A window shorter than that isn't rounded.
+        _, end = es_snap_range(None, arrow.utcnow(), round_end='down')
+        end = end.datetime
+        if end <= start:
+            end = arrow.utcnow().datetime.replace(microsecond=0)
 
         s = self.search()\
             .query('range',
                    ** {self.timestamp_field: {'gte': start.isoformat(),
                                               'lt': end.isoformat()}})
+        s = es_route_search(s, self.index_prefix, start, end)
         return s, start, end
 
+    def is_due(self, now=None):
+        """Return True if target_interval seconds have passed since last_end.
+
+        :param now: the current time.  If None, the current UTC time is used
+        :type now: datetime
+
+        """
+
+        if now is None:
+            now = timezone.now()
+
+        return (now - self.last_end).total_seconds() >= self.target_interval
+
     def update_recent_search_window(self, start, end):
         """trigger an update of the last_start and last_end fields and persist
         the changes.  Due to a bug in logstash, we're going to round these
-        times down to the nearest second.  """
+        times down to the nearest second.
+
+        The update is a compare-and-swap: it only happens if the stored
+        last_end hasn't already moved past start (i.e., nobody else has
+        advanced the window).  Otherwise the stored window is left alone and
+        reloaded.  Several alert definitions that share this search can all
+        report the same window.  """
+        from datetime import timedelta
+
+        start = start.replace(microsecond=0)
+        end = end.replace(microsecond=0)
+
+        updated = SavedSearch.objects\
+            .filter(pk=self.pk, last_end__lt=start + timedelta(seconds=1))\
+            .update(last_start=start, last_end=end)
+
+        if updated:
+            self.last_start, self.last_end = start, end
+        else:
+            self.last_start, self.last_end = SavedSearch.objects\
+                .filter(pk=self.pk)\
+                .values_list('last_start', 'last_end')[0]
+
+            if self.last_end != end:
+                logger.warning("%s window was already advanced past %s",
+                               self, start)
 
-        self.last_start = start.replace(microsecond=0)
-        self.last_end = end.replace(microsecond=0)
-        self.save()
         return self.last_start, self.last_end
 
     def field_has_raw(self, field):
-        """Return boolean indicating whether the field has a .raw version."""
+        """Return boolean indicating whether the field has a .raw version.
 
-        conn = DailyIndexDocType._doc_type.using
-        index = es_indices(self.index_prefix)
+        Lookups are served from the process-wide field mapping cache.
+        """
 
-        try:
-            mapping = conn.indices.get_field_mapping(
-                field,
-                index,
-                self.doc_type,
-                include_defaults=True,
-                allow_no_indices=False)
-            return 'raw' in \
-                   mapping[mapping.keys()[-1]]['mappings'][self.doc_type][
-                       field]['mapping'][field]['fields']
-        except KeyError:
-            return False
+        def _lookup():
+            """Fetch the mapping and look for a raw subfield."""
+
+            conn = DailyIndexDocType._doc_type.using
+            index = es_indices(self.index_prefix, new_days=False)
+
+            try:
+                mapping = conn.indices.get_field_mapping(
+                    field,
+                    index,
+                    self.doc_type,
+                    include_defaults=True,
+                    allow_no_indices=False)
+                return mapping_has_raw(mapping, self.doc_type, field)
+            except KeyError:
+                return False
+
+        return field_mapping_cache.get(self.index_prefix,
+                                       self.doc_type,
+                                       field,
+                                       _lookup)
 
     def __repr__(self):
         return "<SavedSearch: %s>" % self.uuid
@@ -168,6 +236,85 @@ class SavedSearch(models.Model):
         return "<SavedSearch: %s>" % self.uuid
 
 
+class SearchSchedule(models.Model):
+    """The lease on a SavedSearch's recurring time window.
+
+    A task must claim the lease before evaluating the window
+    [last_end, now) of a search, and release it afterwards.  A lease that
+    isn't released (e.g., because the worker died) expires, and the window is
+    then claimed again by another task.
+    """
+
+    search = models.OneToOneField(SavedSearch, primary_key=True,
+                                  related_name='schedule')
+
+    lease_owner = models.CharField(max_length=64, blank=True, null=True)
+
+    lease_expires = models.DateTimeField(blank=True, null=True)
+
+    @classmethod
+    def claim(cls, search, owner, duration=None):
+        """Try to take the lease on a search's window.
+
+        On success, the search's last_start and last_end are reloaded, since
+        another task may have advanced them.
+
+        :param search: the saved search
+        :type search: SavedSearch
+        :param owner: an identifier unique to the claiming task
+        :type owner: str
+        :param duration: the lease duration in seconds.  If None,
+                         SEARCH_LEASE_DURATION is used
+        :type duration: int
+        :return: True if the lease was taken
+        :rtype: bool
+
+        """
+        from datetime import timedelta
+
+        if duration is None:
+            duration = settings.SEARCH_LEASE_DURATION
+
+        cls.objects.get_or_create(search=search)
+
+        now = timezone.now()
+        claimed = cls.objects\
+            .filter(pk=search.pk)\
+            .filter(Q(lease_expires__isnull=True) | Q(lease_expires__lte=now))\
+            .update(lease_owner=owner,
+                    lease_expires=now + timedelta(seconds=duration))
+
+        if claimed:
+            search.last_start, search.last_end = SavedSearch.objects\
+                .filter(pk=search.pk)\
+                .values_list('last_start', 'last_end')[0]
+
+        return bool(claimed)
+
+    @classmethod
+    def release(cls, search, owner):
+        """Give up a lease taken by claim().
+
+        :param search: the saved search
+        :type search: SavedSearch
+        :param owner: the identifier passed to claim()
+        :type owner: str
+        :return: False if the lease had expired and been taken by another task
+        :rtype: bool
+
+        """
+
+        return bool(cls.objects
+                    .filter(pk=search.pk, lease_owner=owner)
+                    .update(lease_owner=None, lease_expires=None))
+
+    def __repr__(self):
+        return "<SearchSchedule: %s>" % self.pk
+
+    def __unicode__(self):
+        return "<SearchSchedule: %s>" % self.pk
+
+
 class AlertDefinition(models.Model):
     """The definition of alert conditions based on a SavedSearch."""
 
@@ -188,6 +335,19 @@ class AlertDefinition(models.Model):
 
     enabled = models.BooleanField(default=True)
 
+    # Firings within coalesce_window seconds of the first one are folded
+    # into that alert, which counts them.  In digest mode, the alert is only
+    # delivered when its window closes, as a summary of all the firings.
+    coalesce_window = models.IntegerField(
+        default=0,
+        help_text='Seconds during which repeated firings are folded into '
+                  'one alert.  0 disables coalescing')
+
+    digest = models.BooleanField(
+        default=False,
+        help_text='True if coalesced alerts should be delivered once, when '
+                  'their window closes')
+
     created = CreationDateTimeField(editable=False, blank=True, null=True)
 
     updated = ModificationDateTimeField(editable=True, blank=True, null=True)
@@ -197,12 +357,76 @@ class AlertDefinition(models.Model):
     class Meta:
         ordering = ['-created']
 
-    def evaluate(self, search_result, start_time, end_time):
-        """Determine if we need to trigger an alert"""
+    # The template variable that holds the hit documents' sources.
+    HITS_VARIABLE = '_hits'
+
+    def references_hits(self):
+        """Return True if a template uses the search's hit documents, i.e.,
+        the search can't be run as a count."""
+
+        return any(self.HITS_VARIABLE in
+                   template_cache.variables(template)
+                   for template in (self.short_template, self.long_template))
+
+    def coalesce(self, start_time, end_time):
+        """Fold a firing into this definition's open alert, if there is one.
+
+        An alert is open for coalesce_window seconds after the start of its
+        first firing.  A digest alert is also closed once the window has
+        passed in real time, or it's been claimed for delivery, which is
+        what deliver_alert_digests tests under the same row lock.  Window
+        ends lag the current time, so without that a firing could be folded
+        into a digest that's already been summarized.
+
+        :return: True if the firing was folded into an alert
+        :rtype: bool
+
+        """
+        from datetime import timedelta
+
+        if not self.coalesce_window:
+            return False
+
+        window = timedelta(seconds=self.coalesce_window)
+        alerts = Alert.objects.filter(alert_def=self,
+                                      first_occurrence__gt=end_time - window)
+        if self.digest:
+            alerts = alerts.filter(
+                delivered=False, first_occurrence__gt=timezone.now() - window)
+
+        with transaction.atomic():
+            alert = alerts\
+                .select_for_update()\
+                .order_by('-first_occurrence')\
+                .first()
+
+            if alert is None:
+                return False
+
+            Alert.objects.filter(pk=alert.pk).update(
+                occurrences=F('occurrences') + 1,
+                last_occurrence=end_time)
+
+        return True
+
+    def evaluate(self, search_result, start_time, end_time, deliver=True):
+        """Determine if we need to trigger an alert.
+
+        :param deliver: if True, queue the new alert for delivery by the
+                        registered producers.  Callers that evaluate many
+                        definitions can pass False and queue the returned
+                        alerts together
+        :type deliver: bool
+        :return: the new alert, or None
+        :rtype: Alert
+
+        """
 
         kv_pairs = {
             '_alert_def_name': self.name,
             '_search_hits': search_result['hits']['total'],
+            self.HITS_VARIABLE: [hit.get('_source', {}) for hit in
+                                 search_result['hits'].get('hits', [])],
             '_start_time': start_time,
             '_end_time': end_time,
             '_alert_def_id': self.uuid
@@ -211,23 +435,28 @@ class AlertDefinition(models.Model):
         if kv_pairs['_search_hits'] > 0:
             logger.debug("%s alert %s to %s" %
                          (kv_pairs['_alert_def_name'], start_time, end_time))
-            short = Template(self.short_template).render(kv_pairs)
-            long = Template(self.long_template).render(kv_pairs)
-            # create an alert and call all our producers with it
+
+            if self.coalesce(start_time, end_time):
+                # counted on the open alert, and nothing new to deliver.
+                self.search.update_recent_search_window(start_time, end_time)
+                return None
+
+            short = template_cache.render(self.short_template, kv_pairs)
+            long = template_cache.render(self.long_template, kv_pairs)
+            # create an alert and queue it for all our producers
             alert = Alert(short_message=short, long_message=long,
-                          alert_def=self)
+                          alert_def=self, first_occurrence=start_time,
+                          last_occurrence=end_time,
+                          delivered=not (self.coalesce_window and self.digest))
             alert.save()
             self.search.update_recent_search_window(start_time, end_time)
-            # send the alert to all registered producers
-            for producer in Producer.objects.filter(alert_def=self):
-                try:
-                    producer.produce(alert)
-                except Exception as e:
-                    logger.exception(
-                        "failed to send alert to %s" % producer.receiver)
-                    continue
+            if deliver and alert.delivered:
+                from goldstone.core.tasks import queue_alert_delivery
+                queue_alert_delivery([alert])
+            return alert
         else:
             self.search.update_recent_search_window(start_time, end_time)
+            return None
 
     def __repr__(self):
         return "<AlertDefiniton: %s>" % self.uuid
@@ -256,9 +485,28 @@ class Alert(models.Model):
 
     updated = ModificationDateTimeField(editable=True, blank=True, null=True)
 
+    # The number of firings folded into this alert, and the time they span.
+    occurrences = models.IntegerField(default=1)
+
+    first_occurrence = models.DateTimeField(blank=True, null=True)
+
+    last_occurrence = models.DateTimeField(blank=True, null=True)
+
+    # False while a digest alert waits for its window to close.
+    delivered = models.BooleanField(default=True)
+
     class Meta:
         ordering = ['-created']
 
+    def summarize(self):
+        """Add the occurrence count and time span to a digest's messages."""
+
+        if self.occurrences > 1:
+            self.short_message += " (%d occurrences)" % self.occurrences
+            self.long_message += "\n%d occurrences from %s to %s." % \
+                (self.occurrences, self.first_occurrence,
+                 self.last_occurrence)
+
     def __repr__(self):
         return "<Alert: %s>" % self.uuid
 
@@ -297,6 +545,29 @@ class Producer(PolymorphicModel):
     def produce(self, alert):
         raise NotImplementedError("Producer subclass must implement send.")
 
+    @classmethod
+    def produce_batch(cls, deliveries):
+        """Send several alerts through producers of this class.
+
+        Subclasses can override this to share a connection across the batch.
+
+        :param deliveries: (alert, producer) pairs
+        :type deliveries: list
+        :return: the (alert, producer, exception) triples that failed
+        :rtype: list
+
+        """
+
+        failed = []
+
+        for alert, producer in deliveries:
+            try:
+                producer.produce(alert)
+            except Exception as e:        # pylint: disable=W0703
+                failed.append((alert, producer, e))
+
+        return failed
+
     def __repr__(self):
         return "<Producer: %s>" % self.uuid
 
@@ -322,6 +593,41 @@ class EmailProducer(Producer):
                              fail_silently=False)
         return email_rv
 
+    def message(self, alert):
+        """Return the email message for an alert."""
+
+        return EmailMessage(alert.short_message, alert.long_message,
+                            self.sender, [self.receiver])
+
+    @classmethod
+    def produce_batch(cls, deliveries):
+        """Send several alerts over one mail connection.
+
+        See Producer.produce_batch.
+        """
+
+        failed = []
+        connection = get_connection(fail_silently=False)
+
+        try:
+            connection.open()
+        except Exception as e:            # pylint: disable=W0703
+            return [(alert, producer, e) for alert, producer in deliveries]
+
+        try:
+            for alert, producer in deliveries:
+                try:
+                    connection.send_messages([producer.message(alert)])
+                except Exception as e:    # pylint: disable=W0703
+                    failed.append((alert, producer, e))
+        finally:
+            try:
+                connection.close()
+            except Exception:             # pylint: disable=W0703
+                logger.exception("failed to close the mail connection")
+
+        return failed
+
     def __repr__(self):
         return "<EmailProducer: %s>" % self.uuid
 
@@ -329,6 +635,134 @@ class EmailProducer(Producer):
         return "<EmailProducer: %s>" % self.uuid
 
 
+class UndeliveredAlert(models.Model):
+    """An alert that a producer couldn't deliver after all its retries."""
+
+    # uuid = UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    uuid = UUIDField(version=4, auto=True, primary_key=True)
+
+    alert = models.ForeignKey(Alert, editable=False)
+
+    producer = models.ForeignKey(Producer, editable=False)
+
+    error = models.TextField(blank=True)
+
+    attempts = models.IntegerField(default=0)
+
+    created = CreationDateTimeField(editable=False, blank=True, null=True)
+
+    class Meta:
+        ordering = ['-created']
+
+    def __repr__(self):
+        return "<UndeliveredAlert: %s>" % self.uuid
+
+    def __unicode__(self):
+        return "<UndeliveredAlert: %s>" % self.uuid
+
+
+class ExportJob(models.Model):
+    """A background export of a saved search's results over a time range.
+
+    The range is sliced by the daily indices that overlap it, and the slices
+    are written to a zip file with one member per column per slice.  See
+    goldstone.drfes.export.write_columnar.
+
+    """
+
+    PENDING = 'PENDING'
+    RUNNING = 'RUNNING'
+    DONE = 'DONE'
+    FAILED = 'FAILED'
+    STATE_CHOICES = (
+        (PENDING, PENDING),
+        (RUNNING, RUNNING),
+        (DONE, DONE),
+        (FAILED, FAILED),
+    )
+
+    # uuid = UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    uuid = UUIDField(version=4, auto=True, primary_key=True)
+
+    search = models.ForeignKey(SavedSearch, related_name='export_jobs')
+
+    start = models.DateTimeField()
+
+    end = models.DateTimeField()
+
+    fields = models.TextField(
+        blank=True, null=True,
+        help_text='Comma-separated fields to export.  Default is all.')
+
+    state = CharField(max_length=16, choices=STATE_CHOICES, default=PENDING,
+                      editable=False)
+
+    rows = models.BigIntegerField(default=0, editable=False)
+
+    path = models.CharField(max_length=1024, blank=True, null=True,
+                            editable=False)
+
+    error = models.TextField(blank=True, null=True, editable=False)
+
+    created = CreationDateTimeField(editable=False, blank=True, null=True)
+
+    updated = ModificationDateTimeField(editable=True, blank=True, null=True)
+
+    class Meta:
+        ordering = ['-created']
+
+    def __repr__(self):
+        return "<ExportJob: %s>" % self.uuid
+
+    def __unicode__(self):
+        return "<ExportJob: %s>" % self.uuid
+
+    def field_list(self):
+        """Return the fields to export as a list, or None for all of them."""
+
+        return [f.strip() for f in (self.fields or '').split(',')
+                if f.strip()] or None
+
+    def slices(self):
+        """Return the export's searches, one per daily index that overlaps
+        the time range.
+
+        :return: (name, Search) pairs
+        :rtype: list
+
+        """
+
+        search = self.search.search().query(
+            'range', **{self.search.timestamp_field: {
+                'gte': self.start.isoformat(),
+                'lt': self.end.isoformat()}})
+
+        indices = es_indices_for_range(self.search.index_prefix,
+                                       self.start, self.end)
+
+        if indices is None:
+            return [(self.search.index_prefix.rstrip('*'), search)]
+
+        return [(index.rstrip('*'), search.index().index(index))
+                for index in indices]
+
+
+@receiver(post_delete, sender=ExportJob)
+def _export_job_deleted(sender, **kwargs):          # pylint: disable=W0613
+    """Remove a deleted ExportJob's file.
+
+    :param sender: The sending model class
+    :type sender: ExportJob
+    :keyword instance: The actual instance being deleted
+    :type instance: ExportJob row
+
+    """
+
+    path = kwargs['instance'].path
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
 class CADFEventDocType(DailyIndexDocType):
     """ES representation of a PyCADF event. Attempting to write traits that are
     not present in the Nested definition will result in an exception, though
@@ -0,0 +1,240 @@
+"""Refresh-ahead of the dashboard shortcut searches."""
+# Copyright 2016 Solinea, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from ast import literal_eval
+from collections import OrderedDict
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.http import HttpRequest, QueryDict
+from rest_framework.request import Request
+from rest_framework.utils.urls import replace_query_param
+import redis
+
+from goldstone.core.models import SHORTCUT_SEARCHES
+from goldstone.drfes.histogram import interval_ms
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshAhead(object):
+    """Keeps the first page of each dashboard shortcut search's results over
+    the default window ready in Redis.
+
+    The refresh() method recomputes a search's page over the last
+    DEFAULT_LOOKBACK_DAYS days at each of REFRESH_AHEAD_INTERVALS (None is
+    the saved search's own interval), and is run every REFRESH_AHEAD_PERIOD
+    seconds by the refresh_dashboards task.
+
+    The lookup() method serves a request from the store if its only
+    parameters are a time range and an interval (and optionally page 1 and
+    the default page size), its range is as long as the default window, and
+    its range ends within REFRESH_AHEAD_TOLERANCE seconds of a stored
+    page's.  Anything else, and Redis errors, fall through to ES.
+
+    """
+
+    KEY_PREFIX = 'goldstone:refresh_ahead:'
+
+    @staticmethod
+    def _redis():
+        """Return a Redis client."""
+        from goldstone.models import RedisConnection
+
+        return RedisConnection().conn
+
+    def key(self, uuid, interval):
+        """Return the store key of a search's page at an interval."""
+
+        step = interval_ms(interval) if interval is not None else None
+        return '%s%s:%s' % (self.KEY_PREFIX, uuid,
+                            step if step is not None else interval)
+
+    @staticmethod
+    def _window_ms():
+        """Return the length of the default window in milliseconds."""
+
+        return settings.DEFAULT_LOOKBACK_DAYS * 24 * 3600 * 1000
+
+    @staticmethod
+    def _page_size():
+        """Return the default page size."""
+        from goldstone.drfes.pagination import ElasticPageNumberPagination
+
+        return ElasticPageNumberPagination.page_size
+
+    def compute(self, uuid, interval, start, end):
+        """Return the first page of a search's results over [start, end], or
+        None if the search failed.
+
+        The page is computed by the results route, through a request that
+        the route would get from a dashboard.
+
+        :param uuid: The saved search's uuid
+        :type uuid: str
+        :param interval: The histogram interval, or None for the search's own
+        :type interval: str
+        :param start: The start of the range in epoch milliseconds
+        :type start: int
+        :param end: The end of the range in epoch milliseconds
+        :type end: int
+        :return: The page's count, results, and any aggregations
+        :rtype: dict
+
+        """
+        from goldstone.core.models import SavedSearch
+        from goldstone.core.views import SavedSearchViewSet
+
+        obj = SavedSearch.objects.get(uuid=uuid)
+
+        query = QueryDict('', mutable=True)
+        query[obj.timestamp_field + '__range'] = \
+            json.dumps({'gte': start, 'lte': end})
+        if interval is not None:
+            query['interval'] = interval
+
+        http_request = HttpRequest()
+        http_request.method = 'GET'
+        http_request.GET = query
+        request = Request(http_request)
+
+        view = SavedSearchViewSet(request=request, args=(),
+                                  kwargs={'uuid': uuid}, format_kwarg=None,
+                                  action='results')
+        data = view.results_page(request, uuid)
+
+        # Pagination turns ES errors into an empty page without _shards.
+        page = view.paginator.page
+        if '_shards' not in page.object_list.to_dict():
+            return None
+
+        result = OrderedDict([('count', page.paginator.count),
+                              ('results', data['results'])])
+        if 'aggregations' in data:
+            result['aggregations'] = data['aggregations']
+
+        return result
+
+    def refresh(self, uuid, now=None):
+        """Recompute and store a search's pages over the default window.
+
+        :param uuid: The saved search's uuid
+        :type uuid: str
+        :param now: The current epoch time in seconds.  If None, time.time()
+        :type now: float
+        :return: The number of pages stored
+        :rtype: int
+
+        """
+
+        end = int((now if now is not None else time.time()) * 1000)
+        start = end - self._window_ms()
+        ttl = settings.REFRESH_AHEAD_PERIOD + settings.REFRESH_AHEAD_TOLERANCE
+
+        conn = self._redis()
+        stored = 0
+
+        for interval in settings.REFRESH_AHEAD_INTERVALS:
+            page = self.compute(uuid, interval, start, end)
+            if page is None:
+                logger.warning("could not refresh %s at %s", uuid, interval)
+                continue
+
+            conn.set(self.key(uuid, interval),
+                     json.dumps({'start': start, 'end': end, 'page': page}),
+                     ex=ttl)
+            stored += 1
+
+        return stored
+
+    def _default_range(self, request):
+        """Return the (start, end) of a request's range in epoch ms if the
+        request only has default parameters, or None."""
+        from goldstone.drfes.rollup import _epoch_ms
+
+        params = request.query_params
+        ranges = [name for name in params if name.endswith('__range')]
+        allowed = set(ranges + ['interval', 'page', 'page_size'])
+
+        if len(ranges) != 1 or not set(params) <= allowed or \
+                params.get('page', '1') != '1' or \
+                params.get('page_size', str(self._page_size())) != \
+                str(self._page_size()):
+            return None
+
+        try:
+            bounds = literal_eval(params[ranges[0]])
+            start = _epoch_ms(bounds.get('gte', bounds.get('gt')))
+            end = _epoch_ms(bounds.get('lte', bounds.get('lt')))
+        except Exception:         # pylint: disable=W0703
+            return None
+
+        tolerance = settings.REFRESH_AHEAD_TOLERANCE * 1000
+        if start is None or end is None or \
+                abs(end - start - self._window_ms()) > tolerance:
+            return None
+
+        return start, end
+
+    def lookup(self, request, uuid):
+        """Return a stored page for a request, or None.
+
+        :param request: The results request
+        :type request: Request
+        :param uuid: The saved search's uuid
+        :type uuid: str
+        :return: The page, with pagination links for the request
+        :rtype: OrderedDict
+
+        """
+
+        if not settings.REFRESH_AHEAD_ENABLED or \
+                uuid not in SHORTCUT_SEARCHES.values():
+            return None
+
+        bounds = self._default_range(request)
+        if bounds is None:
+            return None
+
+        try:
+            value = self._redis().get(
+                self.key(uuid, request.query_params.get('interval')))
+        except redis.RedisError as exc:
+            logger.warning("refresh-ahead store unavailable: %s", exc)
+            return None
+
+        if value is None:
+            return None
+
+        stored = json.loads(value, object_pairs_hook=OrderedDict)
+        if abs(bounds[1] - stored['end']) > \
+                settings.REFRESH_AHEAD_TOLERANCE * 1000:
+            return None
+
+        page = stored['page']
+        more = page['count'] > self._page_size()
+
+        return OrderedDict(
+            [('count', page['count']),
+             ('next', replace_query_param(request.build_absolute_uri(),
+                                          'page', 2) if more else None),
+             ('previous', None),
+             ('results', page['results'])] +
+            ([('aggregations', page['aggregations'])]
+             if 'aggregations' in page else []))
+
+# The process-wide instance.
+refresh_ahead = RefreshAhead()            # pylint: disable=C0103
@@ -15,7 +15,7 @@
 import logging
 from rest_framework import serializers
 from goldstone.core.models import SavedSearch, Alert, \
-    AlertDefinition, Producer, EmailProducer, MonitoredService
+    AlertDefinition, Producer, EmailProducer, MonitoredService, ExportJob
 
 
 logger = logging.getLogger(__name__)
@@ -87,3 +87,26 @@ class MonitoredServiceSerializer(serializers.ModelSerializer):
 
         model = MonitoredService
         lookup_field = 'uuid'
+
+
+class ExportJobSerializer(serializers.ModelSerializer):
+    """The Export Job serializer."""
+
+    search = serializers.PrimaryKeyRelatedField(
+        queryset=SavedSearch.objects.all())
+
+    class Meta:                 # pylint: disable=C0111,C1001,W0232
+        model = ExportJob
+        exclude = ('path',)
+
+    def validate(self, attrs):
+        """Require a time-stamped search and a non-empty time range."""
+
+        if attrs['search'].timestamp_field is None:
+            raise serializers.ValidationError(
+                "The search has no timestamp field to export by.")
+
+        if attrs['start'] >= attrs['end']:
+            raise serializers.ValidationError("start must be before end.")
+
+        return attrs
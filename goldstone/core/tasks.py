@@ -13,16 +13,32 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import OrderedDict, defaultdict
+import copy
+from datetime import timedelta
+import json
 import logging
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import tempfile
+from uuid import uuid4
 
 import arrow
 from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 import curator
 from goldstone.celery import app as celery_app
-from goldstone.core.models import AlertDefinition, SavedSearch, \
-    MonitoredService
-from django.db.models import Q
-from goldstone.models import es_conn
+from goldstone.core.models import Alert, AlertDefinition, ExportJob, \
+    SavedSearch, SearchSchedule, MonitoredService, Producer, \
+    UndeliveredAlert, SHORTCUT_SEARCHES
+from goldstone.core.refresh import refresh_ahead
+from goldstone.drfes.bulk import BulkWriter
+from goldstone.drfes.export import spool_search, write_columnar
+from goldstone.drfes.rollup import rollups
+from goldstone.models import daily_index, es_conn, es_multi_search, \
+    index_catalog
 
 # do not user get_task_logger here as it does not honor the Django settings
 from goldstone.utils import get_nova_client, get_keystone_region
@@ -45,6 +61,7 @@ def prune_es_indices():
         {"prefix": "goldstone_metrics-", "time_string": "%Y.%m.%d"},
         {"prefix": "api_stats-", "time_string": "%Y.%m.%d"},
         {"prefix": "internal-", "time_string": "%Y.%m.%d"},
+        {"prefix": settings.ROLLUP_INDEX_PREFIX, "time_string": "%Y.%m.%d"},
     ]
 
     client = es_conn()
@@ -77,9 +94,72 @@ def prune_es_indices():
 
         working_list = all_indices  # reset for the next loop iteration
 
+    if deleted_indices:
+        index_catalog.invalidate()
+
     return deleted_indices
 
 
+@celery_app.task()
+def refresh_index_catalog():
+    """Rebuild the index catalog and publish it to Redis, so that web and
+    worker processes can resolve index names without asking the cluster."""
+
+    return len(index_catalog.refresh())
+
+
+@celery_app.task()
+def update_rollups(resolution):
+    """Roll up the newly closed buckets of every rollup source.
+
+    A failure is logged and doesn't stop the other sources.
+
+    :param resolution: "1m" or "1h"
+    :type resolution: str
+    :return: The number of rollup documents written, by source
+    :rtype: dict
+
+    """
+
+    if not settings.ROLLUP_ENABLED:
+        return {}
+
+    written = {}
+
+    for name, source in sorted(rollups.sources().items()):
+        try:
+            written[name] = rollups.update(source, resolution)
+        except Exception:         # pylint: disable=W0703
+            logger.exception("could not roll up %s at %s", name, resolution)
+
+    return written
+
+
+@celery_app.task()
+def refresh_dashboards():
+    """Recompute the dashboard shortcut searches' default pages.
+
+    A failure is logged and doesn't stop the other searches.
+
+    :return: The number of pages stored, by search uuid
+    :rtype: dict
+
+    """
+
+    if not settings.REFRESH_AHEAD_ENABLED:
+        return {}
+
+    stored = {}
+
+    for uuid in sorted(SHORTCUT_SEARCHES.values()):
+        try:
+            stored[uuid] = refresh_ahead.refresh(uuid)
+        except Exception:         # pylint: disable=W0703
+            logger.exception("could not refresh %s", uuid)
+
+    return stored
+
+
 @celery_app.task()
 def expire_auth_tokens():
     """Expire authorization tokens.
@@ -96,39 +176,434 @@ def expire_auth_tokens():
     Token.objects.all().delete()
 
 
+def _count_only(search):
+    """Return a search that only counts its hits.
+
+    If ALERT_TERMINATE_AFTER is set, each shard stops counting after that many
+    documents, which is enough to tell whether there are any.
+    """
+
+    search = search.extra(size=0)
+
+    if settings.ALERT_TERMINATE_AFTER:
+        search = search.extra(terminate_after=settings.ALERT_TERMINATE_AFTER)
+
+    return search
+
+
+def _evaluate_alert_definitions(alert_defs):
+    """Evaluate alert definitions against their recent search windows.
+
+    Each saved search's window is leased (see SearchSchedule) while its
+    definitions are evaluated, so a window is only evaluated by one task.
+    Searches whose lease is held elsewhere are skipped.  Unless a template
+    uses the hit documents, the searches only count their hits.  They are
+    sent together through _msearch, and each response is handed back to its
+    definitions.  A failure is logged and doesn't stop the other definitions.
+    The new alerts are queued for delivery together.
+    """
+
+    owner = uuid4().hex
+    by_search = OrderedDict()
+
+    for alert_def in alert_defs:
+        by_search.setdefault(alert_def.search.pk, []).append(alert_def)
+
+    pending = []
+    alerts = []
+
+    try:
+        for group in by_search.values():
+            saved_search = group[0].search
+            if not SearchSchedule.claim(saved_search, owner):
+                logger.debug("%s is being evaluated elsewhere", saved_search)
+                continue
+
+            try:
+                search, start, end = saved_search.search_recent()
+                if not any(ad.references_hits() for ad in group):
+                    search = _count_only(search)
+            except Exception as e:
+                for alert_def in group:
+                    logger.exception("failed to process %s" % alert_def)
+                SearchSchedule.release(saved_search, owner)
+                continue
+
+            for alert_def in group:
+                # share the claimed search, so its window is reloaded once.
+                alert_def.search = saved_search
+            pending.append((group, search, start, end))
+
+        results = es_multi_search([search for _, search, _, _ in pending])
+
+        for (group, _, start, end), result in zip(pending, results):
+            if 'error' in result:
+                for alert_def in group:
+                    logger.error("failed to process %s: %s" %
+                                 (alert_def, result['error']))
+                continue
+
+            for alert_def in group:
+                try:
+                    alert = alert_def.evaluate(result, start, end,
+                                               deliver=False)
+                    if alert is not None:
+                        alerts.append(alert)
+                except Exception as e:
+                    logger.exception("failed to process %s" % alert_def)
+                    continue
+
+    finally:
+        for group, _, _, _ in pending:
+            if not SearchSchedule.release(group[0].search, owner):
+                logger.warning("lease on %s expired before it was released",
+                               group[0].search)
+
+        queue_alert_delivery(alerts)
+
+
+def queue_alert_delivery(alerts):
+    """Queue alerts for delivery by their definitions' producers.
+
+    :param alerts: the alerts
+    :type alerts: list of Alert
+
+    """
+
+    if not alerts:
+        return
+
+    producers = {}
+    for alert_def_id, producer_id in Producer.objects\
+            .filter(alert_def__in=[alert.alert_def_id for alert in alerts])\
+            .values_list('alert_def', 'uuid'):
+        producers.setdefault(alert_def_id, []).append(producer_id)
+
+    deliveries = [[alert.uuid, producer_id] for alert in alerts
+                  for producer_id in producers.get(alert.alert_def_id, [])]
+
+    if deliveries:
+        deliver_alerts.apply_async(args=[deliveries])
+
+
+@celery_app.task(bind=True, max_retries=None)
+def deliver_alerts(self, deliveries):
+    """Send alerts through their producers.
+
+    The deliveries are grouped by producer class, and each group is sent with
+    the class's produce_batch (e.g., over one mail connection).  Failed
+    deliveries are retried with an exponential backoff, and are recorded as
+    UndeliveredAlerts after ALERT_DELIVERY_MAX_RETRIES retries.  This is
+    routed to the alert_delivery queue.
+
+    :param deliveries: [alert uuid, producer uuid] pairs
+    :type deliveries: list
+
+    """
+
+    alerts = Alert.objects.in_bulk([alert for alert, _ in deliveries])
+    producers = dict((producer.uuid, producer) for producer in
+                     Producer.objects.filter(
+                         uuid__in=[producer for _, producer in deliveries]))
+
+    by_class = OrderedDict()
+    for alert_id, producer_id in deliveries:
+        if alert_id not in alerts or producer_id not in producers:
+            # deleted since the delivery was queued.
+            continue
+
+        producer = producers[producer_id]
+        by_class.setdefault(type(producer), []).append(
+            (alerts[alert_id], producer))
+
+    failed = []
+    for cls, batch in by_class.items():
+        failed.extend(cls.produce_batch(batch))
+
+    if not failed:
+        return
+
+    attempts = self.request.retries + 1
+
+    if attempts <= settings.ALERT_DELIVERY_MAX_RETRIES:
+        logger.warning("%d alert deliveries failed, retrying: %s",
+                       len(failed), failed[0][2])
+        raise self.retry(
+            args=[[[alert.uuid, producer.uuid]
+                   for alert, producer, _ in failed]],
+            countdown=settings.ALERT_DELIVERY_RETRY_BACKOFF * 2 ** (
+                attempts - 1))
+
+    for alert, producer, exc in failed:
+        logger.error("failed to send %s to %s: %s", alert, producer, exc)
+
+    UndeliveredAlert.objects.bulk_create(
+        UndeliveredAlert(alert=alert, producer=producer, error=str(exc),
+                         attempts=attempts)
+        for alert, producer, exc in failed)
+
+
 @celery_app.task()
-def process_alerts():
-    """Detect new alerts since the last run."""
+def deliver_alert_digests():
+    """Deliver the digest alerts whose coalescing window has closed.
 
-    for alert_def in AlertDefinition.objects.all():
-        try:
-            # try to process all alert definitions
-            search, start, end = alert_def.search.search_recent()
-            result = search.execute()
-            alert_def.evaluate(result.to_dict(), start, end)
-        except Exception as e:
-            logger.exception("failed to process %s" % alert_def)
+    An alert is claimed under its row lock, which AlertDefinition.coalesce
+    also takes, so a firing is either folded in before the claim or starts a
+    new alert.
+    """
+
+    now = timezone.now()
+    ready = []
+
+    for alert in Alert.objects.filter(delivered=False)\
+            .select_related('alert_def'):
+        closes = alert.first_occurrence + \
+            timedelta(seconds=alert.alert_def.coalesce_window)
+        if closes > now:
             continue
 
+        # claim the alert, so that it's only delivered once.
+        with transaction.atomic():
+            if Alert.objects.select_for_update()\
+                    .filter(pk=alert.pk, delivered=False).first() is None:
+                continue
+            Alert.objects.filter(pk=alert.pk).update(delivered=True)
+
+        alert.refresh_from_db()
+        alert.summarize()
+        alert.save()
+        ready.append(alert)
+
+    queue_alert_delivery(ready)
+
+
+@celery_app.task()
+def evaluate_alert_definitions(uuids):
+    """Evaluate a batch of alert definitions.
+
+    This is dispatched by process_alerts, and is routed to the alerts queue.
+
+    :param uuids: the alert definitions' uuids
+    :type uuids: list
+
+    """
 
-def status_from_agg(host_buckets, host):
-    service_buckets = [service['per_component']['buckets']
-                       for service in host_buckets
-                       if service['key'] == host][0]
+    _evaluate_alert_definitions(
+        AlertDefinition.objects.filter(uuid__in=uuids).select_related(
+            'search'))
+
+
+@celery_app.task()
+def process_alerts():
+    """Dispatch the alert definitions whose searches are due.
+
+    A definition is due when its search's target_interval has passed since
+    the end of the last window it evaluated.  The due definitions are split
+    into at most ALERT_MAX_CONCURRENCY evaluate_alert_definitions subtasks.
+    The definitions of a search always go to the same subtask, since only
+    one task can claim the search's window.
+    """
+
+    now = arrow.utcnow().datetime
+    by_search = OrderedDict()
+
+    for alert_def in AlertDefinition.objects.select_related('search') \
+            .order_by('search', 'created'):
+        if alert_def.search.is_due(now):
+            by_search.setdefault(alert_def.search_id, []).append(
+                alert_def.uuid)
+
+    if not by_search:
+        return
+
+    # Spread the searches evenly over as many subtasks as we're allowed.
+    groups = list(by_search.values())
+    tasks = min(len(groups), settings.ALERT_MAX_CONCURRENCY)
+
+    for i in range(tasks):
+        evaluate_alert_definitions.apply_async(
+            args=[sum(groups[i::tasks], [])],
+            expires=settings.ALERT_TASK_EXPIRES)
+
+    logger.debug("dispatched %d due alert definitions of %d searches in %d "
+                 "tasks", sum(len(group) for group in groups), len(groups),
+                 tasks)
+
+
+def _statuses_from_host_bucket(host_bucket):
+    """Return the service statuses in one per_host aggregation bucket."""
 
     result = []
-    for bucket in service_buckets:
+    for bucket in host_bucket['per_component']['buckets']:
         if bucket['doc_count'] > 0:
             state = MonitoredService.UP
         else:
             state = MonitoredService.DOWN
 
-        result.append({"host": host,
+        result.append({"host": host_bucket['key'],
                        "name": bucket['key'],
                        "state": state})
     return result
 
 
+def reconcile_service_status(found_services_by_host):
+    """Bring the MonitoredService records of some hosts in line with the
+    per_host buckets of a service status search, and log a message for each
+    change.
+
+    The hosts' records are loaded once, and the differences are written with
+    one bulk insert and one update per new state, in a single transaction.
+
+    :param found_services_by_host: the per_host aggregation buckets
+    :type found_services_by_host: list
+    :return: the hosts in the buckets
+    :rtype: set
+
+    """
+
+    found_hosts = set(bucket['key'] for bucket in found_services_by_host)
+    existing = dict(((service.host, service.name), service)
+                    for service in MonitoredService.objects.filter(
+                        host__in=found_hosts))
+
+    inserts = []
+    changes = defaultdict(list)
+
+    for host_bucket in found_services_by_host:
+        for status in _statuses_from_host_bucket(host_bucket):
+            service_rec = existing.get((status['host'], status['name']))
+
+            if service_rec is None:
+
+                # this is a new service.  Create a database entry and log a
+                # message to be harvested by an AlertDefinition.
+
+                inserts.append(MonitoredService(**status))
+                logger.info(
+                    "Service status update: service %s discovered on host "
+                    "%s with state %s" %
+                    (status['name'], status['host'], status['state']))
+
+            elif service_rec.state != status['state']:
+
+                # this is a state change.  Update the database entry and log
+                # a message to be harvested by an AlertDefinition.
+
+                logger.info("Service status update: service %s on host "
+                            "%s changed state from %s to %s" %
+                            (service_rec.name,
+                             service_rec.host,
+                             service_rec.state,
+                             status['state']))
+                changes[status['state']].append(service_rec.pk)
+
+    with transaction.atomic():
+        if inserts:
+            MonitoredService.objects.bulk_create(inserts)
+
+        _update_service_states(changes)
+
+    return found_hosts
+
+
+def mark_missing_services(found_hosts):
+    """Set the services on hosts that a service status search didn't find to
+    UNKNOWN, and log a message for each.
+
+    :param found_hosts: the hosts that the search found
+    :type found_hosts: set
+
+    """
+
+    # these hosts have disappeared from all ES records.  Possibly an old
+    # host that has been curated out of all indices.  We'll set the state
+    # of all services on the host to unknown.  A human may want to mark the
+    # service as deleted at some point.
+
+    known = MonitoredService.objects\
+        .exclude(state=MonitoredService.UNKNOWN)\
+        .values_list('host', flat=True)\
+        .distinct()
+    missing_hosts = sorted(set(known) - set(found_hosts))
+    page_size = settings.SERVICE_STATUS_PAGE_SIZE
+
+    for offset in range(0, len(missing_hosts), page_size):
+        missing_services = MonitoredService.objects\
+            .filter(host__in=missing_hosts[offset:offset + page_size])\
+            .exclude(state=MonitoredService.UNKNOWN)
+        pks = []
+
+        for missing_service in missing_services:
+            logger.info("Service status update: service %s on host "
+                        "%s changed state from %s to %s" %
+                        (missing_service.name,
+                         missing_service.host,
+                         missing_service.state,
+                         MonitoredService.UNKNOWN))
+            pks.append(missing_service.pk)
+
+        with transaction.atomic():
+            _update_service_states({MonitoredService.UNKNOWN: pks})
+
+
+def _update_service_states(changes):
+    """Apply state changes, one update() per state.
+
+    :param changes: the MonitoredService primary keys for each new state
+    :type changes: dict
+
+    """
+
+    now = timezone.now()
+    for state, pks in changes.items():
+        MonitoredService.objects.filter(pk__in=pks).update(state=state,
+                                                           updated=now)
+
+
+def service_status_pages(search, per_host, page_size):
+    """Run a service status search a page of hosts at a time.
+
+    ES 1.x has no composite aggregation, so the hosts are listed first with a
+    terms aggregation that returns only their names.  Then the per_host
+    aggregation is run for page_size hosts at a time, restricted to them with
+    an include list, with no limit on the number of components per host.
+
+    :param search: the service status search
+    :type search: Search
+    :param per_host: the saved query's per_host aggregation
+    :type per_host: dict
+    :param page_size: the number of hosts per page
+    :type page_size: int
+    :return: a generator of per_host bucket lists, one per page
+
+    """
+
+    host_terms = per_host['terms']
+    hosts_agg = {'terms': {'field': host_terms['field'],
+                           'size': 0,
+                           'min_doc_count': host_terms.get('min_doc_count', 1),
+                           'order': {'_term': 'asc'}}}
+    for key in ('include', 'exclude'):
+        if key in host_terms:
+            hosts_agg['terms'][key] = host_terms[key]
+
+    result = search.extra(size=0, aggs={'hosts': hosts_agg}).execute()
+    hosts = [bucket['key'] for bucket in
+             result.to_dict()['aggregations']['hosts']['buckets']]
+
+    for offset in range(0, len(hosts), page_size):
+        page = hosts[offset:offset + page_size]
+
+        page_agg = copy.deepcopy(per_host)
+        page_agg['terms'].update(include=page, size=len(page))
+        for sub_agg in page_agg.get('aggs', {}).values():
+            if 'terms' in sub_agg:
+                sub_agg['terms']['size'] = 0
+
+        result = search.extra(size=0, aggs={'per_host': page_agg}).execute()
+        yield result.to_dict()['aggregations']['per_host']['buckets']
+
+
 @celery_app.task()
 def service_status_check():
     """Run the service status saved search, update any records, and log a
@@ -180,143 +655,135 @@ def service_status_check():
             key missing = 'UNKNOWN'
             doc_count = 0 = 'DOWN'
             doc_count > 0 = 'UP'
+
+        The aggregation is run and reconciled a page of hosts at a time (see
+        service_status_pages), so every host and component is covered.
         """
 
-    # execute our search and get the results
+    # execute our search a page of hosts at a time
     logger.info("Starting service status check")
     search_id = 'c7fa5f00-e851-4a71-9be0-7dbf8415426c'
     ss = SavedSearch.objects.get(uuid=search_id)
     search, start, end = ss.search_recent()
-    # print "search = %s" % search.to_dict()
-    result = search.execute().to_dict()
-
-    # print "search_result = %s" % result
+    per_host = json.loads(ss.query)['aggs']['per_host']
+    found_hosts = set()
 
-    # compare our results with existing MonitoredService records to see if
+    # compare each page with existing MonitoredService records to see if
     # we have a state change.
-    found_services_by_host = result['aggregations']['per_host']['buckets']
-    monitored_services = MonitoredService.objects.all()
-
-    found_hosts = set([rec['key'] for rec in found_services_by_host])
-    monitored_hosts = set([service.host for service in monitored_services])
-
-    new_hosts = found_hosts - monitored_hosts
-    missing_hosts = monitored_hosts - found_hosts
-    common_hosts = found_hosts.intersection(monitored_hosts)
-
-    for host in new_hosts:
-        # found a new host, so all services on it should be monitored.
-        # also log a message to indicate a status change.
-        statuses = status_from_agg(found_services_by_host, host)
-        for status in statuses:
-            MonitoredService(**status).save()
-            logger.info("Service status update: service %s discovered on host "
-                        "%s with state %s" %
-                        (status['name'], status['host'], status['state']))
-
-    for host in missing_hosts:
-
-        # these hosts have disappeared from all ES records.  Possibly an old
-        # host that has been curated out of all indices.  We'll set the state
-        # of all services on the host to unknown.  A human may want to mark the
-        # service as deleted at some point.
-
-        missing_services = MonitoredService.objects.filter(
-            ~Q(state=MonitoredService.UNKNOWN),
-            host=host
-        )
-        for missing_service in missing_services:
+    for page in service_status_pages(search, per_host,
+                                     settings.SERVICE_STATUS_PAGE_SIZE):
+        found_hosts |= reconcile_service_status(page)
 
-            logger.info("Service status update: service %s on host "
-                        "%s changed state from %s to %s" %
-                        (missing_service.name,
-                         missing_service.host,
-                         missing_service.state,
-                         MonitoredService.UNKNOWN))
-            missing_service.state = MonitoredService.UNKNOWN
-            missing_service.save()
+    mark_missing_services(found_hosts)
 
-    for host in common_hosts:
+    # if we got here, let's update the search time range
+    ss.update_recent_search_window(start, end)
+    logger.info("Finished service status check")
 
-        # we still may known or missing services for a known host.  handle
-        # those like above.  everything else is a comparison of state.
 
-        host_services = MonitoredService.objects.filter(host=host)
-        statuses = status_from_agg(found_services_by_host, host)
+@celery_app.task()
+def nova_hypervisors_stats():
+    """Get stats from the nova API and add them as Goldstone metrics."""
 
-        for status in statuses:
+    novaclient = get_nova_client()
+    response = novaclient.hypervisors.statistics()._info
+    region = get_keystone_region()
+    metric_prefix = 'nova.hypervisor.'
+    now = arrow.utcnow()
+    es_index = daily_index(METRIC_INDEX_PREFIX)
+    es_doc_type = METRIC_DOCTYPE
 
-            # process each of the status records in ES for this host
+    with BulkWriter() as writer:
+        for key, value in response.items():
+            doc = {
+                'type': es_doc_type,
+                'name': metric_prefix + key,
+                'value': value,
+                'metric_type': 'gauge',
+                '@timestamp': now.isoformat(),
+                'region': region
+            }
 
-            if host_services.filter(name=status['name']).count() == 0:
+            if key in ['disk_available_least', 'free_disk_gb', 'local_gb',
+                       'local_gb_used']:
+                doc['unit'] = 'GB'
+            elif key in ['free_ram_mb', 'memory_mb', 'memory_mb_used']:
+                doc['unit'] = 'MB'
+            else:
+                doc['unit'] = 'count'
 
-                # this is a new service on the host.  Create a database entry
-                # and log a message to be harvested by an AlertDefinition.
+            writer.add(es_index, es_doc_type, doc, op_type='create')
 
-                MonitoredService(**status).save()
 
-                logger.info(
-                    "Service status update: service %s discovered on host "
-                    "%s with state %s" %
-                    (status['name'], status['host'], status['state']))
+@celery_app.task()
+def run_export_job(uuid):
+    """Run an ExportJob.
 
-                continue
+    The job's time range is sliced by daily index, the slices are scrolled
+    into column spools by a pool of EXPORT_JOB_WORKERS threads, and the
+    spools are written to <EXPORT_JOB_DIR>/<uuid>.zip.
 
-            # if we got here, there should be a record for this service
+    :param uuid: The job's uuid
+    :type uuid: str
 
-            service_rec = MonitoredService.objects.get(
-                host=status['host'],
-                name=status['name'])
+    """
 
-            if service_rec.state != status['state']:
+    job = ExportJob.objects.get(uuid=uuid)
+    job.state = ExportJob.RUNNING
+    job.save()
 
-                # this is a state change. Update the database entry
-                # and log a message to be harvested by an AlertDefinition.
+    if not os.path.isdir(settings.EXPORT_JOB_DIR):
+        os.makedirs(settings.EXPORT_JOB_DIR)
 
-                logger.info("Service status update: service %s on host "
-                            "%s changed state from %s to %s" %
-                            (service_rec.name,
-                             service_rec.host,
-                             service_rec.state,
-                             status['state']))
-                service_rec.state = status['state']
-                service_rec.save()
+    spool_dir = tempfile.mkdtemp(dir=settings.EXPORT_JOB_DIR)
+    fields = job.field_list()
 
-    # if we got here, let's update the search time range
-    ss.update_recent_search_window(start, end)
-    logger.info("Finished service status check")
+    def _spool(part):
+        """Spool one slice into its own directory."""
+
+        i, (name, search) = part
+        directory = os.path.join(spool_dir, str(i))
+        os.mkdir(directory)
+        return name, spool_search(search, directory, fields)
+
+    try:
+        slices = job.slices()
+        pool = ThreadPool(max(1, min(settings.EXPORT_JOB_WORKERS,
+                                     len(slices))))
+        try:
+            parts = pool.map(_spool, enumerate(slices))
+        finally:
+            pool.close()
+
+        path = os.path.join(settings.EXPORT_JOB_DIR, '%s.zip' % job.uuid)
+        job.rows = write_columnar(
+            path, parts,
+            manifest={'search': str(job.search.uuid),
+                      'start': job.start.isoformat(),
+                      'end': job.end.isoformat()})
+        job.path = path
+        job.state = ExportJob.DONE
+    except Exception as exc:           # pylint: disable=W0703
+        logger.exception("export job %s failed", job.uuid)
+        job.state = ExportJob.FAILED
+        job.error = str(exc)
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+    job.save()
+    return job.state
 
 
 @celery_app.task()
-def nova_hypervisors_stats():
-    """Get stats from the nova API and add them as Goldstone metrics."""
-    from goldstone.models import es_conn, daily_index
+def prune_export_jobs():
+    """Delete ExportJobs, and their files, that are older than
+    EXPORT_JOB_RETENTION days."""
 
-    novaclient = get_nova_client()
-    response = novaclient.hypervisors.statistics()._info
-    region = get_keystone_region()
-    metric_prefix = 'nova.hypervisor.'
-    now = arrow.utcnow()
-    conn = es_conn()
-    es_index = daily_index(METRIC_INDEX_PREFIX)
-    es_doc_type = METRIC_DOCTYPE
+    cutoff = arrow.utcnow().replace(days=-settings.EXPORT_JOB_RETENTION)
 
-    for key, value in response.items():
-        doc = {
-            'type': es_doc_type,
-            'name': metric_prefix + key,
-            'value': value,
-            'metric_type': 'gauge',
-            '@timestamp': now.isoformat(),
-            'region': region
-        }
-
-        if key in ['disk_available_least', 'free_disk_gb', 'local_gb',
-                   'local_gb_used']:
-            doc['unit'] = 'GB'
-        elif key in ['free_ram_mb', 'memory_mb', 'memory_mb_used']:
-            doc['unit'] = 'MB'
-        else:
-            doc['unit'] = 'count'
+    # Delete them one by one, so that post_delete removes their files.
+    jobs = ExportJob.objects.filter(created__lt=cutoff.datetime)
+    for job in jobs:
+        job.delete()
 
-        conn.create(es_index, es_doc_type, doc)
+    return len(jobs)
@@ -17,13 +17,15 @@ from datetime import datetime
 from smtplib import SMTPException
 
 import arrow
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
+from jinja2.exceptions import SecurityError
 from elasticsearch_dsl import Search
 from mock import patch, Mock, MagicMock
 from rest_framework.test import APITestCase
 
+from goldstone.core.alert_templates import TemplateCache, template_cache
 from goldstone.core.models import SavedSearch, AlertDefinition, \
-    EmailProducer, Alert
+    EmailProducer, Alert, SearchSchedule
 
 
 class ModelTests(TestCase):
@@ -190,8 +192,9 @@ class ModelTests(TestCase):
         self.assertDictEqual(search.to_dict(), search_recent.to_dict())
         self.assertEqual(search._doc_type, [])
 
+    @patch('goldstone.core.tasks.queue_alert_delivery')
     @patch('goldstone.core.models.Alert')
-    def test_alert_def_evaluate(self, mock_alert):
+    def test_alert_def_evaluate(self, mock_alert, mock_queue):
         """tests that alert definitions properly create alerts, and produce
         notifications."""
 
@@ -219,3 +222,259 @@ class ModelTests(TestCase):
                          expected_short)
         self.assertEqual(mock_alert.call_args[1]['long_message'],
                          expected_long)
+
+        # the new alert is queued for delivery, not sent inline.
+        mock_queue.assert_called_once_with([mock_alert.return_value])
+
+    @patch('goldstone.core.tasks.queue_alert_delivery')
+    def test_alert_def_coalesce(self, mock_queue):
+        """Firings within the coalescing window are counted on one alert."""
+
+        self.alert_def.coalesce_window = 600
+        self.alert_def.save()
+        result = {'hits': {'total': 1}}
+        start = arrow.utcnow().replace(minutes=-30).datetime
+
+        def window(minutes):
+            """Return the window that starts minutes after start."""
+            return (arrow.get(start).replace(minutes=minutes).datetime,
+                    arrow.get(start).replace(minutes=minutes + 1).datetime)
+
+        first = self.alert_def.evaluate(result, *window(0))
+        self.assertIsNotNone(first)
+        self.assertIsNone(self.alert_def.evaluate(result, *window(1)))
+        self.assertIsNone(self.alert_def.evaluate(result, *window(5)))
+        self.assertEqual(mock_queue.call_count, 1)
+
+        first = Alert.objects.get(pk=first.pk)
+        self.assertEqual(first.occurrences, 3)
+        self.assertEqual(first.first_occurrence, window(0)[0])
+        self.assertEqual(first.last_occurrence, window(5)[1])
+
+        # a firing after the window closes starts a new alert.
+        self.assertIsNotNone(self.alert_def.evaluate(result, *window(20)))
+        self.assertEqual(mock_queue.call_count, 2)
+
+    @patch('goldstone.core.tasks.queue_alert_delivery')
+    def test_alert_def_digest(self, mock_queue):
+        """Digest alerts are delivered when their window closes."""
+        from goldstone.core.tasks import deliver_alert_digests
+
+        self.alert_def.coalesce_window = 600
+        self.alert_def.digest = True
+        self.alert_def.save()
+        result = {'hits': {'total': 1}}
+        start = arrow.utcnow().replace(minutes=-5)
+
+        alert = self.alert_def.evaluate(
+            result, start.datetime, start.replace(minutes=+1).datetime)
+        self.alert_def.evaluate(
+            result, start.replace(minutes=+1).datetime,
+            start.replace(minutes=+2).datetime)
+        self.assertFalse(alert.delivered)
+        self.assertFalse(mock_queue.called)
+
+        # the window hasn't closed yet.
+        deliver_alert_digests()
+        self.assertEqual(mock_queue.call_args[0][0], [])
+
+        with patch('django.utils.timezone.now',
+                   return_value=start.replace(minutes=+11).datetime):
+            deliver_alert_digests()
+
+        delivered = mock_queue.call_args[0][0]
+        self.assertEqual([a.pk for a in delivered], [alert.pk])
+        self.assertIn('(2 occurrences)', delivered[0].short_message)
+        self.assertTrue(Alert.objects.get(pk=alert.pk).delivered)
+
+        # it's only delivered once.
+        deliver_alert_digests()
+        self.assertEqual(mock_queue.call_args[0][0], [])
+
+        # a later firing that falls in the window starts a new alert, since
+        # the digest was already delivered.
+        late = self.alert_def.evaluate(
+            result, start.replace(minutes=+2).datetime,
+            start.replace(minutes=+3).datetime)
+        self.assertIsNotNone(late)
+        self.assertEqual(Alert.objects.get(pk=alert.pk).occurrences, 2)
+
+    @patch('goldstone.core.tasks.queue_alert_delivery')
+    def test_alert_def_digest_closed(self, mock_queue):
+        """A firing isn't folded into a digest whose window has closed in
+        real time, even if the firing's window ends inside it."""
+
+        self.alert_def.coalesce_window = 600
+        self.alert_def.digest = True
+        self.alert_def.save()
+        result = {'hits': {'total': 1}}
+        start = arrow.utcnow().replace(minutes=-30)
+
+        first = self.alert_def.evaluate(
+            result, start.datetime, start.replace(minutes=+1).datetime)
+        second = self.alert_def.evaluate(
+            result, start.replace(minutes=+4).datetime,
+            start.replace(minutes=+5).datetime)
+
+        self.assertIsNotNone(second)
+        self.assertNotEqual(first.pk, second.pk)
+        self.assertEqual(Alert.objects.get(pk=first.pk).occurrences, 1)
+
+    @patch('goldstone.core.models.get_connection')
+    def test_email_producer_batch(self, mock_get_connection):
+        """A batch of emails goes over one connection, and failures are
+        returned per message."""
+
+        connection = mock_get_connection.return_value
+        connection.send_messages.side_effect = [1, SMTPException('no'), 1]
+        deliveries = [(self.alert, self.producer)] * 3
+
+        failed = EmailProducer.produce_batch(deliveries)
+
+        self.assertEqual(mock_get_connection.call_count, 1)
+        self.assertEqual(connection.open.call_count, 1)
+        self.assertEqual(connection.close.call_count, 1)
+        self.assertEqual(connection.send_messages.call_count, 3)
+        message = connection.send_messages.call_args[0][0][0]
+        self.assertEqual(message.subject, self.alert.short_message)
+        self.assertEqual(message.to, [self.producer.receiver])
+        self.assertEqual(len(failed), 1)
+        self.assertIsInstance(failed[0][2], SMTPException)
+
+        # if the relay is down, the whole batch fails.
+        connection.open.side_effect = SMTPException('down')
+        self.assertEqual(len(EmailProducer.produce_batch(deliveries)), 3)
+
+    def test_search_window_compare_and_swap(self):
+        """A window is only advanced if nobody else advanced it first."""
+
+        self.saved_search.last_end = \
+            arrow.utcnow().replace(minutes=-10).datetime
+        self.saved_search.save()
+        search, start, end = self.saved_search.search_recent()
+
+        # another copy of the search advances the window first.
+        other = SavedSearch.objects.get(pk=self.saved_search.pk)
+        other.update_recent_search_window(start, end)
+
+        later = arrow.get(end).replace(minutes=+5).datetime
+        self.saved_search.update_recent_search_window(start, later)
+
+        stored = SavedSearch.objects.get(pk=self.saved_search.pk)
+        self.assertEqual(stored.last_end, end)
+        self.assertEqual(self.saved_search.last_end, end)
+
+    def test_search_schedule_lease(self):
+        """Only one owner holds a search's lease until it's released or
+        expires."""
+
+        self.assertTrue(SearchSchedule.claim(self.saved_search, 'a'))
+        self.assertFalse(SearchSchedule.claim(self.saved_search, 'b'))
+
+        # only the owner can release it.
+        self.assertFalse(SearchSchedule.release(self.saved_search, 'b'))
+        self.assertTrue(SearchSchedule.release(self.saved_search, 'a'))
+        self.assertTrue(SearchSchedule.claim(self.saved_search, 'b'))
+
+        # an expired lease can be claimed by someone else.
+        SearchSchedule.objects.filter(pk=self.saved_search.pk).update(
+            lease_expires=arrow.utcnow().replace(seconds=-1).datetime)
+        self.assertTrue(SearchSchedule.claim(self.saved_search, 'c'))
+        self.assertFalse(SearchSchedule.release(self.saved_search, 'b'))
+
+    def test_search_schedule_claim_reloads_window(self):
+        """Claiming a lease picks up a window advanced by another task."""
+
+        stale = SavedSearch.objects.get(pk=self.saved_search.pk)
+        end = arrow.utcnow().replace(microsecond=0).datetime
+        self.saved_search.update_recent_search_window(
+            self.saved_search.last_end, end)
+
+        self.assertTrue(SearchSchedule.claim(stale, 'a'))
+        self.assertEqual(stale.last_end, end)
+
+    @patch('goldstone.core.tasks.queue_alert_delivery')
+    @patch('goldstone.core.models.Alert')
+    def test_alert_def_hits_template(self, mock_alert, _):
+        """Templates can use the hit documents, and say so."""
+
+        self.assertFalse(self.alert_def.references_hits())
+
+        self.alert_def.long_template = \
+            '{% for hit in _hits %}{{ hit.message }};{% endfor %}'
+        self.assertTrue(self.alert_def.references_hits())
+
+        search, start, end = self.saved_search.search_recent()
+        search_result = {'hits': {'total': 2,
+                                  'hits': [{'_source': {'message': 'a'}},
+                                           {'_source': {'message': 'b'}}]}}
+        self.alert_def.evaluate(search_result, start, end)
+
+        self.assertEqual(mock_alert.call_args[1]['long_message'], 'a;b;')
+
+    def test_alert_defs_share_templates(self):
+        """Definitions with the same template text share its entry, and
+        saving or deleting one leaves the entry to the others."""
+
+        template_cache.clear()
+        self.alert_def.references_hits()
+        self.assertEqual(len(template_cache), 2)
+
+        alert_def = AlertDefinition.objects.create(
+            name='other', search=self.saved_search,
+            short_template=self.alert_def.short_template,
+            long_template=self.alert_def.long_template)
+        alert_def.references_hits()
+        self.assertEqual(len(template_cache), 2)
+
+        alert_def.delete()
+        with patch.object(template_cache.environment, 'from_string') as \
+                compile_:
+            self.alert_def.references_hits()
+            self.assertFalse(compile_.called)
+
+
+class TemplateCacheTests(SimpleTestCase):
+    """Test the compiled alert template cache."""
+
+    def test_compiled_once(self):
+        """A template's text is compiled once, and evicted LRU-first."""
+
+        cache = TemplateCache(max_size=2, sandboxed=False)
+
+        with patch.object(cache.environment, 'from_string',
+                          wraps=cache.environment.from_string) as compile_:
+            self.assertEqual(cache.render('a {{x}}', {'x': 1}), 'a 1')
+            self.assertEqual(cache.render('a {{x}}', {'x': 2}), 'a 2')
+            self.assertEqual(compile_.call_count, 1)
+
+            cache.get('b')
+            cache.get('a {{x}}')
+            cache.get('c')          # evicts 'b'
+            self.assertEqual(len(cache), 2)
+            self.assertEqual(compile_.call_count, 3)
+
+            cache.get('a {{x}}')
+            self.assertEqual(compile_.call_count, 3)
+            cache.get('b')
+            self.assertEqual(compile_.call_count, 4)
+
+    def test_variables(self):
+        """Referenced variables are reported."""
+
+        cache = TemplateCache(max_size=10, sandboxed=False)
+
+        self.assertEqual(cache.variables('{{a}} {{b.c}}'), set(['a', 'b']))
+        cache.get('{{d}}')
+        self.assertEqual(len(cache), 2)
+
+    def test_sandboxed(self):
+        """The sandboxed mode blocks unsafe attribute access."""
+
+        template = '{{ x.__class__.__subclasses__() }}'
+
+        self.assertTrue(TemplateCache(max_size=10, sandboxed=False)
+                        .render(template, {'x': object()}))
+        self.assertRaises(SecurityError,
+                          TemplateCache(max_size=10, sandboxed=True).render,
+                          template, {'x': object()})
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import json
+import tempfile
 from types import NoneType
 
 from mock import patch
@@ -21,10 +22,13 @@ from mock import patch
 from rest_framework.status import HTTP_200_OK, \
     HTTP_401_UNAUTHORIZED, \
     HTTP_405_METHOD_NOT_ALLOWED, \
-    HTTP_204_NO_CONTENT
+    HTTP_204_NO_CONTENT, \
+    HTTP_201_CREATED, \
+    HTTP_400_BAD_REQUEST, \
+    HTTP_409_CONFLICT
 from rest_framework.test import APIRequestFactory, force_authenticate
 
-from goldstone.core.models import SavedSearch
+from goldstone.core.models import ExportJob, SavedSearch
 from goldstone.core.views import SavedSearchViewSet
 from goldstone.test_utils import Setup, create_and_login, \
     AUTHORIZATION_PAYLOAD, CONTENT_BAD_TOKEN, CONTENT_NO_CREDENTIALS, \
@@ -33,6 +37,7 @@ from goldstone.test_utils import Setup, create_and_login, \
 SEARCH_URL = "/core/saved_search/"
 SEARCH_UUID_URL = SEARCH_URL + "%s/"
 SEARCH_UUID_RESULTS_URL = SEARCH_UUID_URL + "results/"
+EXPORT_JOB_URL = "/core/export_job/"
 
 
 class SearchSetup(Setup):
@@ -331,3 +336,256 @@ class GetPostTests(SearchSetup):
 
         self.assertEqual(response.status_code,
                          HTTP_405_METHOD_NOT_ALLOWED)
+
+
+class ExportTests(SearchSetup):
+    """GET /saved_search/<uuid>/export/."""
+
+    def setUp(self):
+
+        super(ExportTests, self).setUp()
+        self.search = SavedSearch.objects.filter(
+            hidden=False, timestamp_field__isnull=False)[0]
+        self.url = SEARCH_UUID_URL % self.search.uuid + "export/"
+
+    @patch('goldstone.drfes.export.scan_sources')
+    def test_ndjson(self, scan_sources):
+        """Results stream as NDJSON, with the request's filters."""
+
+        scan_sources.return_value = iter([{'a': 1}, {'a': 2}])
+        token = create_and_login()
+
+        response = self.client.get(
+            self.url + '?fields=a&syslog_severity=ERROR',
+            HTTP_AUTHORIZATION=AUTHORIZATION_PAYLOAD % token)
+
+        self.assertEqual(response.status_code, HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(
+            [json.loads(line)
+             for line in b''.join(response.streaming_content).splitlines()],
+            [{'a': 1}, {'a': 2}])
+
+        search, fields = scan_sources.call_args[0]
+        self.assertEqual(fields, ['a'])
+        self.assertIn({'fquery': {'query': {'match': {'syslog_severity':
+                                                      'ERROR'}}}},
+                      search.to_dict()['query']['filtered']['filter']['bool'][
+                          'must'])
+
+    @patch('goldstone.drfes.export.scan_sources')
+    def test_csv(self, scan_sources):
+        """Results stream as CSV, and bad formats are rejected."""
+
+        scan_sources.return_value = iter([{'a': 1, 'b': {'c': u'\xe9'}}])
+        token = create_and_login()
+
+        response = self.client.get(
+            self.url + '?output=csv&fields=a,b.c',
+            HTTP_AUTHORIZATION=AUTHORIZATION_PAYLOAD % token)
+
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(b''.join(response.streaming_content),
+                         b'a,b.c\r\n1,\xc3\xa9\r\n')
+
+        response = self.client.get(
+            self.url + '?output=xml',
+            HTTP_AUTHORIZATION=AUTHORIZATION_PAYLOAD % token)
+
+        self.assertEqual(response.status_code, HTTP_400_BAD_REQUEST)
+
+
+class RollupRoutingTests(SearchSetup):
+    """GET /saved_search/<uuid>/results/ with rollups."""
+
+    @patch('goldstone.drfes.pagination.agg_cache')
+    @patch('goldstone.core.views.rollups')
+    def test_results(self, mock_rollups, mock_cache):
+        """The rollup plan's raw search is paginated, and merged with the
+        rollups."""
+        from elasticsearch_dsl.result import Response
+
+        raw = Response({'hits': {'total': 3, 'hits': []},
+                        'aggregations': {'_rollup_raw': {}}})
+        merged = Response({'hits': {'total': 3, 'hits': []},
+                           'aggregations': {'per_interval': {}}})
+        mock_cache.execute.return_value = raw
+        plan = mock_rollups.plan.return_value
+        plan.merge.return_value = merged
+        token = create_and_login()
+
+        response = self.client.get(
+            SEARCH_UUID_RESULTS_URL % '18936ecd-11f5-413c-9e70-fc9a7dd037e3' +
+            '?@timestamp__range={"gte":1451606400000,"lte":1451692800000}'
+            '&interval=1h',
+            HTTP_AUTHORIZATION=AUTHORIZATION_PAYLOAD % token)
+
+        self.assertEqual(response.status_code, HTTP_200_OK)
+        self.assertEqual(json.loads(response.content)['aggregations'],
+                         {'per_interval': {}})
+
+        search, start, end = mock_rollups.plan.call_args[0]
+        self.assertEqual((start, end), (1451606400000, 1451692800000))
+        self.assertEqual(search.aggs.aggs['per_interval'].interval, '1h')
+        # The page is sliced from the raw search.
+        self.assertIs(mock_cache.execute.call_args[0][0],
+                      plan.raw_search.__getitem__.return_value)
+        plan.merge.assert_called_once_with(raw)
+
+
+class RefreshAheadTests(SearchSetup):
+    """GET /saved_search/<uuid>/results/ with refresh-ahead."""
+
+    # The end of the default window, and the search behind /core/api-calls/.
+    END = 1451606400000 + 7 * 24 * 3600 * 1000
+    UUID = '18936ecd-11f5-413c-9e70-fc9a7dd037e3'
+
+    def _url(self, end, extra=''):
+        """Return a results URL for the default window ending at end."""
+
+        return SEARCH_UUID_RESULTS_URL % self.UUID + \
+            '?@timestamp__range={"gte":%d,"lte":%d}&interval=1h%s' % \
+            (end - 7 * 24 * 3600 * 1000, end, extra)
+
+    @patch('goldstone.drfes.pagination.agg_cache')
+    @patch('goldstone.core.refresh.RefreshAhead._redis')
+    def test_lookup(self, mock_redis, mock_cache):
+        """A default request is served from a stored page; others aren't."""
+        from elasticsearch_dsl.result import Response
+
+        page = {'count': 11, 'results': [{'a': 1}],
+                'aggregations': {'per_interval': {'buckets': []}}}
+        mock_redis.return_value.get.return_value = json.dumps(
+            {'start': self.END - 7 * 24 * 3600 * 1000, 'end': self.END,
+             'page': page})
+        mock_cache.execute.return_value = Response(
+            {'hits': {'total': 30, 'hits': []}})
+        token = create_and_login()
+
+        response = self.client.get(
+            self._url(self.END + 30000),
+            HTTP_AUTHORIZATION=AUTHORIZATION_PAYLOAD % token)
+
+        self.assertEqual(response.status_code, HTTP_200_OK)
+        content = json.loads(response.content)
+        self.assertEqual(content['count'], 11)
+        self.assertEqual(content['results'], [{'a': 1}])
+        self.assertEqual(content['aggregations'], page['aggregations'])
+        self.assertIn('page=2', content['next'])
+        self.assertIsNone(content['previous'])
+        self.assertEqual(mock_redis.return_value.get.call_args[0][0],
+                         'goldstone:refresh_ahead:%s:3600000' % self.UUID)
+        self.assertFalse(mock_cache.execute.called)
+
+        # Later pages, other parameters, and stale pages go to ES.
+        for url in [self._url(self.END, '&page=2'),
+                    self._url(self.END, '&component=nova'),
+                    self._url(self.END + 120000)]:
+            mock_cache.reset_mock()
+            response = self.client.get(
+                url, HTTP_AUTHORIZATION=AUTHORIZATION_PAYLOAD % token)
+
+            self.assertEqual(response.status_code, HTTP_200_OK)
+            self.assertTrue(mock_cache.execute.called)
+
+    @patch('goldstone.drfes.pagination.agg_cache')
+    @patch('goldstone.core.refresh.RefreshAhead._redis')
+    def test_refresh(self, mock_redis, mock_cache):
+        """A search's pages are computed and stored, unless ES fails."""
+        from elasticsearch_dsl.result import Response
+        from goldstone.core.refresh import refresh_ahead
+
+        mock_cache.execute.return_value = Response(
+            {'hits': {'total': 1,
+                      'hits': [{'_index': 'api_stats-2016.01.08',
+                                '_type': 'api_stats', '_id': '1',
+                                '_source': {'a': 1}}]},
+             '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+             'timed_out': False})
+
+        with self.settings(REFRESH_AHEAD_INTERVALS=[None, '1h']):
+            stored = refresh_ahead.refresh(self.UUID, now=self.END / 1000)
+
+        self.assertEqual(stored, 2)
+        calls = mock_redis.return_value.set.call_args_list
+        self.assertEqual([c[0][0] for c in calls],
+                         ['goldstone:refresh_ahead:%s:None' % self.UUID,
+                          'goldstone:refresh_ahead:%s:3600000' % self.UUID])
+        value = json.loads(calls[1][0][1])
+        self.assertEqual(value['end'], self.END)
+        self.assertEqual(value['page']['count'], 1)
+        self.assertEqual(len(value['page']['results']), 1)
+
+        # The page was searched over the default window, at the interval.
+        search = mock_cache.execute.call_args[0][0]
+        self.assertEqual(search.aggs.aggs['per_interval'].interval, '1h')
+
+        # Failed searches aren't stored.
+        mock_redis.reset_mock()
+        mock_cache.execute.side_effect = Exception('oops')
+
+        self.assertEqual(
+            refresh_ahead.refresh(self.UUID, now=self.END / 1000), 0)
+        self.assertFalse(mock_redis.return_value.set.called)
+
+
+class ExportJobViewTests(SearchSetup):
+    """The /core/export_job/ endpoints."""
+
+    @patch('goldstone.core.tasks.run_export_job.delay')
+    def test_create_and_download(self, mock_delay):
+        """A created job is queued, and downloadable when it's done."""
+
+        search = SavedSearch.objects.filter(
+            hidden=False, timestamp_field__isnull=False)[0]
+        token = create_and_login()
+
+        response = self.client.post(
+            EXPORT_JOB_URL,
+            json.dumps({'search': str(search.uuid),
+                        'start': '2016-01-01T00:00:00Z',
+                        'end': '2016-01-03T00:00:00Z',
+                        'fields': 'a,b'}),
+            content_type="application/json",
+            HTTP_AUTHORIZATION=AUTHORIZATION_PAYLOAD % token)
+
+        self.assertEqual(response.status_code, HTTP_201_CREATED)
+        content = json.loads(response.content)
+        self.assertEqual(content['state'], ExportJob.PENDING)
+        self.assertNotIn('path', content)
+        mock_delay.assert_called_once_with(content['uuid'])
+
+        download_url = EXPORT_JOB_URL + content['uuid'] + '/download/'
+        response = self.client.get(
+            download_url, HTTP_AUTHORIZATION=AUTHORIZATION_PAYLOAD % token)
+        self.assertEqual(response.status_code, HTTP_409_CONFLICT)
+
+        with tempfile.NamedTemporaryFile(suffix='.zip') as export:
+            export.write(b'PK')
+            export.flush()
+            ExportJob.objects.filter(uuid=content['uuid']).update(
+                state=ExportJob.DONE, path=export.name)
+
+            response = self.client.get(
+                download_url, HTTP_AUTHORIZATION=AUTHORIZATION_PAYLOAD % token)
+
+            self.assertEqual(response.status_code, HTTP_200_OK)
+            self.assertEqual(b''.join(response.streaming_content), b'PK')
+
+    def test_create_bad_range(self):
+        """The range must not be empty."""
+
+        search = SavedSearch.objects.filter(
+            hidden=False, timestamp_field__isnull=False)[0]
+        token = create_and_login()
+
+        response = self.client.post(
+            EXPORT_JOB_URL,
+            json.dumps({'search': str(search.uuid),
+                        'start': '2016-01-03T00:00:00Z',
+                        'end': '2016-01-01T00:00:00Z'}),
+            content_type="application/json",
+            HTTP_AUTHORIZATION=AUTHORIZATION_PAYLOAD % token)
+
+        self.assertEqual(response.status_code, HTTP_400_BAD_REQUEST)
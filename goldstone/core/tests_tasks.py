@@ -12,12 +12,25 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+
+from django.db import connection
 from django.test import TestCase
-from mock import patch
+from django.test.utils import CaptureQueriesContext
+from mock import MagicMock, patch
 from rest_framework.status import HTTP_200_OK, HTTP_401_UNAUTHORIZED
 
-from goldstone.core.models import AlertDefinition, SavedSearch
-from goldstone.core.tasks import process_alerts
+from goldstone.core.models import Alert, AlertDefinition, EmailProducer, \
+    ExportJob, MonitoredService, SavedSearch, SearchSchedule, \
+    UndeliveredAlert
+from goldstone.core.tasks import deliver_alerts, evaluate_alert_definitions, \
+    mark_missing_services, process_alerts, queue_alert_delivery, \
+    reconcile_service_status, refresh_dashboards, run_export_job, \
+    service_status_pages, update_rollups
 from goldstone.test_utils import Setup, create_and_login, AUTHORIZATION_PAYLOAD
 
 
@@ -26,27 +39,475 @@ class TaskTests(TestCase):
 
     fixtures = ['core_initial_data.yaml']
 
+    @patch('goldstone.core.tasks.evaluate_alert_definitions.apply_async')
+    def test_process_alerts(self, mock_apply):
+        """Only due definitions are dispatched, within the ceiling."""
+        from datetime import timedelta
+        from django.utils import timezone
+
+        SavedSearch.objects.update(last_end=timezone.now(),
+                                   target_interval=60)
+
+        searches = SavedSearch.objects.all()[:3]
+        for ss in searches[:2]:
+            ss.last_end = timezone.now() - timedelta(seconds=120)
+            ss.save()
+
+        due = [AlertDefinition.objects.create(name='due %d' % i,
+                                              search=searches[i % 2])
+               for i in range(3)]
+
+        AlertDefinition.objects.create(name='not due', search=searches[2])
+
+        with self.settings(ALERT_MAX_CONCURRENCY=3):
+            process_alerts()
+
+        # One subtask per due search, each with all of its definitions.
+        self.assertEqual(mock_apply.call_count, 2)
+        dispatched = [sorted(call[1]['args'][0])
+                      for call in mock_apply.call_args_list]
+        self.assertEqual(sorted(dispatched),
+                         sorted([sorted([due[0].uuid, due[2].uuid]),
+                                 [due[1].uuid]]))
+
+    @patch('goldstone.core.tasks.evaluate_alert_definitions.apply_async')
+    def test_process_alerts_shared_search(self, mock_apply):
+        """Definitions of one search are never split across subtasks."""
+        from datetime import timedelta
+        from django.utils import timezone
+
+        SavedSearch.objects.update(last_end=timezone.now(),
+                                   target_interval=60)
+
+        ss = SavedSearch.objects.all()[0]
+        ss.last_end = timezone.now() - timedelta(seconds=120)
+        ss.save()
+
+        due = [AlertDefinition.objects.create(name='due %d' % i, search=ss)
+               for i in range(2)]
+
+        with self.settings(ALERT_MAX_CONCURRENCY=4):
+            process_alerts()
+
+        self.assertEqual(mock_apply.call_count, 1)
+        self.assertEqual(sorted(mock_apply.call_args[1]['args'][0]),
+                         sorted(ad.uuid for ad in due))
+
+    @patch('goldstone.core.tasks.es_multi_search')
     @patch('goldstone.core.tasks.AlertDefinition.evaluate')
     @patch("goldstone.core.tasks.logger.exception")
-    def test_process_alerts(self, mock_logger, mock_evaluate):
+    def test_evaluate_alert_definitions(self, mock_logger, mock_evaluate,
+                                        mock_msearch):
 
         ss = SavedSearch.objects.all()[0]
         ad = AlertDefinition(name=ss.name, search=ss)
         ad.save()
 
+        mock_msearch.side_effect = \
+            lambda searches: [{'hits': {'total': 0}} for _ in searches]
         mock_evaluate.return_value = None
-        alert_def_count = AlertDefinition.objects.count()
+        uuids = [alert_def.uuid for alert_def in AlertDefinition.objects.all()]
+        alert_def_count = len(uuids)
 
-        process_alerts()
+        evaluate_alert_definitions(uuids)
 
+        self.assertEqual(mock_msearch.call_count, 1)
+        self.assertEqual(len(mock_msearch.call_args[0][0]), alert_def_count)
         self.assertEqual(mock_evaluate.call_count, alert_def_count)
 
         mock_evaluate.side_effect = Exception
 
-        process_alerts()
+        evaluate_alert_definitions(uuids)
 
         self.assertTrue(mock_logger.called)
 
+    @patch('goldstone.core.tasks.es_multi_search')
+    @patch('goldstone.core.tasks.AlertDefinition.evaluate')
+    @patch("goldstone.core.tasks.logger.error")
+    def test_evaluate_search_error(self, mock_logger, mock_evaluate,
+                                   mock_msearch):
+        """A failed search doesn't stop the other definitions."""
+
+        ss1, ss2 = SavedSearch.objects.all()[:2]
+        first = AlertDefinition.objects.create(name='first', search=ss1)
+        second = AlertDefinition.objects.create(name='second', search=ss2)
+
+        mock_msearch.return_value = [{'error': 'boom'},
+                                     {'hits': {'total': 0}}]
+        mock_evaluate.return_value = None
+
+        evaluate_alert_definitions([first.uuid, second.uuid])
+
+        self.assertEqual(mock_logger.call_count, 1)
+        self.assertEqual(mock_evaluate.call_count, 1)
+
+    @patch('goldstone.core.tasks.es_multi_search')
+    @patch('goldstone.core.tasks.AlertDefinition.evaluate')
+    def test_evaluate_leased_search(self, mock_evaluate, mock_msearch):
+        """Definitions whose search is leased elsewhere are skipped, and
+        leases are released afterwards."""
+
+        first, second = SavedSearch.objects.all()[:2]
+        ad1 = AlertDefinition.objects.create(name='first', search=first)
+        ad2 = AlertDefinition.objects.create(name='second', search=second)
+
+        self.assertTrue(SearchSchedule.claim(second, 'someone else'))
+        mock_msearch.side_effect = \
+            lambda searches: [{'hits': {'total': 0}} for _ in searches]
+        mock_evaluate.return_value = None
+
+        evaluate_alert_definitions([ad1.uuid, ad2.uuid])
+
+        self.assertEqual(len(mock_msearch.call_args[0][0]), 1)
+        self.assertEqual(mock_evaluate.call_count, 1)
+        self.assertIsNone(SearchSchedule.objects.get(pk=first.pk).lease_owner)
+        self.assertEqual(SearchSchedule.objects.get(pk=second.pk).lease_owner,
+                         'someone else')
+
+    @patch('goldstone.core.tasks.es_multi_search')
+    @patch('goldstone.core.tasks.AlertDefinition.evaluate')
+    def test_evaluate_count_only(self, mock_evaluate, mock_msearch):
+        """Searches are run as counts unless a template uses the hits."""
+
+        first, second = SavedSearch.objects.all()[:2]
+        ad1 = AlertDefinition.objects.create(name='count', search=first)
+        ad2 = AlertDefinition.objects.create(
+            name='hits', search=second,
+            long_template='{{ _hits[0].message }}')
+        mock_msearch.side_effect = \
+            lambda searches: [{'hits': {'total': 0}} for _ in searches]
+        mock_evaluate.return_value = None
+
+        with self.settings(ALERT_TERMINATE_AFTER=1):
+            evaluate_alert_definitions([ad1.uuid, ad2.uuid])
+
+        count, hits = sorted([search.to_dict()
+                              for search in mock_msearch.call_args[0][0]],
+                             key=lambda body: 'terminate_after' not in body)
+        self.assertEqual(count['size'], 0)
+        self.assertEqual(count['terminate_after'], 1)
+        self.assertNotIn('terminate_after', hits)
+        self.assertNotEqual(hits.get('size'), 0)
+
+
+class AlertDeliveryTests(TestCase):
+    """Test the asynchronous delivery of alerts."""
+
+    fixtures = ['core_initial_data.yaml']
+
+    def setUp(self):
+
+        ss = SavedSearch.objects.all()[0]
+        self.alert_def = AlertDefinition.objects.create(name='def', search=ss)
+        self.producers = [
+            EmailProducer.objects.create(receiver='a@example.com',
+                                         alert_def=self.alert_def),
+            EmailProducer.objects.create(receiver='b@example.com',
+                                         alert_def=self.alert_def)]
+        self.alert = Alert.objects.create(short_message='short',
+                                          long_message='long',
+                                          alert_def=self.alert_def)
+        self.deliveries = [[self.alert.uuid, producer.uuid]
+                           for producer in self.producers]
+
+    @patch('goldstone.core.tasks.deliver_alerts.apply_async')
+    def test_queue_alert_delivery(self, mock_apply):
+        """An alert is queued for each of its definition's producers."""
+
+        queue_alert_delivery([])
+        self.assertFalse(mock_apply.called)
+
+        queue_alert_delivery([self.alert])
+        self.assertEqual(sorted(mock_apply.call_args[1]['args'][0]),
+                         sorted(self.deliveries))
+
+    @patch('goldstone.core.models.EmailProducer.produce_batch')
+    def test_deliver_alerts(self, mock_batch):
+        """Deliveries are sent in one batch per producer class."""
+
+        mock_batch.return_value = []
+
+        deliver_alerts(self.deliveries)
+
+        self.assertEqual(mock_batch.call_count, 1)
+        self.assertEqual(sorted(producer.uuid for _, producer in
+                                mock_batch.call_args[0][0]),
+                         sorted(producer.uuid for producer in self.producers))
+        self.assertFalse(UndeliveredAlert.objects.exists())
+
+    @patch('goldstone.core.tasks.deliver_alerts.retry')
+    @patch('goldstone.core.models.EmailProducer.produce_batch')
+    def test_deliver_alerts_retry(self, mock_batch, mock_retry):
+        """Only the failed deliveries are retried, with a backoff."""
+
+        alert, producer = self.alert, self.producers[1]
+        mock_batch.return_value = [(alert, producer, Exception('busy'))]
+        mock_retry.return_value = Exception('retry')
+
+        with self.settings(ALERT_DELIVERY_RETRY_BACKOFF=10):
+            self.assertRaises(Exception, deliver_alerts, self.deliveries)
+
+        self.assertEqual(mock_retry.call_args[1]['args'],
+                         [[[alert.uuid, producer.uuid]]])
+        self.assertEqual(mock_retry.call_args[1]['countdown'], 10)
+
+    @patch('goldstone.core.models.EmailProducer.produce_batch')
+    def test_deliver_alerts_dead_letter(self, mock_batch):
+        """Deliveries that run out of retries are recorded."""
+
+        mock_batch.return_value = [
+            (self.alert, self.producers[0], Exception('bounced'))]
+
+        with self.settings(ALERT_DELIVERY_MAX_RETRIES=0):
+            deliver_alerts(self.deliveries)
+
+        undelivered = UndeliveredAlert.objects.get()
+        self.assertEqual(undelivered.alert, self.alert)
+        self.assertEqual(undelivered.producer.pk, self.producers[0].pk)
+        self.assertEqual(undelivered.error, 'bounced')
+        self.assertEqual(undelivered.attempts, 1)
+
+
+class ServiceStatusTests(TestCase):
+    """Test reconciling MonitoredService records with a status search."""
+
+    @staticmethod
+    def host_bucket(host, **counts):
+        """Return a per_host bucket with a per_component count per
+        service."""
+
+        return {'key': host,
+                'doc_count': sum(counts.values()),
+                'per_component': {'buckets': [
+                    {'key': name, 'doc_count': count}
+                    for name, count in sorted(counts.items())]}}
+
+    @staticmethod
+    def statements(queries):
+        """Return the kinds of SQL statements captured, except savepoints."""
+
+        import re
+
+        return [re.search(r'SELECT|INSERT|UPDATE|DELETE', query['sql']).group()
+                for query in queries.captured_queries
+                if 'SAVEPOINT' not in query['sql']]
+
+    def state(self, host, name):
+        """Return the stored state of a service."""
+
+        return MonitoredService.objects.get(host=host, name=name).state
+
+    @patch('goldstone.core.tasks.logger.info')
+    def test_reconcile(self, mock_info):
+        """New services are added, and changed states are updated."""
+
+        for host, name, state in [('h1', 'nova', MonitoredService.UP),
+                                  ('h1', 'glance', MonitoredService.UP),
+                                  ('h2', 'nova', MonitoredService.UP),
+                                  ('h3', 'nova', MonitoredService.UNKNOWN)]:
+            MonitoredService.objects.create(host=host, name=name, state=state)
+
+        buckets = [self.host_bucket('h1', nova=5, glance=0, cinder=1),
+                   self.host_bucket('h4', nova=1)]
+
+        # one read, one insert, and one update per new state.
+        with CaptureQueriesContext(connection) as queries:
+            found = reconcile_service_status(buckets)
+        self.assertEqual(self.statements(queries),
+                         ['SELECT', 'INSERT', 'UPDATE'])
+        self.assertEqual(found, set(['h1', 'h4']))
+
+        mark_missing_services(found)
+
+        self.assertEqual(self.state('h1', 'nova'), MonitoredService.UP)
+        self.assertEqual(self.state('h1', 'glance'), MonitoredService.DOWN)
+        self.assertEqual(self.state('h1', 'cinder'), MonitoredService.UP)
+        self.assertEqual(self.state('h2', 'nova'), MonitoredService.UNKNOWN)
+        self.assertEqual(self.state('h3', 'nova'), MonitoredService.UNKNOWN)
+        self.assertEqual(self.state('h4', 'nova'), MonitoredService.UP)
+        self.assertEqual(MonitoredService.objects.count(), 6)
+
+        messages = sorted(call[0][0] for call in mock_info.call_args_list)
+        self.assertEqual(messages, sorted([
+            "Service status update: service cinder discovered on host h1 "
+            "with state UP",
+            "Service status update: service nova discovered on host h4 "
+            "with state UP",
+            "Service status update: service glance on host h1 changed state "
+            "from UP to DOWN",
+            "Service status update: service nova on host h2 changed state "
+            "from UP to UNKNOWN"]))
+
+        # nothing changes the second time around.
+        mock_info.reset_mock()
+        with CaptureQueriesContext(connection) as queries:
+            reconcile_service_status(buckets)
+        self.assertEqual(self.statements(queries), ['SELECT'])
+        mark_missing_services(found)
+        self.assertFalse(mock_info.called)
+
+    def test_pages(self):
+        """The status aggregation is run a page of hosts at a time."""
+
+        per_host = {'terms': {'field': 'host', 'min_doc_count': 0},
+                    'aggs': {'per_component': {'terms': {
+                        'field': 'component', 'min_doc_count': 0}}}}
+        bodies = []
+
+        def extra(**kwargs):
+            """Record a request, and answer it."""
+
+            bodies.append(kwargs['aggs'])
+            response = MagicMock()
+            if 'hosts' in kwargs['aggs']:
+                buckets = [{'key': host} for host in ['a', 'b', 'c']]
+                aggs = {'hosts': {'buckets': buckets}}
+            else:
+                hosts = kwargs['aggs']['per_host']['terms']['include']
+                aggs = {'per_host': {'buckets': [self.host_bucket(host, x=1)
+                                                 for host in hosts]}}
+            response.execute.return_value.to_dict.return_value = \
+                {'aggregations': aggs}
+            return response
+
+        search = MagicMock()
+        search.extra.side_effect = extra
+
+        pages = list(service_status_pages(search, per_host, 2))
+
+        self.assertEqual([[bucket['key'] for bucket in page]
+                          for page in pages], [['a', 'b'], ['c']])
+        self.assertEqual(bodies[0]['hosts']['terms'],
+                         {'field': 'host', 'size': 0, 'min_doc_count': 0,
+                          'order': {'_term': 'asc'}})
+        page_terms = bodies[1]['per_host']['terms']
+        self.assertEqual((page_terms['include'], page_terms['size']),
+                         (['a', 'b'], 2))
+        self.assertEqual(
+            bodies[1]['per_host']['aggs']['per_component']['terms']['size'],
+            0)
+        # the saved aggregation isn't modified.
+        self.assertNotIn('include', per_host['terms'])
+
+
+class ExportJobTests(TestCase):
+    """Tests for the export job tasks."""
+
+    fixtures = ['core_initial_data.yaml']
+
+    def setUp(self):
+        from datetime import timedelta
+        from django.utils import timezone
+
+        self.directory = tempfile.mkdtemp()
+        self.search = SavedSearch.objects.filter(
+            timestamp_field__isnull=False)[0]
+        self.job = ExportJob.objects.create(
+            search=self.search, fields='a,b.c',
+            start=timezone.now() - timedelta(days=2), end=timezone.now())
+
+    def tearDown(self):
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    @patch('goldstone.drfes.export.scan_sources')
+    @patch('goldstone.core.models.es_indices_for_range')
+    def test_run_export_job(self, mock_indices, mock_scan):
+        """Each daily index is spooled and zipped by column."""
+
+        mock_indices.return_value = ['logstash-2016.01.01',
+                                     'logstash-2016.01.02*']
+        mock_scan.side_effect = lambda search, fields: iter(
+            [{'a': index, 'b': {'c': 1}} for index in search._index])
+
+        with self.settings(EXPORT_JOB_DIR=self.directory):
+            self.assertEqual(run_export_job(self.job.uuid), ExportJob.DONE)
+
+        job = ExportJob.objects.get(uuid=self.job.uuid)
+        self.assertEqual(job.rows, 2)
+        self.assertEqual(mock_scan.call_args[0][1], ['a', 'b.c'])
+
+        with zipfile.ZipFile(job.path) as archive:
+            self.assertEqual(
+                sorted(archive.namelist()),
+                ['logstash-2016.01.01/0.jsonl',
+                 'logstash-2016.01.01/1.jsonl',
+                 'logstash-2016.01.02/0.jsonl',
+                 'logstash-2016.01.02/1.jsonl',
+                 'manifest.json'])
+            self.assertEqual(archive.read('logstash-2016.01.02/0.jsonl'),
+                             '"logstash-2016.01.02*"\n')
+            manifest = json.loads(archive.read('manifest.json'))
+            self.assertEqual(manifest['search'], str(self.search.uuid))
+            self.assertEqual(manifest['parts'][1]['columns'],
+                             [{'name': 'a',
+                               'member': 'logstash-2016.01.02/0.jsonl'},
+                              {'name': 'b.c',
+                               'member': 'logstash-2016.01.02/1.jsonl'}])
+
+        # Only the zip file is left, and deleting the job removes it.
+        self.assertEqual(os.listdir(self.directory),
+                         [os.path.basename(job.path)])
+        job.delete()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    @patch('goldstone.drfes.export.scan_sources')
+    @patch('goldstone.core.models.es_indices_for_range')
+    def test_run_export_job_failed(self, mock_indices, mock_scan):
+        """A failed job records its error."""
+
+        mock_indices.return_value = None
+        mock_scan.side_effect = Exception('oops')
+
+        with self.settings(EXPORT_JOB_DIR=self.directory):
+            self.assertEqual(run_export_job(self.job.uuid),
+                             ExportJob.FAILED)
+
+        job = ExportJob.objects.get(uuid=self.job.uuid)
+        self.assertEqual(job.error, 'oops')
+        self.assertIsNone(job.path)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class RollupTaskTests(TestCase):
+    """Tests for the rollup task."""
+
+    @patch('goldstone.core.tasks.rollups')
+    def test_update_rollups(self, mock_rollups):
+        """Every source is rolled up, even if another fails."""
+
+        mock_rollups.sources.return_value = {'api_stats': 'a',
+                                             'core_metric': 'b'}
+        mock_rollups.update.side_effect = [3, Exception('oops')]
+
+        self.assertEqual(update_rollups('1h'), {'api_stats': 3})
+        self.assertEqual(mock_rollups.update.call_args_list,
+                         [(('a', '1h'), {}), (('b', '1h'), {})])
+
+        with self.settings(ROLLUP_ENABLED=False):
+            self.assertEqual(update_rollups('1h'), {})
+
+
+class RefreshDashboardsTaskTests(TestCase):
+    """Tests for the refresh-ahead task."""
+
+    @patch('goldstone.core.tasks.refresh_ahead')
+    def test_refresh_dashboards(self, mock_refresh):
+        """Every shortcut search is refreshed, even if another fails."""
+        from goldstone.core.models import SHORTCUT_SEARCHES
+
+        uuids = sorted(SHORTCUT_SEARCHES.values())
+        mock_refresh.refresh.side_effect = \
+            [Exception('oops')] + [2] * (len(uuids) - 1)
+
+        self.assertEqual(refresh_dashboards(),
+                         dict((uuid, 2) for uuid in uuids[1:]))
+        self.assertEqual(mock_refresh.refresh.call_args_list,
+                         [((uuid, ), {}) for uuid in uuids])
+
+        with self.settings(REFRESH_AHEAD_ENABLED=False):
+            self.assertEqual(refresh_dashboards(), {})
+
 
 class AuthToken(Setup):
     """Test authorization token expiration."""
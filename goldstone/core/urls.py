@@ -15,8 +15,10 @@
 from django.conf.urls import url, patterns
 from rest_framework.routers import DefaultRouter
 
+from .models import SHORTCUT_SEARCHES
 from .views import SavedSearchViewSet, AlertDefinitionViewSet, AlertViewSet, \
-    ProducerViewSet, EmailProducerViewSet, MonitoredServiceViewSet
+    ProducerViewSet, EmailProducerViewSet, MonitoredServiceViewSet, \
+    ExportJobViewSet, ElasticsearchPoolStatsView, AggregationCacheStatsView
 
 router = DefaultRouter()
 
@@ -38,20 +40,25 @@ router.register(r'email_producer',
 router.register(r'monitored_service',
                 MonitoredServiceViewSet,
                 base_name="monitored_service")
+router.register(r'export_job',
+                ExportJobViewSet,
+                base_name="export_job")
 
 urlpatterns = router.urls
 urlpatterns += patterns(
     '',
     url(r'^logs/', SavedSearchViewSet.as_view(
-        {'get': 'results'}), {'uuid': '55b19303-4fd2-4216-95cb-75a4f39b763c'}),
+        {'get': 'results'}), {'uuid': SHORTCUT_SEARCHES['logs']}),
     url(r'^api-calls/', SavedSearchViewSet.as_view(
-        {'get': 'results'}), {'uuid': '18936ecd-11f5-413c-9e70-fc9a7dd037e3'}),
+        {'get': 'results'}), {'uuid': SHORTCUT_SEARCHES['api-calls']}),
     url(r'^events/', SavedSearchViewSet.as_view(
-        {'get': 'results'}), {'uuid': '7906893c-16dc-4ab3-96e0-8f0054bd4cc1'}),
+        {'get': 'results'}), {'uuid': SHORTCUT_SEARCHES['events']}),
     url(r'^metrics/', SavedSearchViewSet.as_view(
-        {'get': 'results'}), {'uuid': 'a3f34f00-967b-40a2-913e-ba10afdd611b'}),
+        {'get': 'results'}), {'uuid': SHORTCUT_SEARCHES['metrics']}),
     url(r'^canary/', SavedSearchViewSet.as_view(
-        {'get': 'results'}), {'uuid': '139851f2-1329-4826-9c70-c154a6c102f2'}),
+        {'get': 'results'}), {'uuid': SHORTCUT_SEARCHES['canary']}),
     url(r'^hypervisor/spawns/', SavedSearchViewSet.as_view(
-        {'get': 'results'}), {'uuid': '21f5c6db-5a2e-41d4-9462-c3cdc03a837b'})
+        {'get': 'results'}), {'uuid': SHORTCUT_SEARCHES['hypervisor/spawns']}),
+    url(r'^es-pool-stats/', ElasticsearchPoolStatsView.as_view()),
+    url(r'^agg-cache-stats/', AggregationCacheStatsView.as_view()),
 )
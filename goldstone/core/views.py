@@ -15,44 +15,54 @@
 import logging
 
 from django.conf import settings
+from django.http import FileResponse, StreamingHttpResponse
 from rest_framework import filters
 import django_filters
 from rest_framework.decorators import detail_route
-from rest_framework.exceptions import MethodNotAllowed
+from rest_framework.exceptions import MethodNotAllowed, ValidationError
 from rest_framework.generics import RetrieveAPIView, ListAPIView
+from rest_framework.mixins import CreateModelMixin, DestroyModelMixin
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.status import HTTP_400_BAD_REQUEST
+from rest_framework.response import Response
+from rest_framework.status import HTTP_409_CONFLICT
+from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 from goldstone.core.models import SavedSearch, Alert, AlertDefinition, \
-    Producer, EmailProducer, MonitoredService
+    Producer, EmailProducer, MonitoredService, ExportJob
+from goldstone.core.refresh import refresh_ahead
 from goldstone.core.serializers import SavedSearchSerializer, \
     AlertDefinitionSerializer, AlertSerializer, ProducerSerializer, \
-    EmailProducerSerializer, MonitoredServiceSerializer
+    EmailProducerSerializer, MonitoredServiceSerializer, ExportJobSerializer
 from goldstone.drfes.filters import ElasticFilter
+from goldstone.drfes.pagination import ElasticCursorPagination, \
+    ElasticPageNumberPagination
+from goldstone.drfes.rollup import rollups
 from goldstone.drfes.serializers import ElasticResponseSerializer
+from goldstone.models import es_route_search, es_conn_stats
 
 
 ##################
 # Saved Search   #
 ##################
 
+# The content types of the export formats.
+EXPORT_CONTENT_TYPES = {'ndjson': 'application/x-ndjson',
+                        'csv': 'text/csv'}
+
 
 class SavedSearchFilter(ElasticFilter):
 
     @staticmethod
-    def _add_query(param, value, view, queryset, operation='match'):
-        """Return a query, preferring the raw field if available.
+    def _field(field, view):
+        """Return the field to search.  Saved searches' fields are used as
+        they are.
 
-        :param param: the field name in ES
-        :param value: the field value
+        :param field: the field name in ES
         :param view: the calling view
-        :param queryset: the base queryset
-        :param operation: the query operation
-        :return: the update Search object
-        :rtype Search
+        :rtype: str
 
         """
-        return queryset.query(operation, **{param: value})
+        return field
 
 
 # N.B. Goldstone's swagger-ui API documentation uses the docstrings to populate
@@ -67,6 +77,10 @@ class SavedSearchViewSet(ModelViewSet):
     # Tell DRF that the lookup field is this string, and not "pk".
     lookup_field = "uuid"
 
+    # The results' time range, if the request has one.
+    start = None
+    end = None
+
     filter_fields = ('owner', 'name', 'protected', 'index_prefix', 'doc_type')
     search_fields = ('owner', 'name', 'protected', 'index_prefix', 'doc_type')
     ordering_fields = ('owner', 'name', 'protected', 'index_prefix',
@@ -76,28 +90,39 @@ class SavedSearchViewSet(ModelViewSet):
     def get_queryset(self):
         return self.query_model.objects.filter(hidden=False)
 
-    @detail_route()
-    def results(self, request, uuid=None):       # pylint: disable=W0613,R0201
-        """Return a defined search's results."""
-        from goldstone.drfes.pagination import ElasticPageNumberPagination
-        from ast import literal_eval
+    def _results_search(self, request, obj):
+        """Return the search for a defined search's results, with the request's
+        filtering, ordering, interval, and time range applied.
 
-        # Get the model for the requested uuid
-        obj = self.query_model.objects.get(uuid=uuid)
+        :param request: The HTTP request
+        :type request: Request
+        :param obj: The defined search
+        :type obj: SavedSearch
+        :rtype: Search
+
+        """
+        from ast import literal_eval
 
         # To use as much Goldstone code as possible, we now override the class
         # to create a "drfes environment" for filtering, pagination, and
         # serialization. We then create an elasticsearch_dsl Search object from
         # the Elasticsearch query. DailyIndexDocType uses a "logstash-" index
         # prefix.
-        self.pagination_class = ElasticPageNumberPagination
+        # A cursor parameter selects cursor pagination, for deep paging.
+        self.cursor_pagination_class = (  # pylint: disable=W0201
+            ElasticCursorPagination)
+        self.pagination_class = ElasticCursorPagination \
+            if ElasticCursorPagination.cursor_query_param in \
+            request.query_params else ElasticPageNumberPagination
         self.serializer_class = ElasticResponseSerializer
         self.filter_backends = (SavedSearchFilter, )
 
         # Tell ElasticFilter to not add these query parameters to the
         # Elasticsearch query.
         self.reserved_params = ['interval',  # pylint: disable=W0201
-                                'ordering']
+                                'ordering',
+                                'fields',
+                                'output']
 
         queryset = obj.search()
         queryset = self.filter_queryset(queryset)
@@ -105,7 +130,7 @@ class SavedSearchViewSet(ModelViewSet):
         # Default to descending sort on the timestamp_field if no ordering
         # param is provided in the query.
         if obj.timestamp_field is not None \
-                and 'ordering' not in self.request.query_params:
+                and 'ordering' not in request.query_params:
             queryset = queryset.sort("-%s" % obj.timestamp_field)
 
         # otherwise use any provided ordering parameter (only supports
@@ -113,8 +138,8 @@ class SavedSearchViewSet(ModelViewSet):
         # a raw field if it has one.  If it doesn't, and it's a string, this
         # will probably fail.  It may also fail for events since they don't
         # have a common doc_type.
-        elif 'ordering' in self.request.query_params:
-            ordering_value = self.request.query_params['ordering']
+        elif 'ordering' in request.query_params:
+            ordering_value = request.query_params['ordering']
             if ordering_value.startswith("-"):
                 has_raw = obj.field_has_raw(ordering_value[1:])
             else:
@@ -128,18 +153,21 @@ class SavedSearchViewSet(ModelViewSet):
         # if an interval parameter was provided, assume that it is meant to
         # be a change to the saved search date_histogram aggregation interval
         # if present.
-        if 'interval' in self.request.query_params:
+        if 'interval' in request.query_params:
             try:
                 queryset.aggs.aggs['per_interval'].interval = \
-                    self.request.query_params['interval']
+                    request.query_params['interval']
             except:
-                return HTTP_400_BAD_REQUEST("interval parameter not supported "
-                                            "for this request")
+                raise ValidationError("interval parameter not supported for "
+                                      "this request")
 
         # if there is a timestamp range parameter supplied, we'll construct
         # an extended_bounds.min parameter from the gt/gte parameter and add
         # it to the date_histogram aggregation. this will ensure that the
         # buckets go back to the start time.
+        #
+        # the range also lets us limit the search to the daily indices that
+        # overlap it.
         time_range_param = obj.timestamp_field + "__range"
         if time_range_param in request.query_params:
             json = literal_eval(request.query_params[time_range_param])
@@ -152,11 +180,87 @@ class SavedSearchViewSet(ModelViewSet):
                     'min': json['gte']
                 }
 
+            self.start = json.get('gte', json.get('gt'))
+            self.end = json.get('lte', json.get('lt'))
+            queryset = es_route_search(queryset,
+                                       obj.index_prefix,
+                                       self.start,
+                                       self.end)
+
+        return queryset
+
+    @detail_route()
+    def results(self, request, uuid=None):       # pylint: disable=W0613,R0201
+        """Return a defined search's results."""
+
+        # The dashboards' default views are kept precomputed.
+        stored = refresh_ahead.lookup(request, uuid)
+        if stored is not None:
+            return Response(stored)
+
+        return self.get_paginated_response(self.results_page(request, uuid))
+
+    def results_page(self, request, uuid):
+        """Return the serialized page of a defined search's results.
+
+        This leaves the page in self.paginator, for the pagination links.
+
+        """
+
+        # Get the model for the requested uuid
+        obj = self.query_model.objects.get(uuid=uuid)
+        queryset = self._results_search(request, obj)
+
+        # Coarse date histograms are answered from rollups where there are
+        # any.  Cursor pages add their own count aggregation, so they aren't.
+        plan = None
+        if self.pagination_class is not ElasticCursorPagination:
+            plan = rollups.plan(queryset, self.start, self.end)
+            if plan is not None:
+                queryset = plan.raw_search
+
         # Perform the search and paginate the response.
         page = self.paginate_queryset(queryset)
+        if plan is not None:
+            page = plan.merge(page)
 
         serializer = self.get_serializer(page)
-        return self.get_paginated_response(serializer.data)
+        return serializer.data
+
+    @detail_route()
+    def export(self, request, uuid=None):        # pylint: disable=W0613
+        """Stream all of a defined search's results.
+
+        The results are filtered like the results route's, and scrolled out
+        of ES as they're written, so an export of any size uses constant
+        memory.  The output parameter selects "ndjson" (the default) or "csv",
+        and the fields parameter is a comma-separated list of the fields to
+        export.  By default, NDJSON has all the fields, and CSV has the
+        fields of the first result.
+        """
+        from goldstone.drfes.export import csv_lines, ndjson_lines, \
+            scan_sources
+
+        output = request.query_params.get('output', 'ndjson')
+        if output not in EXPORT_CONTENT_TYPES:
+            raise ValidationError("output must be one of %s."
+                                  % ", ".join(sorted(EXPORT_CONTENT_TYPES)))
+
+        fields = [f.strip()
+                  for f in request.query_params.get('fields', '').split(',')
+                  if f.strip()] or None
+
+        obj = self.query_model.objects.get(uuid=uuid)
+        sources = scan_sources(self._results_search(request, obj), fields)
+
+        lines = csv_lines(sources, fields) if output == 'csv' \
+            else ndjson_lines(sources)
+
+        response = StreamingHttpResponse(
+            lines, content_type=EXPORT_CONTENT_TYPES[output])
+        response['Content-Disposition'] = \
+            'attachment; filename="%s.%s"' % (obj.uuid, output)
+        return response
 
     def update(self, request, *args, **kwargs):
         """override PATCH methods to not allow updates to
@@ -267,3 +371,79 @@ class MonitoredServiceViewSet(ModelViewSet):
 
     def get_queryset(self):
         return self.query_model.objects.all()
+
+
+class ExportJobViewSet(CreateModelMixin, DestroyModelMixin,
+                       ReadOnlyModelViewSet):
+    """Provide the /core/export_job/ endpoints.
+
+    POST a search, start, end, and optional fields to start a job, GET a job
+    to follow its state, and GET its download route when it's DONE.
+
+    """
+
+    permission_classes = (IsAuthenticated,)
+    serializer_class = ExportJobSerializer
+    query_model = ExportJob
+
+    # Tell DRF that the lookup field is this string, and not "pk".
+    lookup_field = "uuid"
+
+    filter_fields = ('search', 'state')
+    ordering_fields = ('created', 'updated', 'state', 'start', 'end')
+
+    def get_queryset(self):
+        return self.query_model.objects.all()
+
+    def perform_create(self, serializer):
+        from goldstone.core.tasks import run_export_job
+
+        job = serializer.save()
+        run_export_job.delay(job.uuid)
+
+    @detail_route()
+    def download(self, request, uuid=None):      # pylint: disable=W0613
+        """Return a finished job's zip file."""
+
+        job = self.get_object()
+
+        if job.state != ExportJob.DONE:
+            return Response({'detail': "The export is %s." % job.state},
+                            status=HTTP_409_CONFLICT)
+
+        response = FileResponse(open(job.path, 'rb'),
+                                content_type='application/zip')
+        response['Content-Disposition'] = \
+            'attachment; filename="%s.zip"' % job.uuid
+        return response
+
+
+class ElasticsearchPoolStatsView(APIView):
+    """Provide the /core/es-pool-stats/ endpoint.
+
+    Reports Elasticsearch connection pool utilization for the worker process
+    that serves the request.
+    """
+
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):             # pylint: disable=W0613,R0201
+        """Return the pool statistics."""
+
+        return Response(es_conn_stats())
+
+
+class AggregationCacheStatsView(APIView):
+    """Provide the /core/agg-cache-stats/ endpoint.
+
+    Reports the aggregation result cache's hit and miss counters, overall and
+    per index family, and its number of entries.
+    """
+
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):             # pylint: disable=W0613,R0201
+        """Return the cache statistics."""
+        from goldstone.drfes.cache import agg_cache
+
+        return Response(agg_cache.stats())
@@ -0,0 +1,326 @@
+"""DRFES bulk indexing."""
+# Copyright 2016 Solinea, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+from django.conf import settings
+from elasticsearch import ConnectionError, TransportError
+from elasticsearch.serializer import JSONSerializer
+
+logger = logging.getLogger(__name__)
+
+# Per-item and per-request statuses that are worth retrying.
+RETRY_STATUSES = (429, 503)
+
+
+class BulkWriter(object):
+    """Buffers documents and writes them through the _bulk endpoint.
+
+    Documents are grouped by target index, and each index's documents go out
+    in one _bulk request.  The buffer is flushed when it holds max_docs
+    documents or max_bytes bytes, when the oldest buffered document is older
+    than max_age seconds, and when the writer is used as a context manager
+    and the block exits.  The age is checked when a document is added and
+    by flush_if_due(), which a writer that lives across idle periods must
+    call periodically; otherwise, call flush() when done adding.
+
+    Items that ES rejects with a retryable status (e.g., a full bulk queue)
+    are resent with an exponential backoff, up to max_retries times.  Other
+    failures are logged and returned from flush().  When a request fails, the
+    documents it didn't write stay buffered for the next flush, and the error
+    is raised.
+
+    Usage::
+
+        with BulkWriter() as writer:
+            for doc in docs:
+                writer.add(daily_index('goldstone_metrics-'), 'core_metric',
+                           doc)
+
+    """
+
+    def __init__(self, conn=None, max_docs=None, max_bytes=None, max_age=None,
+                 max_retries=None):
+        """Initialize the writer.
+
+        :param conn: The ES client.  If None, es_conn() is used
+        :type conn: Elasticsearch
+        :param max_docs: Flush when this many documents are buffered
+        :type max_docs: int
+        :param max_bytes: Flush when the buffered documents reach this size
+        :type max_bytes: int
+        :param max_age: Flush when the oldest buffered document is this many
+                        seconds old
+        :type max_age: float
+        :param max_retries: The number of times a retryable item is resent
+        :type max_retries: int
+
+        """
+        from goldstone.models import es_conn
+
+        def _default(value, setting):
+            return getattr(settings, setting) if value is None else value
+
+        self.conn = conn if conn is not None else es_conn()
+        self.max_docs = _default(max_docs, 'ES_BULK_MAX_DOCS')
+        self.max_bytes = _default(max_bytes, 'ES_BULK_MAX_BYTES')
+        self.max_age = _default(max_age, 'ES_BULK_MAX_AGE')
+        self.max_retries = _default(max_retries, 'ES_BULK_MAX_RETRIES')
+        self.backoff = settings.ES_BULK_RETRY_BACKOFF
+
+        self._serializer = JSONSerializer()
+        self._lock = threading.RLock()
+        self._buffer = OrderedDict()
+        self._docs = 0
+        self._bytes = 0
+        self._oldest = None
+
+        # Running totals over the writer's lifetime.
+        self.indexed = 0
+        self.failed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def __len__(self):
+        return self._docs
+
+    def add(self, index, doc_type, doc, doc_id=None, op_type='index'):
+        """Buffer a document, and flush if a threshold has been reached.
+
+        :param index: The target index
+        :type index: str
+        :param doc_type: The document type
+        :type doc_type: str
+        :param doc: The document body
+        :type doc: dict
+        :param doc_id: The document id.  If None, ES assigns one
+        :type doc_id: str
+        :param op_type: 'index' or 'create'
+        :type op_type: str
+
+        """
+
+        action = {'_type': doc_type}
+        if doc_id is not None:
+            action['_id'] = doc_id
+
+        size = len(self._serializer.dumps(doc)) + 1
+
+        buffered = None
+
+        with self._lock:
+            self._buffer.setdefault(index, []).append(
+                ({op_type: action}, doc))
+            self._docs += 1
+            self._bytes += size
+            if self._oldest is None:
+                self._oldest = time.time()
+
+            if self._docs >= self.max_docs or \
+                    self._bytes >= self.max_bytes or self._due():
+                buffered = self._take()
+
+        # Other threads can keep adding documents while these are sent.
+        if buffered is not None:
+            self._write(*buffered)
+
+    def _due(self):
+        """Return True if the oldest buffered document is at least max_age
+        seconds old.  The caller must hold the lock."""
+
+        return self._oldest is not None and \
+            time.time() - self._oldest >= self.max_age
+
+    def flush_if_due(self):
+        """Flush if the oldest buffered document is at least max_age seconds
+        old.
+
+        :return: What flush() returns, or None if nothing was due
+        :rtype: tuple
+
+        """
+
+        with self._lock:
+            if not self._due():
+                return None
+            buffered = self._take()
+
+        return self._write(*buffered)
+
+    def flush(self):
+        """Write all the buffered documents.
+
+        If a request fails, the documents that weren't sent are put back in
+        the buffer, and the error is raised.
+
+        :return: The number of documents written, and the failed items as
+                 returned by ES
+        :rtype: tuple
+
+        """
+
+        with self._lock:
+            buffered = self._take()
+
+        return self._write(*buffered)
+
+    def _take(self):
+        """Empty the buffer.  The caller must hold the lock.
+
+        :return: The buffered documents by index, and the time the oldest one
+                 was added
+        :rtype: tuple
+
+        """
+
+        buffered = (self._buffer, self._oldest)
+
+        self._buffer = OrderedDict()
+        self._docs = 0
+        self._bytes = 0
+        self._oldest = None
+
+        return buffered
+
+    def _requeue(self, unsent, oldest):
+        """Put unsent documents back at the front of the buffer.
+
+        :param unsent: (action, document) pairs by index
+        :type unsent: OrderedDict
+        :param oldest: The time the oldest of them was added
+        :type oldest: float
+
+        """
+
+        with self._lock:
+            buffer = OrderedDict()
+            for index, items in unsent.items():
+                buffer[index] = list(items)
+            for index, items in self._buffer.items():
+                buffer.setdefault(index, []).extend(items)
+
+            for items in unsent.values():
+                self._docs += len(items)
+                self._bytes += sum(len(self._serializer.dumps(doc)) + 1
+                                   for _, doc in items)
+
+            self._buffer = buffer
+            if oldest is not None:
+                self._oldest = min(oldest, self._oldest or oldest)
+
+    def _write(self, buffered, oldest):
+        """Send documents taken from the buffer.
+
+        :param buffered: (action, document) pairs by index
+        :type buffered: OrderedDict
+        :param oldest: The time the oldest of them was added
+        :type oldest: float
+        :return: The number of documents written, and the failed items
+        :rtype: tuple
+
+        """
+
+        progress = {'indexed': 0, 'failures': [], 'unsent': []}
+        indices = buffered.keys()
+
+        try:
+            for position, index in enumerate(indices):
+                try:
+                    self._send(index, buffered[index], progress)
+                except Exception:
+                    unsent = OrderedDict()
+                    if progress['unsent']:
+                        unsent[index] = progress['unsent']
+                    for later in indices[position + 1:]:
+                        unsent[later] = buffered[later]
+                    self._requeue(unsent, oldest)
+                    raise
+        finally:
+            self.indexed += progress['indexed']
+            self.failed += len(progress['failures'])
+
+        indexed, failures = progress['indexed'], progress['failures']
+
+        if failures:
+            logger.error("%d of %d bulk items failed; first failure: %s",
+                         len(failures), indexed + len(failures), failures[0])
+
+        return indexed, failures
+
+    def _send(self, index, items, progress):
+        """Send one index's items, retrying the retryable ones.
+
+        :param index: The target index
+        :type index: str
+        :param items: (action, document) pairs
+        :type items: list
+        :param progress: Updated as the items go out: the number of documents
+                         written ('indexed'), the failed items ('failures'),
+                         and the items not yet accepted or failed ('unsent')
+        :type progress: dict
+
+        """
+
+        attempt = 0
+
+        while items:
+            progress['unsent'] = items
+
+            body = []
+            for action, doc in items:
+                body.extend([action, doc])
+
+            try:
+                response = self.conn.bulk(body, index=index)
+            except TransportError as exc:
+                if not isinstance(exc, ConnectionError) and \
+                        exc.status_code not in RETRY_STATUSES:
+                    raise
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning("Bulk request to %s failed (%s), retrying",
+                               index, exc)
+                attempt = self._backoff(attempt)
+                continue
+
+            retry = []
+            for (action, doc), item in zip(items, response['items']):
+                result = item.values()[0]
+                status = result.get('status', 200)
+
+                if status < 300:
+                    progress['indexed'] += 1
+                elif status in RETRY_STATUSES and \
+                        attempt < self.max_retries:
+                    retry.append((action, doc))
+                else:
+                    progress['failures'].append(result)
+
+            items = retry
+            progress['unsent'] = items
+            if items:
+                attempt = self._backoff(attempt)
+
+    def _backoff(self, attempt):
+        """Sleep before the next retry and return the next attempt number."""
+
+        time.sleep(self.backoff * (2 ** attempt))
+        return attempt + 1
@@ -0,0 +1,347 @@
+"""DRFES aggregation result cache."""
+# Copyright 2016 Solinea, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import json
+import logging
+import time
+
+from django.conf import settings
+from elasticsearch_dsl.result import Response
+import redis
+
+logger = logging.getLogger(__name__)
+
+# The keys of range bounds that are aligned before hashing.
+RANGE_BOUNDS = ('gt', 'gte', 'lt', 'lte', 'from', 'to', 'min', 'max')
+
+
+class AggregationCache(object):
+    """A Redis cache of aggregation search results, shared by all processes.
+
+    A result is keyed by a hash of its search's body, indices, doc types, and
+    parameters.  Time range bounds in the body (range queries and filters on
+    time fields, and date_histogram extended_bounds) are aligned down to
+    AGG_CACHE_ALIGNMENT seconds before hashing.  That lets dashboards that
+    refresh with "now" as the end of their range share entries.
+
+    Entries live for the TTL of their index family (AGG_CACHE_TTLS, keyed by
+    index prefix, or AGG_CACHE_DEFAULT_TTL).  At most AGG_CACHE_MAX_ENTRIES
+    are kept, and the oldest are evicted first.  Hits and misses are counted
+    overall and per family.
+
+    Searches without aggregations, and Redis errors, bypass the cache.
+    Searches that aren't answered from the cache are executed through
+    single_flight, so identical concurrent ones reach ES once.
+
+    """
+
+    KEY_PREFIX = 'goldstone:agg_cache:'
+    ENTRIES_KEY = 'goldstone:agg_cache_entries'
+    STATS_KEY = 'goldstone:agg_cache_stats'
+
+    @staticmethod
+    def _redis():
+        """Return a Redis client."""
+        from goldstone.models import RedisConnection
+
+        return RedisConnection().conn
+
+    @staticmethod
+    def _align(value, alignment):
+        """Return a time bound aligned down to alignment seconds, or the
+        value unchanged if it isn't a fixed time.
+
+        Times are ISO 8601 strings or epoch milliseconds.
+
+        """
+        import arrow
+
+        if isinstance(value, basestring) and value.isdigit():
+            value = int(value)
+
+        try:
+            if isinstance(value, (int, long, float)) and \
+                    not isinstance(value, bool):
+                bound = arrow.get(value / 1000.0)
+            elif isinstance(value, basestring) and 'now' not in value:
+                bound = arrow.get(value)
+            else:
+                return value
+        except Exception:         # pylint: disable=W0703
+            return value
+
+        return bound.timestamp - bound.timestamp % alignment
+
+    @classmethod
+    def time_fields(cls, body):
+        """Return the time fields of a search body: AGG_CACHE_TIME_FIELDS,
+        and the fields of its date_histogram aggregations.
+
+        :param body: A search body
+        :type body: dict
+        :rtype: set
+
+        """
+
+        fields = set(settings.AGG_CACHE_TIME_FIELDS)
+
+        if isinstance(body, list):
+            for item in body:
+                fields |= cls.time_fields(item)
+        elif isinstance(body, dict):
+            for key, value in body.items():
+                if key == 'date_histogram' and isinstance(value, dict) and \
+                        'field' in value:
+                    fields.add(value['field'])
+                fields |= cls.time_fields(value)
+
+        return fields
+
+    @classmethod
+    def normalize(cls, body, alignment=None, time_fields=None):
+        """Return a search body with its time range bounds aligned.
+
+        Only the bounds of range clauses on time fields, and the
+        extended_bounds of date_histograms, are aligned; ranges on other
+        fields are kept as they are.
+
+        :param body: A search body, or part of one
+        :type body: dict
+        :param alignment: The alignment in seconds.  If None,
+                          AGG_CACHE_ALIGNMENT
+        :type alignment: int
+        :param time_fields: The time fields.  If None, the body's
+                            time_fields()
+        :type time_fields: set
+
+        """
+
+        if alignment is None:
+            alignment = settings.AGG_CACHE_ALIGNMENT
+        if time_fields is None:
+            time_fields = cls.time_fields(body)
+
+        if isinstance(body, list):
+            return [cls.normalize(item, alignment, time_fields)
+                    for item in body]
+
+        if not isinstance(body, dict):
+            return body
+
+        normalized = {}
+
+        for key, value in body.items():
+            if alignment and isinstance(value, dict):
+                if key == 'range':
+                    value = dict(
+                        (field, cls._align_bounds(bounds, alignment)
+                         if field in time_fields and
+                         isinstance(bounds, dict) else bounds)
+                        for field, bounds in value.items())
+                elif key == 'date_histogram' and \
+                        isinstance(value.get('extended_bounds'), dict):
+                    value = dict(value, extended_bounds=cls._align_bounds(
+                        value['extended_bounds'], alignment))
+            normalized[key] = cls.normalize(value, alignment, time_fields)
+
+        return normalized
+
+    @classmethod
+    def _align_bounds(cls, bounds, alignment):
+        """Align the bounds ({bound: value}) of a range or of
+        extended_bounds."""
+
+        return dict((bound, cls._align(v, alignment)
+                     if bound in RANGE_BOUNDS else v)
+                    for bound, v in bounds.items())
+
+    @staticmethod
+    def _names(value):
+        """Return a search's index or doc type names as a sorted list."""
+
+        if value is None:
+            return []
+        if isinstance(value, basestring):
+            return [value]
+
+        return sorted(value)
+
+    def key(self, search, body=None):
+        """Return the cache key of a search.
+
+        :param search: The search
+        :type search: Search
+        :param body: The search's body, if it's already been built
+        :type body: dict
+        :rtype: str
+
+        """
+        # pylint: disable=W0212
+
+        normalized = {
+            'body': self.normalize(body or search.to_dict()),
+            'index': self._names(search._index),
+            'doc_type': self._names(search._doc_type),
+            'params': search._params,
+        }
+
+        digest = hashlib.sha1(json.dumps(normalized, sort_keys=True))
+        return self.KEY_PREFIX + digest.hexdigest()
+
+    @staticmethod
+    def family(search):
+        """Return the index family, i.e. the index prefix, of a search."""
+        from goldstone.models import IndexCatalog
+
+        names = AggregationCache._names(search._index)  # pylint: disable=W0212
+        families = set()
+
+        for name in names:
+            prefix = IndexCatalog.index_prefix(name.rstrip('*'))
+            families.add(prefix if prefix is not None else name.rstrip('*'))
+
+        return ','.join(sorted(families)) or '_all'
+
+    @staticmethod
+    def ttl(family):
+        """Return the TTL of a family's entries.  A search of several
+        families gets the shortest of their TTLs."""
+
+        ttls = [settings.AGG_CACHE_TTLS.get(
+            prefix, settings.AGG_CACHE_DEFAULT_TTL)
+            for prefix in family.split(',')]
+
+        return min(ttls)
+
+    def execute(self, search):
+        """Execute a search, through the cache if it has aggregations.
+
+        :param search: The search
+        :type search: Search
+        :rtype: Response
+
+        """
+
+        from goldstone.drfes.flight import single_flight
+
+        body = search.to_dict()
+
+        if not settings.AGG_CACHE_ENABLED or not body.get('aggs'):
+            return single_flight.execute(search, body)
+
+        key = self.key(search, body)
+        family = self.family(search)
+
+        try:
+            conn = self._redis()
+            cached = conn.get(key)
+        except redis.RedisError as exc:
+            logger.warning("aggregation cache unavailable: %s", exc)
+            return single_flight.execute(search, body)
+
+        if cached is not None:
+            self._count(conn, 'hits', family)
+            callbacks = search._doc_type_map     # pylint: disable=W0212
+            return Response(json.loads(cached), callbacks=callbacks)
+
+        self._count(conn, 'misses', family)
+        response = single_flight.execute(search, body)
+
+        if response.success():
+            self._store(conn, key, family, response.to_dict())
+
+        return response
+
+    def _count(self, conn, counter, family):
+        """Increment a counter, overall and for a family."""
+
+        try:
+            pipe = conn.pipeline(transaction=False)
+            pipe.hincrby(self.STATS_KEY, counter, 1)
+            pipe.hincrby(self.STATS_KEY, '%s:%s' % (counter, family), 1)
+            pipe.execute()
+        except redis.RedisError as exc:
+            logger.warning("could not count aggregation cache %s: %s",
+                           counter, exc)
+
+    def _store(self, conn, key, family, result):
+        """Store a result, and evict the oldest entries if there are too
+        many."""
+
+        value = json.dumps(result)
+        if len(value) > settings.AGG_CACHE_MAX_ENTRY_SIZE:
+            return
+
+        now = time.time()
+
+        try:
+            pipe = conn.pipeline(transaction=False)
+            pipe.set(key, value, ex=self.ttl(family))
+            pipe.zadd(self.ENTRIES_KEY, now, key)
+            # Forget entries that have expired by themselves.
+            pipe.zremrangebyscore(self.ENTRIES_KEY, 0,
+                                  now - max(self._ttls()))
+            pipe.zcard(self.ENTRIES_KEY)
+            size = pipe.execute()[-1]
+
+            excess = size - settings.AGG_CACHE_MAX_ENTRIES
+            if excess > 0:
+                evicted = conn.zrange(self.ENTRIES_KEY, 0, excess - 1)
+                if evicted:
+                    pipe = conn.pipeline(transaction=False)
+                    pipe.delete(*evicted)
+                    pipe.zrem(self.ENTRIES_KEY, *evicted)
+                    pipe.execute()
+        except redis.RedisError as exc:
+            logger.warning("could not store aggregation cache entry: %s", exc)
+
+    @staticmethod
+    def _ttls():
+        """Return all the configured TTLs."""
+
+        return list(settings.AGG_CACHE_TTLS.values()) + \
+            [settings.AGG_CACHE_DEFAULT_TTL]
+
+    def stats(self):
+        """Return the hit and miss counters, and the number of entries.
+
+        :rtype: dict
+
+        """
+
+        conn = self._redis()
+        pipe = conn.pipeline(transaction=False)
+        pipe.hgetall(self.STATS_KEY)
+        pipe.zcard(self.ENTRIES_KEY)
+        counters, entries = pipe.execute()
+
+        result = dict((name, int(value)) for name, value in counters.items())
+        result['entries'] = entries
+        return result
+
+    def clear(self):
+        """Drop all the entries, and reset the counters."""
+
+        conn = self._redis()
+        keys = conn.zrange(self.ENTRIES_KEY, 0, -1)
+
+        pipe = conn.pipeline(transaction=False)
+        if keys:
+            pipe.delete(*keys)
+        pipe.delete(self.ENTRIES_KEY, self.STATS_KEY)
+        pipe.execute()
+
+# The process-wide instance.
+agg_cache = AggregationCache()          # pylint: disable=C0103
@@ -0,0 +1,328 @@
+"""DRFES streaming export."""
+# Copyright 2016 Solinea, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import OrderedDict
+import csv
+from itertools import chain
+import json
+import logging
+import os
+import zipfile
+
+from django.conf import settings
+from elasticsearch import TransportError
+from elasticsearch_dsl.connections import connections
+import six
+
+logger = logging.getLogger(__name__)
+
+
+def scan_sources(search, fields=None, size=None, scroll=None):
+    """Yield the _source of every hit of a search, scrolling through it.
+
+    Hits come back in scan order, a page of size hits per shard at a time, and
+    only the current page is held in memory.  Sorts and aggregations are
+    dropped from the search.  The scroll is cleared if the caller stops
+    early, e.g., because the client went away.
+
+    :param search: The search
+    :type search: Search
+    :param fields: The source fields to return.  If None, all are returned
+    :type fields: list of str
+    :param size: The hits per shard per page.  If None, ES_EXPORT_SCROLL_SIZE
+    :type size: int
+    :param scroll: How long to keep the scroll alive between pages.  If None,
+                   ES_EXPORT_SCROLL
+    :type scroll: str
+    :rtype: generator of dict
+
+    """
+    # pylint: disable=W0212
+    conn = connections.get_connection(search._using)
+
+    body = search.to_dict()
+    for key in ['aggs', 'sort', 'from', 'size']:
+        body.pop(key, None)
+    if fields:
+        body['_source'] = fields
+
+    scroll = scroll or settings.ES_EXPORT_SCROLL
+
+    response = conn.search(index=search._index,
+                           doc_type=search._doc_type,
+                           body=body,
+                           search_type='scan',
+                           scroll=scroll,
+                           size=size or settings.ES_EXPORT_SCROLL_SIZE)
+    scroll_id = response.get('_scroll_id')
+
+    try:
+        while scroll_id:
+            response = conn.scroll(scroll_id=scroll_id, scroll=scroll)
+            scroll_id = response.get('_scroll_id')
+
+            hits = response['hits']['hits']
+            if not hits:
+                break
+
+            for hit in hits:
+                yield hit.get('_source', {})
+    finally:
+        if scroll_id:
+            try:
+                conn.clear_scroll(scroll_id=scroll_id)
+            except TransportError as exc:
+                # It will expire anyway.
+                logger.warning("Couldn't clear scroll: %s", exc)
+
+
+def ndjson_lines(sources):
+    """Yield documents as newline-delimited JSON."""
+
+    for source in sources:
+        yield json.dumps(source) + '\n'
+
+
+class _Echo(object):
+    """A file-like object that returns what's written to it, so csv.writer
+    can format one row at a time."""
+
+    def write(self, value):        # pylint: disable=R0201
+        return value
+
+
+def _field_value(source, field):
+    """Return a possibly dotted field's value in a document, or None."""
+
+    value = source
+    for part in field.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+
+    return value
+
+
+def _cell(value):
+    """Return a field value as a CSV cell."""
+
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, six.text_type):
+        return value.encode('utf-8')
+
+    return str(value)
+
+
+def csv_lines(sources, fields=None):
+    """Yield documents as CSV rows, after a header row.
+
+    :param sources: The documents
+    :type sources: iterable of dict
+    :param fields: The columns, which may be dotted field names.  If None,
+                   the first document's top-level fields are used
+    :type fields: list of str
+    :rtype: generator of str
+
+    """
+
+    sources = iter(sources)
+
+    if fields is None:
+        try:
+            first = next(sources)
+        except StopIteration:
+            return
+        fields = sorted(first)
+        sources = chain([first], sources)
+
+    writer = csv.writer(_Echo())
+    yield writer.writerow([_cell(f) for f in fields])
+
+    for source in sources:
+        yield writer.writerow([_cell(_field_value(source, f))
+                               for f in fields])
+
+
+def _flatten(source, prefix=''):
+    """Return a document's leaf values keyed by dotted field name.  Lists are
+    leaf values."""
+
+    values = OrderedDict()
+
+    for key, value in source.items():
+        if isinstance(value, dict):
+            values.update(_flatten(value, prefix + key + '.'))
+        else:
+            values[prefix + key] = value
+
+    return values
+
+
+class ColumnSpool(object):
+    """Spools documents to one file per column under a directory.
+
+    Each column file holds one JSON value per line, one line per document, so
+    the columns of a document are on the same line of every file.  A column
+    that first appears part way through is backfilled with nulls.  Nested
+    fields become dotted columns.
+
+    Values are buffered in memory and appended to the column files, one file
+    open at a time, whenever EXPORT_SPOOL_BUFFER bytes are buffered, so a
+    search with many distinct fields doesn't hold a file open per field.
+
+    """
+
+    def __init__(self, directory, fields=None):
+        """Initialize the spool.
+
+        :param directory: An existing, empty directory for the column files
+        :type directory: str
+        :param fields: The columns, which may be dotted field names.  If
+                       None, every field found is a column
+        :type fields: list of str
+
+        """
+
+        self.directory = directory
+        self.fields = fields
+        self.rows = 0
+        self.columns = OrderedDict()
+        self._buffered = 0
+
+        for field in fields or []:
+            self._column(field)
+
+    def _path(self, index):
+        """Return the path of a column's file."""
+
+        return os.path.join(self.directory, '%d.jsonl' % index)
+
+    def _column(self, name):
+        """Return a column's buffer, creating and backfilling it if
+        needed."""
+
+        if name not in self.columns:
+            with open(self._path(len(self.columns)), 'w') as column:
+                column.write('null\n' * self.rows)
+            self.columns[name] = []
+
+        return self.columns[name]
+
+    def add(self, source):
+        """Add a document as the next row."""
+
+        if self.fields:
+            values = dict((f, _field_value(source, f)) for f in self.fields)
+        else:
+            values = _flatten(source)
+            for name in values:
+                self._column(name)
+
+        for name, column in self.columns.items():
+            line = json.dumps(values.get(name)) + '\n'
+            column.append(line)
+            self._buffered += len(line)
+
+        self.rows += 1
+
+        if self._buffered >= settings.EXPORT_SPOOL_BUFFER:
+            self.flush()
+
+    def flush(self):
+        """Append the buffered values to the column files."""
+
+        for index, column in enumerate(self.columns.values()):
+            if column:
+                with open(self._path(index), 'a') as column_file:
+                    column_file.writelines(column)
+                del column[:]
+
+        self._buffered = 0
+
+    def close(self):
+        """Write out the buffered values."""
+
+        self.flush()
+
+
+def spool_search(search, directory, fields=None):
+    """Scroll a search into a closed ColumnSpool.
+
+    :param search: The search
+    :type search: Search
+    :param directory: An existing, empty directory for the column files
+    :type directory: str
+    :param fields: The columns.  If None, every field found is a column
+    :type fields: list of str
+    :rtype: ColumnSpool
+
+    """
+
+    spool = ColumnSpool(directory, fields)
+
+    try:
+        for source in scan_sources(search, fields):
+            spool.add(source)
+    finally:
+        spool.close()
+
+    return spool
+
+
+def write_columnar(path, parts, manifest=None):
+    """Write spooled parts to a zip file, with a deflated member per column.
+
+    Each part's columns are stored as <part>/<n>.jsonl, numbered in the
+    order they were found, and a manifest.json member lists the parts, their
+    row counts, and their columns' names and members.  A part only has the
+    columns found in its own documents, so a column that another part lists
+    and it doesn't is null in all its rows.
+
+    :param path: The zip file's path
+    :type path: str
+    :param parts: (name, ColumnSpool) pairs
+    :type parts: list
+    :param manifest: Extra manifest entries
+    :type manifest: dict
+    :return: The total number of rows
+    :rtype: int
+
+    """
+
+    manifest = dict(manifest or {})
+    manifest['parts'] = []
+    rows = 0
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as archive:
+        for name, spool in parts:
+            columns = []
+            for i, column in enumerate(spool.columns):
+                member = '%s/%d.jsonl' % (name, i)
+                archive.write(os.path.join(spool.directory, '%d.jsonl' % i),
+                              member)
+                columns.append({'name': column, 'member': member})
+
+            manifest['parts'].append({'name': name,
+                                      'rows': spool.rows,
+                                      'columns': columns})
+            rows += spool.rows
+
+        manifest['rows'] = rows
+        archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+
+    return rows
@@ -12,36 +12,57 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from collections import namedtuple
+
+from django.db.models.constants import LOOKUP_SEP
+from rest_framework.exceptions import ValidationError
 from rest_framework.filters import BaseFilterBackend
 
+# Operations that are ES filters, and are used as they are.
+FILTER_OPERATIONS = ('term', 'terms', 'range', 'regexp', 'prefix')
+
+# Operations that are only ES queries.  They're wrapped in fquery filters,
+# which ES doesn't cache, since their values are usually free text.
+QUERY_OPERATIONS = ('match', 'match_phrase', 'match_phrase_prefix',
+                    'wildcard', 'fuzzy')
+
+# Parameters that are whole operations, whose values are {field: value}
+# dicts.
+BODY_PARAMS = ('regexp', 'terms')
+
+# The first characters of values that may be Python literals.
+LITERAL_STARTS = frozenset('[{(\'"-+.0123456789')
+
+# One condition of a compiled plan.  The field is None for a BODY_PARAMS
+# parameter.
+Clause = namedtuple('Clause', 'param field operation')
+
 
 class ElasticFilter(BaseFilterBackend):
     """A basic query filter for ES query specification.
 
-    Everything will be treated as query enhancements (rather than filters) from
-    an ES perspective.  Conditionals other than AND are not currently
-    supported.
+    The query parameters are compiled into a plan of validated clauses, one
+    per parameter, and the plan is emitted as a single bool filter.  Filters
+    don't score, and ES caches the term and range ones.  Conditionals other
+    than AND are not currently supported.
 
     """
 
     @staticmethod
-    def _add_query(param, value, view, queryset, operation='match'):
-        """Return a query, preferring the raw field if available.
+    def _field(field, view):
+        """Return the field to search, preferring the raw field if available.
 
-        :param param: the field name in ES
-        :param value: the field value
+        :param field: the field name in ES
         :param view: the calling view
-        :param queryset: the base queryset
-        :param operation: the query operation
-        :return: the update Search object
-        :rtype Search
+        :return: the field name, or its raw field's name
+        :rtype: str
 
         """
 
-        if view.Meta.model.field_has_raw(param):
-            param += ".raw"
+        if view.Meta.model.field_has_raw(field):
+            field += ".raw"
 
-        return queryset.query(operation, **{param: value})
+        return field
 
     @staticmethod
     def _coerce_value(value):
@@ -54,22 +75,104 @@ class ElasticFilter(BaseFilterBackend):
         """
         import ast
 
+        # Most values are plain strings, which needn't be parsed.
+        if not isinstance(value, basestring) or not value or \
+                (value[0] not in LITERAL_STARTS and
+                 value not in ('True', 'False', 'None')):
+            return value
+
         try:
             return ast.literal_eval(value)
 
         except (ValueError, SyntaxError):
             return value
 
-    def filter_queryset(self, request, queryset, view):
-        """Return the queryset enhanced with additional specificity, as
-        determined by the request's query parameters.
+    @staticmethod
+    def _compile_param(param):
+        """Return the clause of a query parameter.
 
-        The returned queryset is effectively an AND of the conditions.
+        :param param: The query parameter's name
+        :type param: str
+        :rtype: Clause
+        :raises: ValidationError
+
+        """
+
+        split_param = param.split(LOOKUP_SEP)
+
+        if len(split_param) == 1:
+            if param in BODY_PARAMS:
+                return Clause(param, None, param)
+
+            # This is a field = value term.
+            return Clause(param, param, 'match')
+
+        # First term is the field, second term is the query operation.
+        if len(split_param) > 2 or not split_param[0] or \
+                split_param[1] not in FILTER_OPERATIONS + QUERY_OPERATIONS:
+            raise ValidationError("unsupported query parameter %s" % param)
+
+        return Clause(param, split_param[0], split_param[1])
+
+    @classmethod
+    def compile(cls, params):
+        """Return the plan of a set of query parameters.
+
+        :param params: The names of the query parameters
+        :type params: list of str
+        :return: The clauses, sorted by parameter, so the same parameters
+                 always give the same filter
+        :rtype: tuple of Clause
+        :raises: ValidationError
+
+        """
+
+        return tuple(cls._compile_param(param) for param in sorted(params))
+
+    def _emit(self, clause, value, view):
+        """Return the filter of a clause, given its parameter's value.
 
         For "<term> = <value>" parameters, the value is lowercased if term is a
         kind of regular expression parameter. E.g., _all__regexp. Note,
         lowercasing isn't done for "'regexp': <dict>" parameters.
 
+        :raises: ValidationError
+
+        """
+
+        if clause.field is None:
+            # The terms and regexp "fields" have a value of a dict of
+            # field:value terms.
+            if not isinstance(value, dict):
+                raise ValidationError("%s must be a dict" % clause.param)
+            return {clause.operation: value}
+
+        if clause.operation == 'range' and not isinstance(value, dict):
+            raise ValidationError("%s must be a dict" % clause.param)
+        if clause.operation == 'terms' and \
+                not isinstance(value, (list, tuple)):
+            raise ValidationError("%s must be a list" % clause.param)
+
+        if clause.operation == 'regexp':
+            if not isinstance(value, basestring):
+                raise ValidationError("%s must be a string" % clause.param)
+            value = value.lower()
+
+        field = self._field(clause.field, view)
+
+        if clause.operation == 'match' and field != clause.field:
+            # A match of a raw field is a match of its one term.
+            return {'term': {field: value}}
+        if clause.operation in QUERY_OPERATIONS:
+            return {'fquery': {'query': {clause.operation: {field: value}}}}
+
+        return {clause.operation: {field: value}}
+
+    def filter_queryset(self, request, queryset, view):
+        """Return the queryset enhanced with additional specificity, as
+        determined by the request's query parameters.
+
+        The returned queryset is effectively an AND of the conditions.
 
         :param request: The HTTP request
         :type request: Request
@@ -77,46 +180,31 @@ class ElasticFilter(BaseFilterBackend):
         :type queryset: Search
         :param view: The view
         :type view: callable
-        :return: The base queryset enhanced with additional queries
+        :return: The base queryset enhanced with a filter
         :rtype: Search
 
         """
-        from django.db.models.constants import LOOKUP_SEP
-
-        reserved_params = view.reserved_params + \
-            [view.pagination_class.page_query_param,
-             view.pagination_class.page_size_query_param]
-
-        for param in request.query_params:
-            # We don't want these in our queryset.
-            if param in reserved_params:
-                continue
-
-            value = self._coerce_value(request.query_params.get(param))
-            split_param = param.split(LOOKUP_SEP)
-
-            if len(split_param) == 1:
-                # This is a field = value term.
-                if split_param[0] in ["regexp", "terms"]:
-                    # The terms and regexp "fields" have a value of a dict of
-                    # field:value terms.
-                    queryset = queryset.query(split_param[0], **value)
-                else:
-                    # This is a standard match query.
-                    queryset = self._add_query(param, value, view, queryset)
-            else:
-                # First term is the field, second term is the query operation.
-                param = split_param[0]
-                operation = split_param[1]
-
-                # Lowercase the value if it's a regular expression.
-                if operation == "regexp":
-                    value = value.lower()      # pylint: disable=E1101
-
-                queryset = self._add_query(param,
-                                           value,
-                                           view,
-                                           queryset,
-                                           operation)
-
-        return queryset
+
+        # Leave out the parameters of either kind of pagination.
+        reserved_params = list(view.reserved_params)
+        for paginator in [view.pagination_class,
+                          getattr(view, 'cursor_pagination_class', None)]:
+            for attr in ['page_query_param', 'page_size_query_param',
+                         'cursor_query_param']:
+                param = getattr(paginator, attr, None)
+                if param is not None:
+                    reserved_params.append(param)
+
+        # We don't want these in our queryset.
+        plan = self.compile([param for param in request.query_params
+                             if param not in reserved_params])
+        if not plan:
+            return queryset
+
+        clauses = [self._emit(clause,
+                              self._coerce_value(
+                                  request.query_params.get(clause.param)),
+                              view)
+                   for clause in plan]
+
+        return queryset.filter('bool', must=clauses)
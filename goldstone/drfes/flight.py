@@ -0,0 +1,171 @@
+"""DRFES coalescing of identical in-flight searches."""
+# Copyright 2016 Solinea, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import json
+import logging
+import time
+import uuid
+
+from django.conf import settings
+from elasticsearch_dsl.result import Response
+import redis
+
+from goldstone.drfes.cache import AggregationCache
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight(object):
+    """Runs at most one of a set of identical concurrent searches, across all
+    processes.
+
+    Searches are identical if their bodies, with time range bounds aligned
+    to SINGLE_FLIGHT_ALIGNMENT seconds, indices, doc types, and parameters
+    are.  The first one takes a Redis lease on its key, executes, and
+    publishes its result under the lease's token.  An identical search that
+    arrives while the lease is held polls for that result every
+    SINGLE_FLIGHT_POLL_INTERVAL seconds and returns it.  The lease expires
+    after SINGLE_FLIGHT_LEASE seconds, so a crashed leader doesn't block
+    later searches for longer than that.
+
+    Followers run in request workers, so one only waits SINGLE_FLIGHT_MAX_WAIT
+    seconds.  A follower whose leader failed, or that waited that long, and
+    all searches when Redis is unavailable, execute by themselves.
+
+    """
+
+    KEY_PREFIX = 'goldstone:single_flight:'
+
+    @staticmethod
+    def _redis():
+        """Return a Redis client."""
+        from goldstone.models import RedisConnection
+
+        return RedisConnection().conn
+
+    @staticmethod
+    def key(search, body=None):
+        """Return the lease key of a search.
+
+        :param search: The search
+        :type search: Search
+        :param body: The search's body, if it's already been built
+        :type body: dict
+        :rtype: str
+
+        """
+        # pylint: disable=W0212
+
+        normalized = {
+            'body': AggregationCache.normalize(
+                body or search.to_dict(), settings.SINGLE_FLIGHT_ALIGNMENT),
+            'index': AggregationCache._names(search._index),
+            'doc_type': AggregationCache._names(search._doc_type),
+            'params': search._params,
+        }
+
+        digest = hashlib.sha1(json.dumps(normalized, sort_keys=True))
+        return SingleFlight.KEY_PREFIX + digest.hexdigest()
+
+    def execute(self, search, body=None):
+        """Execute a search, or wait for an identical one that's in flight.
+
+        :param search: The search
+        :type search: Search
+        :param body: The search's body, if it's already been built
+        :type body: dict
+        :rtype: Response
+
+        """
+
+        if not settings.SINGLE_FLIGHT_ENABLED:
+            return search.execute()
+
+        key = self.key(search, body)
+        token = uuid.uuid4().hex
+
+        try:
+            conn = self._redis()
+            leader = conn.set(key, token, nx=True,
+                              ex=settings.SINGLE_FLIGHT_LEASE)
+            if not leader:
+                token = conn.get(key)
+        except redis.RedisError as exc:
+            logger.warning("single-flight lease unavailable: %s", exc)
+            return search.execute()
+
+        if leader:
+            return self._lead(conn, search, key, token)
+
+        if token is not None:
+            result = self._follow(conn, key, token)
+            if result is not None:
+                callbacks = search._doc_type_map     # pylint: disable=W0212
+                return Response(result, callbacks=callbacks)
+
+        return search.execute()
+
+    @staticmethod
+    def _lead(conn, search, key, token):
+        """Execute a search, publish its result to its followers, and
+        release its lease."""
+
+        try:
+            response = search.execute()
+
+            try:
+                conn.set('%s:%s' % (key, token),
+                         json.dumps(response.to_dict()),
+                         ex=settings.SINGLE_FLIGHT_LEASE)
+            except redis.RedisError as exc:
+                logger.warning("could not publish single-flight result: %s",
+                               exc)
+
+            return response
+        finally:
+            try:
+                if conn.get(key) == token:
+                    conn.delete(key)
+            except redis.RedisError as exc:
+                logger.warning("could not release single-flight lease: %s",
+                               exc)
+
+    @staticmethod
+    def _follow(conn, key, token):
+        """Return the result published under a lease, or None if the lease
+        ends, or SINGLE_FLIGHT_MAX_WAIT seconds pass, without one."""
+
+        deadline = time.time() + min(settings.SINGLE_FLIGHT_MAX_WAIT,
+                                     settings.SINGLE_FLIGHT_LEASE)
+        result_key = '%s:%s' % (key, token)
+
+        try:
+            while time.time() < deadline:
+                result = conn.get(result_key)
+                if result is not None:
+                    return json.loads(result)
+                if conn.get(key) != token:
+                    # The leader may have published just before releasing.
+                    result = conn.get(result_key)
+                    return json.loads(result) if result is not None else None
+                time.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+        except redis.RedisError as exc:
+            logger.warning("could not wait for single-flight result: %s",
+                           exc)
+
+        return None
+
+# The process-wide instance.
+single_flight = SingleFlight()          # pylint: disable=C0103
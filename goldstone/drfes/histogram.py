@@ -0,0 +1,223 @@
+"""DRFES incremental date histograms."""
+# Copyright 2016 Solinea, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import json
+import logging
+import re
+import time
+
+from django.conf import settings
+from elasticsearch_dsl.result import Response
+import redis
+
+from goldstone.drfes.cache import AggregationCache, agg_cache
+
+logger = logging.getLogger(__name__)
+
+# Fixed-length histogram intervals, e.g. "3600s" or "1.5h".  Weeks, months,
+# etc. are calendar intervals, which aren't handled.
+INTERVAL = re.compile(r'^(\d+(?:\.\d+)?)([smhd])$')
+UNIT_MS = {'s': 1000, 'm': 60 * 1000, 'h': 3600 * 1000, 'd': 86400 * 1000}
+
+
+def interval_ms(interval):
+    """Return a fixed-length interval in milliseconds, or None."""
+
+    match = INTERVAL.match(interval or '')
+    if match is None:
+        return None
+
+    step = int(float(match.group(1)) * UNIT_MS[match.group(2)])
+    return step if step > 0 else None
+
+
+class IncrementalHistogram(object):
+    """Serves date histograms from stored closed buckets plus a search of the
+    buckets that may still change.
+
+    A bucket is closed once it lies wholly inside the requested range and
+    its end is more than HISTOGRAM_GRACE_PERIOD seconds in the past, leaving
+    time for late-arriving documents.  Closed buckets are stored in Redis per
+    (search, interval), with the time range left out of the key, so a chart
+    that's refreshed with a sliding window only searches its open tail and
+    its partial first bucket.
+
+    Calendar intervals, histograms of more than HISTOGRAM_MAX_BUCKETS
+    buckets, searches without a time range, and Redis errors get a plain
+    search.
+
+    """
+
+    KEY_PREFIX = 'goldstone:histogram:'
+
+    @staticmethod
+    def _redis():
+        """Return a Redis client."""
+        from goldstone.models import RedisConnection
+
+        return RedisConnection().conn
+
+    @classmethod
+    def _strip_range(cls, body, field):
+        """Return a search body without the field's range bounds and the
+        histogram's extended bounds."""
+
+        if isinstance(body, list):
+            return [cls._strip_range(item, field) for item in body]
+
+        if not isinstance(body, dict):
+            return body
+
+        stripped = {}
+
+        for key, value in body.items():
+            if key == 'extended_bounds':
+                continue
+            if key == 'range' and isinstance(value, dict) and field in value:
+                value = dict((k, v) for k, v in value.items() if k != field)
+            stripped[key] = cls._strip_range(value, field)
+
+        return stripped
+
+    def key(self, search, agg_name, field):
+        """Return the store key of a search's histogram.
+
+        Indices are keyed by family, since time routing picks different
+        daily indices as the range slides.
+
+        """
+        # pylint: disable=W0212
+
+        normalized = {
+            'body': self._strip_range(search.to_dict(), field),
+            'family': AggregationCache.family(search),
+            'doc_type': AggregationCache._names(search._doc_type),
+            'params': search._params,
+            'agg': agg_name,
+        }
+
+        digest = hashlib.sha1(json.dumps(normalized, sort_keys=True))
+        return self.KEY_PREFIX + digest.hexdigest()
+
+    @staticmethod
+    def _runs(keys, step):
+        """Return [start, end) ranges covering runs of consecutive bucket
+        keys."""
+
+        runs = []
+
+        for key in keys:
+            if runs and runs[-1][1] == key:
+                runs[-1][1] = key + step
+            else:
+                runs.append([key, key + step])
+
+        return runs
+
+    def execute(self, search, agg_name, field, interval, start, end,
+                now=None):
+        """Return the response to a date histogram search, with closed
+        buckets served from the store.
+
+        :param search: The search, whose agg_name aggregation is a
+                       date_histogram of field
+        :type search: Search
+        :param agg_name: The top-level histogram's name
+        :type agg_name: str
+        :param field: The histogram's time field
+        :type field: str
+        :param interval: The histogram's interval
+        :type interval: str
+        :param start: The start of the search's time range
+        :param end: The end of the search's time range
+        :param now: The current epoch time in seconds.  If None, time.time()
+        :type now: float
+        :rtype: Response
+
+        """
+        from goldstone.models import _as_arrow
+
+        step = interval_ms(interval)
+        start = _as_arrow(start)
+        end = _as_arrow(end)
+
+        if not settings.HISTOGRAM_STORE_ENABLED or step is None or \
+                start is None or end is None or start > end:
+            return agg_cache.execute(search)
+
+        start_ms = start.timestamp * 1000 + start.microsecond // 1000
+        end_ms = end.timestamp * 1000 + end.microsecond // 1000
+        now_ms = int((now if now is not None else time.time()) * 1000)
+        grace_ms = settings.HISTOGRAM_GRACE_PERIOD * 1000
+
+        keys = range(start_ms - start_ms % step, end_ms + 1, step)
+        if len(keys) > settings.HISTOGRAM_MAX_BUCKETS:
+            return agg_cache.execute(search)
+
+        closed = [k for k in keys
+                  if k >= start_ms and k + step - 1 <= end_ms and
+                  k + step + grace_ms <= now_ms]
+
+        store_key = self.key(search, agg_name, field)
+
+        try:
+            conn = self._redis()
+            values = conn.hmget(store_key, closed) if closed else []
+        except redis.RedisError as exc:
+            logger.warning("histogram store unavailable: %s", exc)
+            return agg_cache.execute(search)
+
+        stored = dict((k, json.loads(v))
+                      for k, v in zip(closed, values) if v is not None)
+        missing = [k for k in keys if k not in stored]
+
+        if missing:
+            ranges = [{'range': {field: {'gte': low, 'lt': high}}}
+                      for low, high in self._runs(missing, step)]
+            response = agg_cache.execute(
+                search.filter('bool', should=ranges))
+            result = response.to_dict()
+            complete = response.success()
+        else:
+            result = {'hits': {'total': 0, 'max_score': None, 'hits': []},
+                      'aggregations': {agg_name: {'buckets': []}}}
+            complete = True
+
+        histogram = result.setdefault('aggregations', {}).setdefault(
+            agg_name, {'buckets': []})
+        buckets = dict((b['key'], b) for b in histogram['buckets'])
+
+        # Store the newly closed buckets, and keep the stored ones alive.
+        fresh = dict((k, json.dumps(buckets[k]))
+                     for k in closed
+                     if complete and k not in stored and k in buckets)
+        try:
+            if fresh or stored:
+                pipe = conn.pipeline(transaction=False)
+                if fresh:
+                    pipe.hmset(store_key, fresh)
+                pipe.expire(store_key, settings.HISTOGRAM_STORE_TTL)
+                pipe.execute()
+        except redis.RedisError as exc:
+            logger.warning("could not store histogram buckets: %s", exc)
+
+        buckets.update(stored)
+        histogram['buckets'] = [buckets[k] for k in sorted(buckets)]
+
+        callbacks = search._doc_type_map         # pylint: disable=W0212
+        return Response(result, callbacks=callbacks)
+
+# The process-wide instance.
+incremental_histogram = IncrementalHistogram()    # pylint: disable=C0103
@@ -0,0 +1,128 @@
+"""DRFES field mapping cache."""
+# Copyright 2016 Solinea, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import threading
+import time
+
+import arrow
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def mapping_has_raw(mapping, doc_type, field):
+    """Return True if a get_field_mapping response shows a 'raw' subfield.
+
+    :param mapping: the response from indices.get_field_mapping
+    :type mapping: dict
+    :param doc_type: the doc_type the mapping was requested for
+    :type doc_type: str
+    :param field: the field name in ES
+    :type field: str
+    :rtype: bool
+
+    """
+
+    try:
+        return 'raw' in \
+               mapping[mapping.keys()[-1]]['mappings'][doc_type][
+                   field]['mapping'][field]['fields']
+    except (KeyError, IndexError):
+        return False
+
+
+class FieldMappingCache(object):
+    """A process-wide cache of field mapping lookups.
+
+    Entries are keyed by (index prefix, doc_type, field).  An entry expires
+    after ES_FIELD_MAPPING_CACHE_TTL seconds, or when the prefix's generation
+    changes.  The default generation is the current UTC date, because a new
+    daily index (which may carry a new mapping) appears when the day rolls
+    over.  Callers that learn about new indices some other way can call
+    invalidate().
+
+    """
+
+    def __init__(self, ttl=None):
+
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _prefix_key(prefix):
+        """Return the normalized form of an index prefix."""
+
+        return (prefix or '').rstrip('*')
+
+    @staticmethod
+    def generation(prefix):           # pylint: disable=W0613
+        """Return the token that invalidates a prefix's entries when it
+        changes."""
+
+        return arrow.utcnow().format('YYYY.MM.DD')
+
+    def get(self, prefix, doc_type, field, loader):
+        """Return the cached value for a field, calling loader() on a miss.
+
+        Exceptions raised by the loader are not cached.
+
+        :param prefix: the index prefix, with or without a trailing wildcard
+        :type prefix: str
+        :param doc_type: the doc_type name
+        :type doc_type: str
+        :param field: the field name in ES
+        :type field: str
+        :param loader: a callable that returns the value to cache
+        :type loader: callable
+
+        """
+
+        prefix = self._prefix_key(prefix)
+        key = (prefix, doc_type, field)
+        generation = self.generation(prefix)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is not None:
+            value, expires, entry_generation = entry
+            if expires > now and entry_generation == generation:
+                return value
+
+        value = loader()
+        ttl = settings.ES_FIELD_MAPPING_CACHE_TTL if self.ttl is None \
+            else self.ttl
+
+        with self._lock:
+            self._entries[key] = (value, now + ttl, generation)
+
+        return value
+
+    def invalidate(self, prefix=None):
+        """Drop the entries for an index prefix, or all entries if prefix is
+        None."""
+
+        with self._lock:
+            if prefix is None:
+                self._entries.clear()
+            else:
+                prefix = self._prefix_key(prefix)
+                for key in [k for k in self._entries if k[0] == prefix]:
+                    del self._entries[key]
+
+# The process-wide instance.
+field_mapping_cache = FieldMappingCache()     # pylint: disable=C0103
@@ -14,7 +14,9 @@
 # limitations under the License.
 
 from elasticsearch_dsl import DocType, Search
-from goldstone.models import es_conn, es_indices, daily_index
+from goldstone.drfes.mappings import field_mapping_cache, mapping_has_raw
+from goldstone.models import es_conn, es_indices, es_latest_index, \
+    es_route_search, es_snap_range, es_aggregation_only, daily_index
 
 
 class DailyIndexDocType(DocType):
@@ -38,17 +40,25 @@ class DailyIndexDocType(DocType):
             doc_type={cls._doc_type.name: cls.from_es},
         ).sort(cls.SORT).using(es_conn())
 
-    def save(self, using=None, index=None, **kwargs):
+    def save(self, using=None, index=None, writer=None, **kwargs):
         """Posts a record to the database.
 
-        See elasticsearch-dsl for parameter information.
-        """
-        if using is None:
-            using = es_conn()
+        If writer (a BulkWriter) is given, the record is queued on it instead
+        of being written immediately, and None is returned.
 
+        See elasticsearch-dsl for other parameter information.
+        """
         if index is None:
             index = daily_index(self.INDEX_PREFIX)
 
+        if writer is not None:
+            writer.add(index, self._doc_type.name, self.to_dict(),
+                       doc_id=self.meta.get('id'))
+            return None
+
+        if using is None:
+            using = es_conn()
+
         return super(DailyIndexDocType, self).save(using, index, **kwargs)
 
     @classmethod
@@ -59,7 +69,7 @@ class DailyIndexDocType(DocType):
         """
 
         if index is None:
-            index = es_indices(cls.INDEX_PREFIX)
+            index = es_latest_index(cls.INDEX_PREFIX)
 
         return super(DailyIndexDocType, cls).get(id, using, index, **kwargs)
 
@@ -70,13 +80,20 @@ class DailyIndexDocType(DocType):
         """
 
         if index is None:
-            index = es_indices(self.INDEX_PREFIX)
+            index = es_latest_index(self.INDEX_PREFIX)
 
         return super(DailyIndexDocType, self).delete(using, index, **kwargs)
 
     @classmethod
-    def bounded_search(cls, start=None, end=None, key_field='@timestamp'):
-        """ Returns a search with time range."""
+    def bounded_search(cls, start=None, end=None, key_field='@timestamp',
+                       granularity=None):
+        """ Returns a search with time range.
+
+        The range is widened to whole multiples of granularity (seconds or a
+        fixed-length interval, by default ES_RANGE_GRANULARITY seconds), so
+        that ES can cache the search.  The search only targets the daily
+        indices that overlap the range.
+        """
         import arrow
         from arrow import Arrow
 
@@ -89,7 +106,8 @@ class DailyIndexDocType(DocType):
         if start is not None:
             assert isinstance(start, Arrow), "start is not an Arrow object"
 
-        search = cls.search()
+        start, end = es_snap_range(start, end, granularity)
+        search = es_route_search(cls.search(), cls.INDEX_PREFIX, start, end)
 
         if start is not None and end is not None:
             search = search.query(
@@ -134,14 +152,25 @@ class DailyIndexDocType(DocType):
         :rtype: object
 
         """
+        from goldstone.models import _as_arrow
 
         # aggregations mutate the search, so let's be nice to our caller
         # and work on a clone.
         search = base_queryset._clone()          # pylint: disable=W0212
 
-        # we are not interested in the actual docs, so use the count search
-        # type.
-        search = search.params(search_type="count")
+        # we are not interested in the actual docs, so only ask for the
+        # aggregations, which ES can cache.
+        search = es_aggregation_only(search)
+
+        # the bounds only pick the first and last buckets, so flooring them
+        # to the interval doesn't change the histogram, and keeps the search
+        # the same as the range moves within a bucket.  Bounds that aren't
+        # times (e.g., date math) are left alone.
+        snapped = es_snap_range(_as_arrow(bounds_min), _as_arrow(bounds_max),
+                                interval, round_end='down')
+        bounds_min, bounds_max = [
+            bound if bound is not None else original
+            for bound, original in zip(snapped, (bounds_min, bounds_max))]
 
         # add a top-level aggregation for the field
         search.aggs.bucket(agg_name, cls._datehist_agg(interval, bounds_min,
@@ -186,7 +215,7 @@ class DailyIndexDocType(DocType):
         """Return a field mapping."""
 
         conn = es_conn()
-        index = es_indices(cls.INDEX_PREFIX)
+        index = es_indices(cls.INDEX_PREFIX, new_days=False)
 
         return conn.indices.get_field_mapping(field,
                                               index,
@@ -199,15 +228,25 @@ class DailyIndexDocType(DocType):
         """Return True if the Elasticsearch mapping for a field has a 'raw'
         representation.
 
+        The answer is served from the process-wide field mapping cache, so
+        only the first lookup for a field touches the cluster.
+
         :param field: the field name in ES
         :return: bool
 
         """
 
-        try:
-            mapping = cls.get_field_mapping(field)
-            return 'raw' in \
-                   mapping[mapping.keys()[-1]]['mappings'][cls._doc_type.name][
-                       field]['mapping'][field]['fields']
-        except KeyError:
-            return False
+        def _lookup():
+            """Fetch the mapping and look for a raw subfield."""
+
+            try:
+                return mapping_has_raw(cls.get_field_mapping(field),
+                                       cls._doc_type.name,
+                                       field)
+            except KeyError:
+                return False
+
+        return field_mapping_cache.get(cls.INDEX_PREFIX,
+                                       cls._doc_type.name,
+                                       field,
+                                       _lookup)
@@ -14,7 +14,7 @@
 # limitations under the License.
 
 from elasticsearch_dsl import DocType
-from goldstone.models import es_conn
+from goldstone.models import es_conn, es_route_search, es_snap_range
 
 
 class DailyIndexDocType(DocType):
@@ -24,15 +24,28 @@ class DailyIndexDocType(DocType):
     class Meta:
         using = es_conn()
 
-    def save(self, using=None, index=None, **kwargs):
+    def save(self, using=None, index=None, writer=None, **kwargs):
+        """Posts a record to today's index, or queues it on writer (a
+        BulkWriter) if one is given."""
         if index is None:
             index = self._index_today()
+        if writer is not None:
+            writer.add(index, self._doc_type.name, self.to_dict(),
+                       doc_id=self.meta.get('id'))
+            return None
         return super(DailyIndexDocType, self).\
             save(using=using, index=index, **kwargs)
 
     @classmethod
-    def search_time_range(cls, start=None, end=None, key_field='@timestamp'):
-        """ Returns a search with time range."""
+    def search_time_range(cls, start=None, end=None, key_field='@timestamp',
+                          granularity=None):
+        """ Returns a search with time range.
+
+        The range is widened to whole multiples of granularity (seconds or a
+        fixed-length interval, by default ES_RANGE_GRANULARITY seconds), so
+        that ES can cache the search.  The search only targets the daily
+        indices that overlap the range.
+        """
         import arrow
         from arrow import Arrow
 
@@ -45,7 +58,9 @@ class DailyIndexDocType(DocType):
         if start is not None:
             assert isinstance(start, Arrow), "start is not an Arrow object"
 
-        search = cls.search()
+        start, end = es_snap_range(start, end, granularity)
+        search = es_route_search(cls.search(), cls._doc_type.index,
+                                 start, end)
 
         if start is not None and end is not None:
             search = search.query(
@@ -12,39 +12,66 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from collections import OrderedDict
+import json
 import logging
-from django.core.paginator import InvalidPage, Paginator as DjangoPaginator
+from django.core.paginator import EmptyPage, InvalidPage, Page, \
+    PageNotAnInteger, Paginator as DjangoPaginator
 from rest_framework import pagination
-from rest_framework.exceptions import NotFound
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 from elasticsearch_dsl.result import Response as ESResponse
 import six
 
+from goldstone.drfes.cache import agg_cache
+from goldstone.drfes.flight import single_flight
+
 logger = logging.getLogger(__name__)
 
 
+class ElasticPaginator(DjangoPaginator):
+    """A paginator whose count comes from an executed search's hits.total,
+    rather than from a separate count request."""
+
+    def __init__(self, count, per_page):
+
+        super(ElasticPaginator, self).__init__([], per_page)
+        self._count = count
+
+
 class ElasticPageNumberPagination(pagination.PageNumberPagination):
 
     page_size_query_param = "page_size"
 
     def paginate_queryset(self, queryset, request, view=None):
         """Paginate a queryset if required, either returning a page object, or
-        `None` if pagination is not configured for this view."""
+        `None` if pagination is not configured for this view.
+
+        The page is fetched with one search using from/size, and the count
+        comes from its hits.total.  Only a request for the last page needs a
+        count first.
+        """
 
         page_size = self.get_page_size(request)
         if not page_size:
             return None
 
-        paginator = DjangoPaginator(queryset, page_size)
         page_number = request.query_params.get(self.page_query_param, 1)
-        if page_number in self.last_page_strings:
-            page_number = paginator.num_pages
 
         try:
-            self.page = paginator.page(page_number)
-            # we need to execute the query to resolve the page of objects
-            self.page.object_list = self.page.object_list.execute()
+            if page_number in self.last_page_strings:
+                count = single_flight.execute(
+                    queryset.extra(size=0)).hits.total
+                number = ElasticPaginator(count, page_size).num_pages
+            else:
+                number = self._page_number(page_number)
+
+            start = (number - 1) * page_size
+            object_list = agg_cache.execute(
+                queryset[start:start + page_size])
+            paginator = ElasticPaginator(object_list.hits.total, page_size)
         except InvalidPage as exc:
             msg = self.invalid_page_message.format(
                 page_number=page_number, message=six.text_type(exc)
@@ -55,15 +82,42 @@ class ElasticPageNumberPagination(pagination.PageNumberPagination):
             # empty response to the client.  This can happen when the indices
             # have not been created, or generally on any ES exception.
             logger.exception(exc)
-            self.page.object_list = ESResponse({"hits": {"hits": []}})
+            number = 1
+            object_list = ESResponse({"hits": {"hits": [], "total": 0}})
+            paginator = ElasticPaginator(0, page_size)
+
+        if number > paginator.num_pages:
+            raise NotFound(self.invalid_page_message.format(
+                page_number=page_number,
+                message=six.text_type("That page contains no results")))
+
+        self.page = Page(object_list, number, paginator)
 
-        if paginator.count > 1 and self.template is not None:
+        if paginator.num_pages > 1 and self.template is not None:
             # The browsable API should display pagination controls.
             self.display_page_controls = True
 
         self.request = request
         return self.page.object_list
 
+    @staticmethod
+    def _page_number(page_number):
+        """Return a requested page number as a positive int.
+
+        :raises: PageNotAnInteger or EmptyPage
+
+        """
+
+        try:
+            number = int(page_number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger("That page number is not an integer")
+
+        if number < 1:
+            raise EmptyPage("That page number is less than 1")
+
+        return number
+
     def get_paginated_response(self, data):
 
         if 'aggregations' in data:
@@ -81,3 +135,206 @@ class ElasticPageNumberPagination(pagination.PageNumberPagination):
                 ('previous', self.get_previous_link()),
                 ('results', data['results']),
             ]))
+
+
+class ElasticCursorPagination(pagination.CursorPagination):
+    """Pages through a search with an opaque cursor.
+
+    The search's sort gets a final _uid tiebreaker, so every hit has a unique
+    sort position.  The cursor holds the sort values of the last hit on a
+    page, and the next page is the first page_size hits past them.  ES 1.x
+    has no search_after, so "past them" is expressed as a post filter on the
+    sort fields.  Each page is then one from=0 search, however deep it is.
+    Being a post filter, it leaves the search's aggregations covering all of
+    its hits, and a filter aggregation counts them for the page's count.
+
+    Cursors only go forward.  A request with an empty cursor parameter gets
+    the first page.
+
+    """
+
+    page_size_query_param = "page_size"
+    max_page_size = None
+    tiebreaker = "_uid"
+
+    # The aggregation that counts all of a search's hits on later pages.
+    TOTAL_AGG = "_cursor_total"
+    count = None
+
+    def get_page_size(self, request):
+
+        try:
+            return pagination._positive_int(     # pylint: disable=W0212
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.max_page_size)
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def paginate_queryset(self, queryset, request, view=None):
+        """Return the page of a search that follows the request's cursor.
+
+        :param queryset: The search
+        :type queryset: Search
+        :param request: The HTTP request
+        :type request: Request
+        :rtype: Response
+
+        """
+
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+
+        sort = self.sort_keys(queryset)
+        queryset = queryset.sort(
+            *[{field: {"order": order}} for field, order in sort])
+
+        after = self.decode_cursor(request)
+        if after is not None:
+            if len(after) != len(sort):
+                raise NotFound(self.invalid_cursor_message)
+            # dsl 0.0.4 has no post_filter(), so set it in the body.  The
+            # post filter narrows the hits total, so count them apart.
+            queryset = queryset.extra(
+                post_filter=self.after_filter(sort, after))
+            queryset.aggs.bucket(self.TOTAL_AGG, 'filter', match_all={})
+
+        try:
+            self.page = agg_cache.execute(queryset[:self.page_size])
+        except Exception as exc:           # pylint: disable=W0703
+            # Treat ES errors the way ElasticPageNumberPagination does.
+            logger.exception(exc)
+            self.page = ESResponse({"hits": {"hits": [], "total": 0}})
+
+        self.count = self.page.hits.total
+        result = self.page.to_dict()
+        total = result.get('aggregations', {}).pop(self.TOTAL_AGG, None)
+        if total is not None:
+            self.count = total['doc_count']
+            if not result['aggregations']:
+                del result['aggregations']
+            self.page = ESResponse(
+                result,
+                callbacks=queryset._doc_type_map)  # pylint: disable=W0212
+
+        hits = self.page.hits
+        self.next_position = hits[-1].meta.sort \
+            if len(hits) == self.page_size else None
+
+        if self.next_position is not None and self.template is not None:
+            # The browsable API should display pagination controls.
+            self.display_page_controls = True
+
+        return self.page
+
+    def sort_keys(self, queryset):
+        """Return a search's sort as (field, order) pairs, ending with the
+        tiebreaker.
+
+        :raises: ValidationError if the search is sorted on something that
+                 can't be filtered on, like _score
+
+        """
+
+        keys = []
+
+        for key in queryset._sort:          # pylint: disable=W0212
+            if isinstance(key, dict):
+                field, options = list(key.items())[0]
+                order = options.get("order", "asc") \
+                    if isinstance(options, dict) else options
+            else:
+                field, order = key, "asc"
+
+            if field.startswith("_") and field != self.tiebreaker:
+                raise ValidationError(
+                    "Cursor pagination can't sort on %s." % field)
+
+            if field != self.tiebreaker:
+                keys.append((field, order))
+
+        keys.append((self.tiebreaker, "asc"))
+        return keys
+
+    @staticmethod
+    def after_filter(sort, values):
+        """Return a filter that matches the documents sorted after a position.
+
+        A document follows the position if, for some sort field, it's past
+        the position's value and equal to it on all the preceding fields.
+
+        :param sort: (field, order) pairs
+        :type sort: list
+        :param values: The position's sort values
+        :type values: list
+        :rtype: dict
+
+        """
+
+        clauses = []
+
+        for i, (field, order) in enumerate(sort):
+            must = [{"term": {f: v}}
+                    for (f, _), v in zip(sort[:i], values[:i])]
+            past = "lt" if order == "desc" else "gt"
+            must.append({"range": {field: {past: values[i]}}})
+            clauses.append({"bool": {"must": must}})
+
+        return {"bool": {"should": clauses}}
+
+    def decode_cursor(self, request):
+        """Return the sort values in the request's cursor, or None for the
+        first page."""
+
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+
+        try:
+            values = json.loads(urlsafe_b64decode(encoded.encode("ascii")))
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if not isinstance(values, list):
+            raise NotFound(self.invalid_cursor_message)
+
+        return values
+
+    def encode_cursor(self, values):
+        """Return a link to the page that follows some sort values."""
+
+        encoded = urlsafe_b64encode(json.dumps(list(values)))
+        url = remove_query_param(self.base_url, "page")
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+
+        if self.next_position is None:
+            return None
+
+        return self.encode_cursor(self.next_position)
+
+    def get_previous_link(self):
+
+        return None
+
+    def get_paginated_response(self, data):
+
+        # ElasticListAPIView serializes the hits as a list, and
+        # ElasticResponseSerializer serializes a whole response as a dict.
+        results = data['results'] if isinstance(data, dict) else data
+
+        response = OrderedDict([
+            ('count', self.count),
+            ('next', self.get_next_link()),
+            ('results', results),
+        ])
+
+        if isinstance(data, dict) and 'aggregations' in data:
+            response['aggregations'] = data['aggregations']
+
+        return Response(response)
@@ -0,0 +1,958 @@
+"""DRFES rollups."""
+# Copyright 2016 Solinea, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import OrderedDict
+import copy
+import hashlib
+import json
+import logging
+import time
+
+import arrow
+from django.conf import settings
+from elasticsearch import ElasticsearchException
+from elasticsearch_dsl import A, Search
+from elasticsearch_dsl.result import Response
+import redis
+
+from goldstone.drfes.cache import AggregationCache, agg_cache
+from goldstone.drfes.histogram import interval_ms
+
+logger = logging.getLogger(__name__)
+
+# The rollup resolutions in milliseconds, coarsest first.
+RESOLUTIONS = OrderedDict([('1h', 3600 * 1000), ('1m', 60 * 1000)])
+
+# The aggregations that can be answered from rollups.  Metric aggregations
+# must be of the source's value field, and bucket aggregations of its
+# dimensions (or, for date histograms, its timestamp).
+BUCKET_AGGS = ('date_histogram', 'terms', 'range')
+METRIC_AGGS = ('stats', 'min', 'max', 'sum', 'value_count')
+
+# The parts of each metric aggregation, and the rollup field and aggregation
+# that each part is computed from.
+METRIC_PARTS = {'stats': ('count', 'sum', 'min', 'max'),
+                'min': ('min', ),
+                'max': ('max', ),
+                'sum': ('sum', ),
+                'value_count': ('count', )}
+PART_AGGS = {'count': ('value_count', 'sum'),
+             'sum': ('sum', 'sum'),
+             'min': ('min', 'min'),
+             'max': ('max', 'max')}
+
+# The options that bucket aggregations may have.
+BUCKET_OPTIONS = {
+    'date_histogram': ('field', 'interval', 'min_doc_count',
+                       'extended_bounds', 'format'),
+    'terms': ('field', 'size', 'shard_size', 'min_doc_count',
+              'shard_min_doc_count', 'order'),
+    'range': ('field', 'ranges', 'keyed'),
+}
+
+# Queries (and filters) whose keys are field names, compound queries, the
+# keys of compound queries that hold other queries, and options.
+FIELD_QUERIES = ('match', 'match_phrase', 'term', 'terms', 'range',
+                 'prefix', 'wildcard')
+COMPOUND_QUERIES = ('bool', 'filtered', 'constant_score', 'and', 'or', 'not',
+                    'fquery')
+CLAUSES = ('must', 'should', 'must_not', 'filter', 'query', 'filters')
+OPTIONS = ('boost', 'execution', 'minimum_should_match', 'disable_coord')
+
+# The rollup aggregation that sums the rolled-up document counts of a bucket.
+COUNT_AGG = '_rollup_count'
+
+
+class NotRollable(Exception):
+    """A search can't be answered from rollups."""
+
+    pass
+
+
+def _floor(value, step):
+    """Return value rounded down to a multiple of step."""
+
+    return value - value % step
+
+
+def _ceil(value, step):
+    """Return value rounded up to a multiple of step."""
+
+    return _floor(value + step - 1, step)
+
+
+def _epoch_ms(value):
+    """Return a time bound in epoch milliseconds, or None."""
+    from goldstone.models import _as_arrow
+
+    value = _as_arrow(value)
+    if value is None:
+        return None
+
+    return value.timestamp * 1000 + value.microsecond // 1000
+
+
+def _parts(definition):
+    """Return an aggregation definition's type, body, and sub-aggregations."""
+
+    definition = dict(definition)
+    subs = definition.pop('aggs', definition.pop('aggregations', {}))
+
+    if len(definition) != 1:
+        raise NotRollable("malformed aggregation")
+
+    kind, body = list(definition.items())[0]
+    return kind, body, subs
+
+
+def _hidden(part, name):
+    """Return the name of the rollup aggregation that computes one part of a
+    metric aggregation."""
+
+    return '_rollup_%s_%s' % (part, name)
+
+
+def _has_histogram(aggs, field):
+    """Return True if aggs include a date histogram of field."""
+
+    for definition in aggs.values():
+        kind, body, subs = _parts(definition)
+        if kind == 'date_histogram' and body.get('field') == field:
+            return True
+        if _has_histogram(subs, field):
+            return True
+
+    return False
+
+
+def _raw_aggs(aggs):
+    """Return the version of aggs that's run on the raw documents outside the
+    rolled-up range.
+
+    Terms aggregations get all their terms, so that they can be merged
+    exactly with the rolled-up ones.
+
+    """
+
+    result = {}
+
+    for name, definition in aggs.items():
+        kind, body, subs = _parts(definition)
+
+        if kind == 'terms':
+            body = dict((k, v) for k, v in body.items() if k != 'shard_size')
+            body['size'] = 0
+
+        result[name] = {kind: body}
+        if subs:
+            result[name]['aggs'] = _raw_aggs(subs)
+
+    return result
+
+
+def _metric(kind, values):
+    """Return a metric aggregation's result from its rolled-up parts."""
+
+    count = int(values.get('count') or 0)
+
+    if kind == 'stats':
+        total = values['sum'] if count else None
+        return {'count': count,
+                'min': values['min'],
+                'max': values['max'],
+                'sum': total,
+                'avg': total / count if count else None}
+
+    if kind == 'value_count':
+        return {'value': count}
+
+    return {'value': values[kind]}
+
+
+def _from_rollup(aggs, container):
+    """Return the aggregation results of a rollup search in the shape that
+    aggs would have had on the raw documents.
+
+    :param aggs: The original aggregations
+    :type aggs: dict
+    :param container: The rollup search's aggregations, or a bucket
+    :type container: dict
+    :rtype: dict
+
+    """
+
+    result = {}
+
+    for name, definition in aggs.items():
+        kind, _, subs = _parts(definition)
+
+        if kind in METRIC_AGGS:
+            values = dict((part, container.get(_hidden(part, name),
+                                               {}).get('value'))
+                          for part in METRIC_PARTS[kind])
+            result[name] = _metric(kind, values)
+            continue
+
+        if name not in container:
+            continue
+
+        agg = dict(container[name])
+        buckets = agg.get('buckets', [])
+
+        if isinstance(buckets, dict):
+            agg['buckets'] = dict((key, _bucket_from_rollup(subs, bucket))
+                                  for key, bucket in buckets.items())
+        else:
+            agg['buckets'] = [_bucket_from_rollup(subs, bucket)
+                              for bucket in buckets]
+
+        result[name] = agg
+
+    return result
+
+
+def _bucket_from_rollup(subs, bucket):
+    """Return a rollup search's bucket, with its document count replaced by
+    the rolled-up count."""
+
+    result = dict((key, value) for key, value in bucket.items()
+                  if not isinstance(value, dict))
+    result['doc_count'] = int(bucket.get(COUNT_AGG, {}).get('value') or 0)
+    result.update(_from_rollup(subs, bucket))
+    return result
+
+
+def _merge(aggs, head, tail):
+    """Merge two sets of aggregation results over disjoint time ranges.
+
+    :param aggs: The aggregations' definitions
+    :type aggs: dict
+    :param head: The results over one range
+    :type head: dict
+    :param tail: The results over the other range
+    :type tail: dict
+    :rtype: dict
+
+    """
+
+    result = {}
+
+    for name, definition in aggs.items():
+        kind, body, subs = _parts(definition)
+        first, second = head.get(name), tail.get(name)
+
+        if first is None or second is None:
+            result[name] = second if first is None else first
+        elif kind in METRIC_AGGS:
+            result[name] = _merge_metric(kind, first, second)
+        else:
+            result[name] = _merge_buckets(kind, body, subs, first, second)
+
+    return result
+
+
+def _merge_metric(kind, first, second):
+    """Merge two results of a metric aggregation."""
+
+    both = (first, second)
+
+    if kind == 'stats':
+        count = first['count'] + second['count']
+        sums = [r['sum'] for r in both if r['count']]
+        mins = [r['min'] for r in both if r['min'] is not None]
+        maxes = [r['max'] for r in both if r['max'] is not None]
+        total = sum(sums) if sums else None
+
+        return {'count': count,
+                'min': min(mins) if mins else None,
+                'max': max(maxes) if maxes else None,
+                'sum': total,
+                'avg': total / count if count else None}
+
+    values = [r['value'] for r in both if r.get('value') is not None]
+
+    if not values:
+        return {'value': None}
+    if kind == 'min':
+        return {'value': min(values)}
+    if kind == 'max':
+        return {'value': max(values)}
+
+    return {'value': sum(values)}
+
+
+def _merge_buckets(kind, body, subs, first, second):
+    """Merge two results of a bucket aggregation, matching buckets by key."""
+
+    def merged(one, other):
+        bucket = dict(one)
+        bucket['doc_count'] = one['doc_count'] + other['doc_count']
+        bucket.update(_merge(subs, one, other))
+        return bucket
+
+    result = dict(first)
+
+    if isinstance(first['buckets'], dict):
+        buckets = dict(first['buckets'])
+        for key, bucket in second['buckets'].items():
+            buckets[key] = merged(buckets[key], bucket) \
+                if key in buckets else bucket
+        result['buckets'] = buckets
+        return result
+
+    others = OrderedDict((b['key'], b) for b in second['buckets'])
+    buckets = [merged(b, others.pop(b['key'])) if b['key'] in others else b
+               for b in first['buckets']]
+    buckets.extend(others.values())
+
+    if kind == 'date_histogram':
+        buckets.sort(key=lambda b: b['key'])
+
+    elif kind == 'terms':
+        order = body.get('order') or {}
+        if '_term' in order:
+            buckets.sort(key=lambda b: b['key'],
+                         reverse=order['_term'] == 'desc')
+        else:
+            buckets.sort(key=lambda b: (-b['doc_count'], b['key']))
+
+        size = body.get('size', 10)
+        if size:
+            result['sum_other_doc_count'] = \
+                sum(b['doc_count'] for b in buckets[size:])
+            buckets = buckets[:size]
+
+        result['doc_count_error_upper_bound'] = 0
+
+    result['buckets'] = buckets
+    return result
+
+
+class RollupSource(object):
+    """A doc type that's rolled up.
+
+    A rollup document summarizes the source documents in one time bucket
+    that have one combination of dimension values.  It has the bucket's
+    start in the source's timestamp field, the dimension values under their
+    source names, and the number of documents in "count".  If the source has
+    a value field, it also has the value's "value_count", "sum", "min", and
+    "max", and if the source has a latency histogram, the number of values
+    in each of ROLLUP_LATENCY_BUCKETS in "histogram".
+
+    """
+
+    def __init__(self, doc_type, index_prefix, timestamp_field, dimensions,
+                 value_field=None, latency_histogram=False):
+        """Initialize the source.
+
+        :param doc_type: The source's doc type, which is also the rollup
+                         documents' doc type
+        :type doc_type: str
+        :param index_prefix: The prefix of the source's daily indices
+        :type index_prefix: str
+        :param timestamp_field: The source's timestamp field
+        :type timestamp_field: str
+        :param dimensions: The names of the dimension fields, mapped to the
+                           fields that are aggregated on (e.g., "x.raw")
+        :type dimensions: dict
+        :param value_field: The numeric field whose statistics are rolled up
+        :type value_field: str
+        :param latency_histogram: Roll up a histogram of the value field
+        :type latency_histogram: bool
+
+        """
+
+        self.doc_type = doc_type
+        self.index_prefix = index_prefix
+        self.timestamp_field = timestamp_field
+        self.dimensions = dimensions
+        self.value_field = value_field
+        self.latency_histogram = latency_histogram and value_field is not None
+
+    def rollup_prefix(self, resolution):
+        """Return the prefix of the daily rollup indices at a resolution."""
+
+        return '%s%s_%s-' % (settings.ROLLUP_INDEX_PREFIX, self.doc_type,
+                             resolution)
+
+    @staticmethod
+    def _histogram_ranges():
+        """Return the ranges of the latency histogram, with their keys."""
+
+        bounds = settings.ROLLUP_LATENCY_BUCKETS
+        ranges = []
+
+        for i, bound in enumerate(bounds):
+            key = 'lt_' + ('%g' % bound).replace('.', '_')
+            ranges.append({'key': key, 'to': bound} if i == 0
+                          else {'key': key, 'from': bounds[i - 1],
+                                'to': bound})
+
+        ranges.append({'key': 'inf', 'from': bounds[-1]})
+        return ranges
+
+    def _summary_aggs(self, dimensions):
+        """Return the nested aggregations that split documents by the
+        remaining dimensions, with the rolled-up metrics at the leaves."""
+
+        if not dimensions:
+            aggs = {}
+            if self.value_field is not None:
+                aggs['stats'] = {'stats': {'field': self.value_field}}
+            if self.latency_histogram:
+                aggs['histogram'] = {'range': {
+                    'field': self.value_field,
+                    'keyed': True,
+                    'ranges': self._histogram_ranges()}}
+            return aggs
+
+        name = dimensions[0]
+        field = self.dimensions[name]
+        inner = self._summary_aggs(dimensions[1:])
+
+        # Documents without the dimension are rolled up too.
+        aggs = {name: {'terms': {'field': field, 'size': 0}},
+                '_missing_' + name: {'missing': {'field': field}}}
+        if inner:
+            for definition in aggs.values():
+                definition['aggs'] = copy.deepcopy(inner)
+
+        return aggs
+
+    def summary_search(self, start, end, resolution):
+        """Return the search that rolls up [start, end).
+
+        :param start: The start of the range in epoch milliseconds
+        :type start: int
+        :param end: The end of the range in epoch milliseconds
+        :type end: int
+        :param resolution: A key of RESOLUTIONS
+        :type resolution: str
+        :rtype: Search
+
+        """
+        from goldstone.models import es_conn, es_route_search
+
+        search = Search(index=self.index_prefix + '*',
+                        doc_type=self.doc_type).using(es_conn())
+        search = es_route_search(search, self.index_prefix, start, end)
+        search = search.filter('range', **{self.timestamp_field: {
+            'gte': start, 'lt': end}})
+        search = search.extra(size=0)
+
+        search.aggs._params = {'aggs': {      # pylint: disable=W0212
+            'per_bucket': A({
+                'date_histogram': {'field': self.timestamp_field,
+                                   'interval': resolution,
+                                   'min_doc_count': 1},
+                'aggs': self._summary_aggs(sorted(self.dimensions))})}}
+
+        return search
+
+    def documents(self, response, resolution):
+        """Yield the rollup documents of a summary search's response.
+
+        :param response: The response to summary_search()
+        :type response: Response
+        :param resolution: A key of RESOLUTIONS
+        :type resolution: str
+        :return: (index, document id, document) tuples
+
+        """
+
+        result = response.to_dict().get('aggregations', {})
+        prefix = self.rollup_prefix(resolution)
+
+        for bucket in result.get('per_bucket', {}).get('buckets', []):
+            index = prefix + arrow.get(bucket['key'] / 1000.0).format(
+                'YYYY.MM.DD')
+
+            for values, leaf in self._leaves(bucket, sorted(self.dimensions),
+                                             {}):
+                doc = {self.timestamp_field: bucket['key'],
+                       'count': leaf['doc_count']}
+                doc.update(values)
+                doc.update(self._metrics(leaf))
+
+                key = json.dumps([resolution, bucket['key'], values],
+                                 sort_keys=True)
+                yield index, hashlib.sha1(key).hexdigest(), doc
+
+    def _leaves(self, bucket, dimensions, values):
+        """Yield the (dimension values, bucket) pairs of the innermost
+        buckets under a bucket."""
+
+        if not dimensions:
+            yield values, bucket
+            return
+
+        name = dimensions[0]
+
+        for inner in bucket.get(name, {}).get('buckets', []):
+            found = dict(values)
+            found[name] = inner['key']
+            for leaf in self._leaves(inner, dimensions[1:], found):
+                yield leaf
+
+        missing = bucket.get('_missing_' + name, {})
+        if missing.get('doc_count'):
+            for leaf in self._leaves(missing, dimensions[1:], values):
+                yield leaf
+
+    def _metrics(self, leaf):
+        """Return the rolled-up metrics of an innermost bucket."""
+
+        metrics = {}
+
+        stats = leaf.get('stats')
+        if stats and stats.get('count'):
+            metrics.update({'value_count': stats['count'],
+                            'sum': stats['sum'],
+                            'min': stats['min'],
+                            'max': stats['max']})
+
+        histogram = leaf.get('histogram')
+        if histogram:
+            metrics['histogram'] = dict(
+                (key, bucket['doc_count'])
+                for key, bucket in histogram['buckets'].items())
+
+        return metrics
+
+    def _check_field(self, field, timestamp=True):
+        """Raise NotRollable if a field isn't a dimension (or the timestamp).
+        """
+
+        base = field[:-len('.raw')] if field.endswith('.raw') else field
+
+        if base not in self.dimensions and \
+                not (timestamp and field == self.timestamp_field):
+            raise NotRollable("%s isn't rolled up" % field)
+
+    def check_query(self, query):
+        """Raise NotRollable unless a query only uses rolled-up fields.
+
+        :param query: A query or filter, or a list of them
+        :type query: dict
+
+        """
+
+        if isinstance(query, list):
+            for item in query:
+                self.check_query(item)
+            return
+
+        if not isinstance(query, dict):
+            raise NotRollable("malformed query")
+
+        for kind, body in query.items():
+            if kind == 'match_all':
+                continue
+
+            elif kind in FIELD_QUERIES and isinstance(body, dict):
+                for field in body:
+                    if not field.startswith('_') and field not in OPTIONS:
+                        self._check_field(field)
+
+            elif kind in COMPOUND_QUERIES:
+                if isinstance(body, dict) and \
+                        set(body) <= set(CLAUSES + OPTIONS + ('_cache', )):
+                    for clause in CLAUSES:
+                        if clause in body:
+                            self.check_query(body[clause])
+                else:
+                    # E.g., the short forms of "and" and "not".
+                    self.check_query(body)
+
+            else:
+                raise NotRollable("%s queries aren't rolled up" % kind)
+
+    def _check_bucket(self, kind, body, step):
+        """Raise NotRollable unless a bucket aggregation can be answered from
+        rollups at a resolution."""
+
+        if not set(body) <= set(BUCKET_OPTIONS[kind]):
+            raise NotRollable("unsupported %s options" % kind)
+
+        if body.get('min_doc_count', 0) > 1:
+            raise NotRollable("min_doc_count is more than 1")
+
+        if kind == 'date_histogram':
+            step_ms = interval_ms(body.get('interval'))
+            if body.get('field') != self.timestamp_field or \
+                    step_ms is None or step_ms % step:
+                raise NotRollable("the histogram doesn't fit the rollups")
+            return
+
+        self._check_field(body.get('field', ''), timestamp=False)
+
+        if kind == 'terms':
+            order = body.get('order') or {'_count': 'desc'}
+            if order not in ({'_count': 'desc'}, {'_term': 'asc'},
+                             {'_term': 'desc'}):
+                raise NotRollable("unsupported terms order")
+
+    def rollup_aggs(self, aggs, step):
+        """Return the aggregations that answer aggs from the rollups at a
+        resolution.
+
+        Every bucket gets a sum of the rolled-up counts, and each metric
+        aggregation becomes aggregations of the rolled-up fields that make
+        it up.
+
+        :param aggs: The aggregations
+        :type aggs: dict
+        :param step: The resolution in milliseconds
+        :type step: int
+        :rtype: dict
+        :raises: NotRollable
+
+        """
+
+        result = {}
+
+        for name, definition in aggs.items():
+            kind, body, subs = _parts(definition)
+
+            if kind in METRIC_AGGS:
+                if subs or set(body) != set(['field']) or \
+                        body['field'] != self.value_field:
+                    raise NotRollable("%s isn't rolled up" % name)
+
+                for part in METRIC_PARTS[kind]:
+                    field, metric = PART_AGGS[part]
+                    result[_hidden(part, name)] = {metric: {'field': field}}
+                continue
+
+            if kind not in BUCKET_AGGS:
+                raise NotRollable("%s aggregations aren't rolled up" % kind)
+
+            self._check_bucket(kind, body, step)
+
+            if kind == 'terms':
+                order = body.get('order')
+                body = {'field': body['field'],
+                        'size': 0,
+                        'min_doc_count': body.get('min_doc_count', 1)}
+                if order and '_term' in order:
+                    body['order'] = order
+
+            inner = self.rollup_aggs(subs, step)
+            inner[COUNT_AGG] = {'sum': {'field': 'count'}}
+            result[name] = {kind: body, 'aggs': inner}
+
+        return result
+
+
+class RollupPlan(object):
+    """A search that's answered from rollups and raw documents.
+
+    The rollups answer for the part of the search's time range that's
+    aligned to their resolution and already rolled up.  The rest of the
+    range, i.e. its unaligned edges and its recent end, is aggregated from
+    the raw documents by a filter aggregation in the original search, which
+    still gets the hits.  The two sets of results are merged bucket by
+    bucket.
+
+    """
+
+    RAW_AGG = '_rollup_raw'
+
+    def __init__(self, search, source, resolution, head_start, head_end,
+                 aggs, rolled):
+        """Initialize the plan.
+
+        :param search: The original search
+        :type search: Search
+        :param source: The source that it searches
+        :type source: RollupSource
+        :param resolution: The rollups' resolution
+        :type resolution: str
+        :param head_start: The start of the rolled-up range in epoch ms
+        :type head_start: int
+        :param head_end: The end of the rolled-up range in epoch ms
+        :type head_end: int
+        :param aggs: The search's aggregations
+        :type aggs: dict
+        :param rolled: The aggregations that answer them from the rollups
+        :type rolled: dict
+
+        """
+        # pylint: disable=W0212
+        from goldstone.models import es_aggregation_only, es_route_search
+
+        self.search = search
+        self.source = source
+        self.resolution = resolution
+        self.head_start = head_start
+        self.head_end = head_end
+        self.aggs = aggs
+
+        head = {self.source.timestamp_field: {'gte': head_start,
+                                              'lt': head_end}}
+
+        self.raw_search = search._clone()
+        self.raw_search.aggs._params = {'aggs': {self.RAW_AGG: A({
+            'filter': {'bool': {'must_not': [{'range': head}]}},
+            'aggs': _raw_aggs(aggs)})}}
+
+        rollup = search._clone()
+        rollup._sort = []
+        rollup._fields = None
+        rollup._highlight = {}
+        rollup._suggest = {}
+        rollup._params = {}
+        rollup._extra = {'size': 0}
+        prefix = source.rollup_prefix(resolution)
+        rollup = es_route_search(rollup.index().index(prefix + '*'), prefix,
+                                 head_start, head_end - 1)
+        rollup = rollup.filter('range', **head)
+        rollup.aggs._params = {'aggs': dict(
+            (name, A(definition)) for name, definition in rolled.items())}
+        self.rollup_search = es_aggregation_only(rollup)
+
+    def merge(self, response):
+        """Return the response to the original search, from the response to
+        raw_search (or to a page of it) and the rollups.
+
+        :param response: The response to raw_search
+        :type response: Response
+        :rtype: Response
+
+        """
+
+        result = copy.deepcopy(response.to_dict())
+        aggregations = result.get('aggregations', {})
+
+        raw = aggregations.pop(self.RAW_AGG, None)
+        if raw is None:
+            # E.g., the empty response that pagination returns on errors.
+            return response
+
+        try:
+            head = agg_cache.execute(self.rollup_search)
+            rolled = head.success()
+        except ElasticsearchException as exc:
+            logger.warning("rollup search failed: %s", exc)
+            rolled = False
+
+        if rolled:
+            aggregations.update(_merge(
+                self.aggs,
+                _from_rollup(self.aggs,
+                             head.to_dict().get('aggregations', {})),
+                raw))
+        else:
+            full = agg_cache.execute(self.search.extra(size=0))
+            aggregations.update(full.to_dict().get('aggregations', {}))
+
+        result['aggregations'] = aggregations
+
+        callbacks = self.search._doc_type_map     # pylint: disable=W0212
+        return Response(result, callbacks=callbacks)
+
+    def execute(self):
+        """Execute the search.
+
+        :rtype: Response
+
+        """
+
+        return self.merge(agg_cache.execute(self.raw_search))
+
+
+class Rollups(object):
+    """Maintains the rollups of ROLLUP_SOURCES, and routes searches to them.
+
+    The update() method rolls up a source's newly closed buckets at a
+    resolution.  A bucket is closed ROLLUP_GRACE_PERIOD seconds after it
+    ends, and documents that arrive later than that aren't rolled up.  The
+    rolled-up range of each source and resolution, [start, end), is kept in
+    Redis.
+
+    The plan() method decides whether a search's aggregations can be
+    answered from rollups: they must include a date histogram whose interval
+    is a multiple of a resolution, and only use aggregations, dimensions,
+    and fields that are rolled up.  The coarsest resolution that covers part
+    of the search's time range is used.
+
+    """
+
+    WATERMARKS_KEY = 'goldstone:rollup_watermarks'
+
+    @staticmethod
+    def _redis():
+        """Return a Redis client."""
+        from goldstone.models import RedisConnection
+
+        return RedisConnection().conn
+
+    @staticmethod
+    def sources():
+        """Return the rollup sources, by doc type.
+
+        :rtype: dict
+
+        """
+
+        return dict((doc_type, RollupSource(doc_type, **config))
+                    for doc_type, config in settings.ROLLUP_SOURCES.items())
+
+    def watermarks(self, source, resolution, conn=None):
+        """Return the rolled-up range of a source at a resolution, as a dict
+        with "start" and "end" epoch ms, or None if it has no rollups."""
+
+        conn = conn if conn is not None else self._redis()
+        value = conn.hget(self.WATERMARKS_KEY,
+                          '%s:%s' % (source.doc_type, resolution))
+
+        return json.loads(value) if value is not None else None
+
+    def update(self, source, resolution, now=None):
+        """Roll up a source's newly closed buckets at a resolution.
+
+        At most ROLLUP_MAX_BUCKETS_PER_RUN buckets are rolled up.  A source
+        without rollups starts ROLLUP_INITIAL_LOOKBACK seconds ago.  Rolling
+        up a bucket again overwrites its documents.
+
+        :param source: The source
+        :type source: RollupSource
+        :param resolution: A key of RESOLUTIONS
+        :type resolution: str
+        :param now: The current epoch time in seconds.  If None, time.time()
+        :type now: float
+        :return: The number of rollup documents written
+        :rtype: int
+
+        """
+        from goldstone.drfes.bulk import BulkWriter
+
+        step = RESOLUTIONS[resolution]
+        now_ms = int((now if now is not None else time.time()) * 1000)
+        ready = _floor(now_ms - settings.ROLLUP_GRACE_PERIOD * 1000, step)
+
+        conn = self._redis()
+        marks = self.watermarks(source, resolution, conn)
+
+        if marks is None:
+            first = start = _floor(
+                now_ms - settings.ROLLUP_INITIAL_LOOKBACK * 1000, step)
+        else:
+            first, start = marks['start'], marks['end']
+
+        end = min(ready, start + settings.ROLLUP_MAX_BUCKETS_PER_RUN * step)
+        if end <= start:
+            return 0
+
+        response = source.summary_search(start, end, resolution).execute()
+        if not response.success():
+            logger.warning("could not roll up %s at %s: search failed",
+                           source.doc_type, resolution)
+            return 0
+
+        writer = BulkWriter()
+        indices = set()
+
+        for index, doc_id, doc in source.documents(response, resolution):
+            writer.add(index, source.doc_type, doc, doc_id=doc_id)
+            indices.add(index)
+
+        writer.flush()
+        if writer.failed:
+            logger.error("could not roll up %s at %s: %d documents failed",
+                         source.doc_type, resolution, writer.failed)
+            return 0
+
+        # Make the rollups searchable before they're routed to.
+        if indices:
+            writer.conn.indices.refresh(index=','.join(sorted(indices)))
+
+        conn.hset(self.WATERMARKS_KEY,
+                  '%s:%s' % (source.doc_type, resolution),
+                  json.dumps({'start': first, 'end': end}))
+
+        return writer.indexed
+
+    def _source(self, search):
+        """Return the rollup source of a search, or None."""
+        # pylint: disable=W0212
+
+        names = AggregationCache._names(search._doc_type)
+        if len(names) != 1:
+            return None
+
+        source = self.sources().get(names[0])
+        if source is None or \
+                AggregationCache.family(search) != source.index_prefix:
+            return None
+
+        return source
+
+    def plan(self, search, start, end):
+        """Return the plan for answering a search's aggregations from
+        rollups, or None if they can't be.
+
+        :param search: The search
+        :type search: Search
+        :param start: The start of the search's time range
+        :param end: The end of the search's time range
+        :rtype: RollupPlan
+
+        """
+
+        if not settings.ROLLUP_ENABLED:
+            return None
+
+        start, end = _epoch_ms(start), _epoch_ms(end)
+        source = self._source(search)
+        body = search.to_dict()
+        aggs = body.get('aggs')
+
+        if source is None or start is None or end is None or not aggs:
+            return None
+
+        try:
+            if not _has_histogram(aggs, source.timestamp_field):
+                return None
+            source.check_query(body.get('query', {}))
+            conn = self._redis()
+        except NotRollable:
+            return None
+
+        for resolution, step in RESOLUTIONS.items():
+            try:
+                rolled = source.rollup_aggs(aggs, step)
+                marks = self.watermarks(source, resolution, conn)
+            except NotRollable:
+                continue
+            except redis.RedisError as exc:
+                logger.warning("rollup watermarks unavailable: %s", exc)
+                return None
+
+            if marks is None:
+                continue
+
+            # The bounds may be exclusive, so the documents at them are left
+            # to the raw search.
+            head_start = max(_ceil(start + 1, step), marks['start'])
+            head_end = _floor(min(end, marks['end']), step)
+
+            if head_start < head_end:
+                return RollupPlan(search, source, resolution, head_start,
+                                  head_end, aggs, rolled)
+
+        return None
+
+# The process-wide instance.
+rollups = Rollups()                   # pylint: disable=C0103
@@ -12,19 +12,38 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import json
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+
 from django.http import QueryDict
 import elasticsearch
 from elasticsearch.client import IndicesClient
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.result import Response
 from mock import MagicMock, patch
-from rest_framework.test import APITestCase
-
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, APITestCase
+
+from goldstone.drfes.bulk import BulkWriter
+from goldstone.drfes.cache import AggregationCache
+from goldstone.drfes.flight import SingleFlight
+from goldstone.drfes.export import ColumnSpool, csv_lines, ndjson_lines, \
+    scan_sources, write_columnar
+from goldstone.drfes.mappings import FieldMappingCache, field_mapping_cache
 from goldstone.drfes.models import DailyIndexDocType
+from goldstone.drfes.pagination import ElasticCursorPagination, \
+    ElasticPageNumberPagination
 from goldstone.drfes.utils import custom_exception_handler
 
 from goldstone.drfes.views import ElasticListAPIView
 from goldstone.drfes.filters import ElasticFilter
+from goldstone.drfes.histogram import IncrementalHistogram, interval_ms
+from goldstone.drfes.rollup import RollupSource, Rollups
 from goldstone.drfes.serializers import ReadOnlyElasticSerializer
 
 
@@ -93,37 +112,29 @@ class SerializerTests(APITestCase):
 class FilterTests(APITestCase):
     """Filter tests."""
 
-    def test__add_query_no_raw(self):
+    def test__field_no_raw(self):
         """Test proper handling of mapping without raw field."""
 
         view = ElasticListAPIView()
         view.Meta.model = MagicMock()
         view.Meta.model.field_has_raw.return_value = False
 
-        expectation = {'query': {'match': {'param1': 'value1'}}}
-        elasticfilter = ElasticFilter()
-        queryset = Search()
-
         # pylint: disable=W0212
-        result = elasticfilter._add_query('param1', 'value1', view, queryset)
+        result = ElasticFilter._field('param1', view)
         self.assertTrue(view.Meta.model.field_has_raw.called)
-        self.assertEqual(result.to_dict(), expectation)
+        self.assertEqual(result, 'param1')
 
-    def test__add_query_with_raw(self):
+    def test__field_with_raw(self):
         """Test proper handling of mapping with raw field."""
 
         view = ElasticListAPIView()
         view.Meta.model = MagicMock()
         view.Meta.model.field_has_raw.return_value = True
 
-        expectation = {'query': {'match': {'param1.raw': 'value1'}}}
-        elasticfilter = ElasticFilter()
-        queryset = Search()
-
         # pylint: disable=W0212
-        result = elasticfilter._add_query('param1', 'value1', view, queryset)
+        result = ElasticFilter._field('param1', view)
         self.assertTrue(view.Meta.model.field_has_raw.called)
-        self.assertEqual(result.to_dict(), expectation)
+        self.assertEqual(result, 'param1.raw')
 
     def test__coerce_value_list(self):
         """Test that we properly coerce values to native python types."""
@@ -168,11 +179,52 @@ class FilterTests(APITestCase):
         result = \
             elasticfilter.filter_queryset(request, Search(), view).to_dict()
 
-        EXPECTED = [{'terms': {u'name': ['value1', 'value2']}},
-                    {'match': {u'name': 'value'}}]
+        EXPECTED = [{'fquery': {'query': {'match': {u'name': 'value'}}}},
+                    {'terms': {u'name': ['value1', 'value2']}}]
 
-        for item in EXPECTED:
-            self.assertTrue(item in result['query']['bool']['must'])
+        self.assertEqual(
+            result['query']['filtered']['filter']['bool']['must'], EXPECTED)
+
+    def test_filter_queryset_raw(self):
+        """Matches of raw fields are term filters."""
+
+        view = ElasticListAPIView()
+        view.Meta.model = MagicMock()
+        view.Meta.model.field_has_raw.return_value = True
+
+        request = MagicMock()
+        request.query_params = QueryDict('name=value&n__range={"gte":1}')
+
+        result = ElasticFilter().filter_queryset(request, Search(), view)
+
+        self.assertEqual(
+            result.to_dict()['query']['filtered']['filter']['bool']['must'],
+            [{'range': {'n.raw': {'gte': 1}}},
+             {'term': {'name.raw': 'value'}}])
+
+    def test_filter_queryset_invalid(self):
+        """Unsupported operations and malformed values are rejected."""
+
+        view = ElasticListAPIView()
+        view.Meta.model = MagicMock()
+        view.Meta.model.field_has_raw.return_value = False
+
+        for query in ['name__script=x', 'a__b__term=x', 'n__range=5',
+                      'name__terms=x', 'terms=[1]', 'name__regexp=[1]']:
+            request = MagicMock()
+            request.query_params = QueryDict(query)
+
+            self.assertRaises(ValidationError, ElasticFilter().filter_queryset,
+                              request, Search(), view)
+
+    def test_compile(self):
+        """Parameters are compiled into clauses in a stable order."""
+
+        plan = ElasticFilter.compile(['b__range', 'a'])
+
+        self.assertEqual(plan, (('a', 'a', 'match'),
+                                ('b__range', 'b', 'range')))
+        self.assertEqual(ElasticFilter.compile(['a', 'b__range']), plan)
 
     def test_filter_terms_regexp(self):
         """Test search object filtering using terms and regexp.
@@ -212,7 +264,8 @@ class FilterTests(APITestCase):
             elasticfilter.filter_queryset(request, Search(), view).to_dict()
 
         for item in EXPECTED:
-            self.assertTrue(item in result['query']['bool']['must'])
+            self.assertTrue(
+                item in result['query']['filtered']['filter']['bool']['must'])
 
 
 class ViewTests(APITestCase):
@@ -244,6 +297,15 @@ class ViewTests(APITestCase):
 
         self.assertEqual(view.get_queryset(), expectation)
 
+    def test_paginator(self):
+        """A cursor parameter selects cursor pagination."""
+
+        for query, expectation in [('?page=2', ElasticPageNumberPagination),
+                                   ('?cursor=', ElasticCursorPagination)]:
+            view = ElasticListAPIView()
+            view.request = Request(APIRequestFactory().get('/x/' + query))
+            self.assertIsInstance(view.paginator, expectation)
+
 
 class CustomExceptionHandlerTests(APITestCase):
     """Tests for DRF custom exception handling."""
@@ -312,6 +374,10 @@ class CustomExceptionHandlerTests(APITestCase):
 class DailyIndexDocTypeTests(APITestCase):
     """Tests for the LogData model"""
 
+    def setUp(self):
+
+        field_mapping_cache.invalidate()
+
     def test_field_has_raw_true(self):
         """field_has_raw returns True if mapping has a raw field."""
 
@@ -354,6 +420,56 @@ class DailyIndexDocTypeTests(APITestCase):
             self.assertTrue(gfm.called)
             self.assertFalse(result)
 
+    def test_field_has_raw_cached(self):
+        """field_has_raw only asks Elasticsearch once per field and day."""
+
+        with patch.object(DailyIndexDocType, "get_field_mapping") as gfm:
+
+            field = 'field'
+            gfm.return_value = {'index': {'mappings': {
+                'syslog': {field: {'mapping': {field: {'fields': {
+                    'raw': True}}}}}}}}
+
+            self.assertTrue(DailyIndexDocType.field_has_raw(field))
+            self.assertTrue(DailyIndexDocType.field_has_raw(field))
+            self.assertEqual(gfm.call_count, 1)
+
+            # a different field is a different cache entry.
+            self.assertFalse(DailyIndexDocType.field_has_raw('other'))
+            self.assertEqual(gfm.call_count, 2)
+
+            # a new daily index invalidates the entry.
+            with patch.object(FieldMappingCache, "generation") as gen:
+                gen.return_value = '2999.01.01'
+                self.assertTrue(DailyIndexDocType.field_has_raw(field))
+                self.assertEqual(gfm.call_count, 3)
+
+    def test_simple_datehistogram_agg(self):
+        """Histograms are aggregation-only, with bounds floored to their
+        interval."""
+
+        search = DailyIndexDocType.simple_datehistogram_agg(
+            Search(), '1h', bounds_min=1451607930500, bounds_max='now')
+
+        body = search.to_dict()
+        self.assertEqual(body['size'], 0)
+        self.assertEqual(
+            body['aggs']['per_interval']['date_histogram']['extended_bounds'],
+            {'min': '2016-01-01T00:00:00+00:00', 'max': 'now'})
+        self.assertEqual(search._params,          # pylint: disable=W0212
+                         {'search_type': 'count', 'query_cache': 'true'})
+
+    def test_field_has_raw_expired(self):
+        """field_has_raw asks Elasticsearch again after the TTL expires."""
+
+        with patch.object(DailyIndexDocType, "get_field_mapping") as gfm, \
+                self.settings(ES_FIELD_MAPPING_CACHE_TTL=0):
+
+            gfm.return_value = {}
+            self.assertFalse(DailyIndexDocType.field_has_raw('field'))
+            self.assertFalse(DailyIndexDocType.field_has_raw('field'))
+            self.assertEqual(gfm.call_count, 2)
+
     def test_get_field_mapping(self):
         """get_field_mapping returns the mapping reported by Elasticsearch."""
 
@@ -362,3 +478,1101 @@ class DailyIndexDocTypeTests(APITestCase):
             gfm.return_value = 'pass me through'
             result = DailyIndexDocType.get_field_mapping('field')
             self.assertEqual(result, 'pass me through')
+
+
+def bulk_response(*statuses):
+    """Return a _bulk response with one item per status."""
+
+    return {'took': 1,
+            'errors': any(status >= 300 for status in statuses),
+            'items': [{'index': {'_index': 'index', '_type': 'type',
+                                 '_id': str(i), 'status': status}}
+                      for i, status in enumerate(statuses)]}
+
+
+class BulkWriterTests(APITestCase):
+    """Tests for the BulkWriter."""
+
+    def setUp(self):
+
+        self.conn = MagicMock()
+        self.conn.bulk.side_effect = \
+            lambda body, index: bulk_response(*[200] * (len(body) / 2))
+
+    def test_batches_by_index(self):
+        """Each index's documents go out in one _bulk request."""
+
+        with BulkWriter(conn=self.conn) as writer:
+            writer.add('a-2016.01.01', 'type', {'n': 1})
+            writer.add('b-2016.01.01', 'type', {'n': 2})
+            writer.add('a-2016.01.01', 'type', {'n': 3}, doc_id='x')
+            self.assertFalse(self.conn.bulk.called)
+
+        self.assertEqual(self.conn.bulk.call_count, 2)
+        body, = self.conn.bulk.call_args_list[0][0]
+        self.assertEqual(self.conn.bulk.call_args_list[0][1],
+                         {'index': 'a-2016.01.01'})
+        self.assertEqual(body, [{'index': {'_type': 'type'}}, {'n': 1},
+                                {'index': {'_type': 'type', '_id': 'x'}},
+                                {'n': 3}])
+        self.assertEqual(writer.indexed, 3)
+        self.assertEqual(len(writer), 0)
+
+    def test_flush_thresholds(self):
+        """The buffer is flushed on the document, byte, and age limits."""
+
+        writer = BulkWriter(conn=self.conn, max_docs=2, max_bytes=1000,
+                            max_age=60)
+        writer.add('index', 'type', {'n': 1})
+        self.assertFalse(self.conn.bulk.called)
+        writer.add('index', 'type', {'n': 2})
+        self.assertEqual(self.conn.bulk.call_count, 1)
+
+        writer = BulkWriter(conn=self.conn, max_docs=100, max_bytes=10,
+                            max_age=60)
+        writer.add('index', 'type', {'text': 'x' * 20})
+        self.assertEqual(self.conn.bulk.call_count, 2)
+
+        writer = BulkWriter(conn=self.conn, max_docs=100, max_bytes=1000,
+                            max_age=0)
+        writer.add('index', 'type', {'n': 1})
+        self.assertEqual(self.conn.bulk.call_count, 3)
+
+    @patch('goldstone.drfes.bulk.time.time')
+    def test_flush_if_due(self, m_time):
+        """An idle writer's buffer is flushed once its oldest document is
+        max_age seconds old."""
+
+        m_time.return_value = 1000.0
+        writer = BulkWriter(conn=self.conn, max_docs=100, max_age=60)
+        self.assertIsNone(writer.flush_if_due())
+
+        writer.add('index', 'type', {'n': 1})
+        m_time.return_value = 1059.0
+        self.assertIsNone(writer.flush_if_due())
+        self.assertFalse(self.conn.bulk.called)
+
+        m_time.return_value = 1060.0
+        self.assertEqual(writer.flush_if_due(), (1, []))
+        self.assertEqual(len(writer), 0)
+
+    @patch('goldstone.drfes.bulk.time.sleep')
+    def test_item_retries(self, sleep):
+        """Busy items are retried, and other failures are returned."""
+
+        self.conn.bulk.side_effect = [bulk_response(200, 429, 400),
+                                      bulk_response(200)]
+
+        writer = BulkWriter(conn=self.conn, max_retries=2)
+        for i in range(3):
+            writer.add('index', 'type', {'n': i})
+        indexed, failures = writer.flush()
+
+        self.assertEqual(indexed, 2)
+        self.assertEqual([f['status'] for f in failures], [400])
+        self.assertEqual(self.conn.bulk.call_args[0][0],
+                         [{'index': {'_type': 'type'}}, {'n': 1}])
+        self.assertEqual(sleep.call_count, 1)
+
+    @patch('goldstone.drfes.bulk.time.sleep')
+    def test_item_retries_exhausted(self, sleep):
+        """An item that stays busy is returned as a failure."""
+
+        self.conn.bulk.side_effect = lambda body, index: bulk_response(429)
+
+        writer = BulkWriter(conn=self.conn, max_retries=2)
+        writer.add('index', 'type', {'n': 1})
+        indexed, failures = writer.flush()
+
+        self.assertEqual(indexed, 0)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(self.conn.bulk.call_count, 3)
+        self.assertEqual([c[0][0] for c in sleep.call_args_list],
+                         [writer.backoff, writer.backoff * 2])
+
+    @patch('goldstone.drfes.bulk.time.sleep')
+    def test_connection_retries(self, _):
+        """A request that can't reach ES is retried, then raised."""
+
+        self.conn.bulk.side_effect = [
+            elasticsearch.ConnectionError('N/A', 'down', None),
+            bulk_response(200)]
+
+        writer = BulkWriter(conn=self.conn, max_retries=1)
+        writer.add('index', 'type', {'n': 1})
+        self.assertEqual(writer.flush(), (1, []))
+
+        self.conn.bulk.side_effect = \
+            elasticsearch.ConnectionError('N/A', 'down', None)
+        writer.add('index', 'type', {'n': 1})
+        self.assertRaises(elasticsearch.ConnectionError, writer.flush)
+        self.assertEqual(len(writer), 1)
+
+    def test_failed_request_requeues(self):
+        """A request that fails puts its unsent documents, and those of the
+        indices after it, back in the buffer."""
+
+        self.conn.bulk.side_effect = [
+            bulk_response(200, 200),
+            elasticsearch.TransportError(500, 'oops'),
+            bulk_response(200, 200),
+            bulk_response(200)]
+
+        writer = BulkWriter(conn=self.conn, max_docs=100)
+        writer.add('a', 'type', {'n': 1})
+        writer.add('a', 'type', {'n': 2})
+        writer.add('b', 'type', {'n': 3})
+        writer.add('c', 'type', {'n': 4})
+
+        self.assertRaises(elasticsearch.TransportError, writer.flush)
+        self.assertEqual(writer.indexed, 2)
+        self.assertEqual(len(writer), 2)
+
+        writer.add('b', 'type', {'n': 5})
+        self.assertEqual(writer.flush(), (3, []))
+        self.assertEqual(self.conn.bulk.call_args_list[2][0][0],
+                         [{'index': {'_type': 'type'}}, {'n': 3},
+                          {'index': {'_type': 'type'}}, {'n': 5}])
+        self.assertEqual(self.conn.bulk.call_args[1], {'index': 'c'})
+        self.assertEqual(writer.indexed, 5)
+        self.assertEqual(len(writer), 0)
+
+    def test_send_outside_lock(self):
+        """A threshold flush sends its documents after releasing the
+        lock."""
+
+        writer = BulkWriter(conn=self.conn, max_docs=1)
+
+        taken = []
+
+        def take():
+            """Try to take the writer's lock."""
+            # pylint: disable=W0212
+
+            if writer._lock.acquire(False):
+                taken.append(True)
+                writer._lock.release()
+
+        def bulk(body, index):
+            """Check that another thread can take the lock."""
+            # pylint: disable=W0613
+
+            thread = threading.Thread(target=take)
+            thread.start()
+            thread.join()
+            return bulk_response(200)
+
+        self.conn.bulk.side_effect = bulk
+        writer.add('index', 'type', {'n': 1})
+        self.assertEqual(taken, [True])
+        self.assertEqual(writer.indexed, 1)
+
+    def test_save_with_writer(self):
+        """save() queues the document on a writer instead of writing it."""
+
+        writer = MagicMock()
+        doc = DailyIndexDocType(message='hello')
+
+        with patch.object(elasticsearch.Elasticsearch, 'index') as index:
+            self.assertIsNone(doc.save(index='logstash-2016.01.01',
+                                       writer=writer))
+            self.assertFalse(index.called)
+
+        writer.add.assert_called_once_with(
+            'logstash-2016.01.01', 'syslog', {'message': 'hello'},
+            doc_id=None)
+
+
+class ElasticPageNumberPaginationTests(APITestCase):
+    """Tests for the ES-native page number paginator."""
+
+    def setUp(self):
+
+        self.queryset = MagicMock()
+        for search in [self.queryset.__getitem__.return_value,
+                       self.queryset.extra.return_value]:
+            search.configure_mock(_index='logstash-*', _doc_type=[],
+                                  _params={})
+            search.to_dict.return_value = {}
+            search.execute.return_value = Response(dummy_response())
+
+    @staticmethod
+    def _request(query):
+        """Return a DRF request for the query string."""
+
+        return Request(APIRequestFactory().get('/things/' + query))
+
+    def test_one_search(self):
+        """A page is fetched by one from/size search, and counted from its
+        hits.total."""
+
+        paginator = ElasticPageNumberPagination()
+        page = paginator.paginate_queryset(
+            self.queryset, self._request('?page=2&page_size=10'))
+
+        self.assertEqual(self.queryset.__getitem__.call_count, 1)
+        self.assertEqual(self.queryset.__getitem__.call_args[0][0],
+                         slice(10, 20))
+        self.assertFalse(self.queryset.extra.called)
+        self.assertEqual(len(page.hits), 1)
+
+        response = paginator.get_paginated_response({'results': []})
+        self.assertEqual(response.data['count'], 123)
+        self.assertEqual(response.data['next'],
+                         'http://testserver/things/?page=3&page_size=10')
+        self.assertEqual(response.data['previous'],
+                         'http://testserver/things/?page_size=10')
+
+    def test_last_page(self):
+        """The last page is located from a size=0 count."""
+
+        paginator = ElasticPageNumberPagination()
+        paginator.paginate_queryset(
+            self.queryset, self._request('?page=last&page_size=10'))
+
+        self.queryset.extra.assert_called_once_with(size=0)
+        self.assertEqual(self.queryset.__getitem__.call_args[0][0],
+                         slice(120, 130))
+        self.assertIsNone(paginator.get_next_link())
+
+    def test_invalid_page(self):
+        """Bad or out-of-range page numbers are not found."""
+
+        paginator = ElasticPageNumberPagination()
+
+        for query in ['?page=0', '?page=x', '?page=50&page_size=10']:
+            self.assertRaises(NotFound, paginator.paginate_queryset,
+                              self.queryset, self._request(query))
+
+    def test_es_error(self):
+        """An ES error yields an empty first page."""
+
+        self.queryset.__getitem__.return_value.execute.side_effect = \
+            elasticsearch.TransportError(500, 'oops')
+
+        paginator = ElasticPageNumberPagination()
+        page = paginator.paginate_queryset(self.queryset,
+                                           self._request('?page=3'))
+
+        self.assertEqual(len(page.hits), 0)
+        self.assertEqual(paginator.page.paginator.count, 0)
+
+
+def hit_response(*sorts):
+    """Return a search response with one hit per sort position."""
+
+    return {"hits": {"total": 42,
+                     "hits": [{"_index": "logstash-2016.01.01",
+                               "_type": "syslog",
+                               "_id": str(i),
+                               "_source": {"n": i},
+                               "sort": sort}
+                              for i, sort in enumerate(sorts)]}}
+
+
+class ElasticCursorPaginationTests(APITestCase):
+    """Tests for the cursor paginator."""
+
+    @staticmethod
+    def _request(query):
+        """Return a DRF request for the query string."""
+
+        return Request(APIRequestFactory().get('/things/' + query))
+
+    def test_first_page(self):
+        """The first page adds the tiebreaker, and links to the next page."""
+
+        search = Search().sort('-@timestamp')
+        paginator = ElasticCursorPagination()
+
+        with patch.object(Search, 'execute') as execute:
+            execute.return_value = Response(
+                hit_response([2000, 'syslog#a'], [1000, 'syslog#b']))
+            page = paginator.paginate_queryset(
+                search, self._request('?cursor=&page_size=2'))
+
+        self.assertEqual(len(page.hits), 2)
+        response = paginator.get_paginated_response([{'n': 0}, {'n': 1}])
+        self.assertEqual(response.data['count'], 42)
+        self.assertEqual(response.data['results'], [{'n': 0}, {'n': 1}])
+        self.assertIn('cursor=', response.data['next'])
+        self.assertEqual(execute.call_count, 1)
+
+    def test_next_page(self):
+        """The cursor of one page post-filters the search of the next."""
+
+        paginator = ElasticCursorPagination()
+        first = self._request('?cursor=&page_size=2')
+        searches = []
+
+        def execute(search):
+            searches.append(search.to_dict())
+            return Response(hit_response([2000, 'syslog#a'],
+                                         [1000, 'syslog#b']))
+
+        with patch.object(Search, 'execute', autospec=True) as mock:
+            mock.side_effect = execute
+            paginator.paginate_queryset(Search().sort('-@timestamp'), first)
+            cursor = paginator.get_next_link().split('cursor=')[1]
+            paginator.paginate_queryset(
+                Search().sort('-@timestamp'),
+                self._request('?cursor=%s&page_size=2' % cursor))
+
+        self.assertEqual(searches[0]['sort'],
+                         [{'@timestamp': {'order': 'desc'}},
+                          {'_uid': {'order': 'asc'}}])
+        self.assertEqual(searches[1]['size'], 2)
+        self.assertEqual(searches[1].get('from', 0), 0)
+        self.assertEqual(searches[1]['query'], {'match_all': {}})
+        self.assertEqual(
+            searches[1]['post_filter'],
+            {'bool': {'should': [
+                {'bool': {'must': [
+                    {'range': {'@timestamp': {'lt': 1000}}}]}},
+                {'bool': {'must': [
+                    {'term': {'@timestamp': 1000}},
+                    {'range': {'_uid': {'gt': 'syslog#b'}}}]}}]}})
+
+    def test_next_page_aggregations(self):
+        """Later pages keep the whole search's aggregations and count."""
+
+        search = Search().sort('-@timestamp')
+        search.aggs.bucket('per_interval', 'date_histogram',
+                           field='@timestamp', interval='1h')
+        aggs = {'per_interval': {'buckets': [{'key': 0, 'doc_count': 42}]}}
+        searches = []
+
+        def execute(search):
+            searches.append(search.to_dict())
+            result = hit_response([2000, 'syslog#a'], [1000, 'syslog#b'])
+            # Past the first page, the post filter narrows hits.total.
+            result['aggregations'] = dict(aggs)
+            if 'post_filter' in searches[-1]:
+                result['hits']['total'] = 10
+                result['aggregations']['_cursor_total'] = {'doc_count': 42}
+            return Response(result)
+
+        pages = []
+        paginator = ElasticCursorPagination()
+
+        with patch.object(Search, 'execute', autospec=True) as mock:
+            mock.side_effect = execute
+            for query in ['?cursor=&page_size=2', None]:
+                if query is None:
+                    query = '?page_size=2&cursor=' + \
+                        paginator.get_next_link().split('cursor=')[1]
+                page = paginator.paginate_queryset(search,
+                                                   self._request(query))
+                pages.append(paginator.get_paginated_response(
+                    {'results': [], 'aggregations':
+                     page.to_dict()['aggregations']}).data)
+
+        self.assertEqual(searches[1]['aggs']['per_interval'],
+                         searches[0]['aggs']['per_interval'])
+        self.assertEqual(pages[1]['aggregations'], pages[0]['aggregations'])
+        self.assertEqual(pages[1]['aggregations'], aggs)
+        self.assertEqual([p['count'] for p in pages], [42, 42])
+
+    def test_last_page(self):
+        """A short page has no next link."""
+
+        paginator = ElasticCursorPagination()
+
+        with patch.object(Search, 'execute') as execute:
+            execute.return_value = Response(hit_response([1, 'syslog#a']))
+            paginator.paginate_queryset(
+                Search().sort('-@timestamp'),
+                self._request('?cursor=&page_size=2'))
+
+        self.assertIsNone(paginator.get_next_link())
+        self.assertIsNone(paginator.get_previous_link())
+
+    def test_invalid_cursor(self):
+        """Garbled cursors, and score sorts, are rejected."""
+
+        paginator = ElasticCursorPagination()
+
+        for cursor in ['!!!', 'eyJhIjogMX0=', 'WzFd']:
+            self.assertRaises(NotFound, paginator.paginate_queryset,
+                              Search().sort('-@timestamp'),
+                              self._request('?cursor=' + cursor))
+
+        self.assertRaises(ValidationError, paginator.paginate_queryset,
+                          Search().sort('_score'),
+                          self._request('?cursor='))
+
+
+class ExportTests(APITestCase):
+    """Tests for the streaming export helpers."""
+
+    def setUp(self):
+
+        self.conn = MagicMock()
+        self.conn.search.return_value = {'_scroll_id': 's0',
+                                         'hits': {'hits': []}}
+        self.conn.scroll.side_effect = [
+            {'_scroll_id': 's1',
+             'hits': {'hits': [{'_source': {'n': 1}}, {'_source': {'n': 2}}]}},
+            {'_scroll_id': 's2', 'hits': {'hits': [{'_source': {'n': 3}}]}},
+            {'_scroll_id': 's3', 'hits': {'hits': []}}]
+
+    def test_scan_sources(self):
+        """Every hit is scrolled out, and the scroll is cleared."""
+
+        search = Search(using=self.conn, index='logstash-*')\
+            .query('match', a='b').sort('-@timestamp')
+        search.aggs.bucket('per_interval', 'date_histogram',
+                           field='@timestamp', interval='1h')
+
+        sources = list(scan_sources(search, fields=['n'], size=10))
+
+        self.assertEqual(sources, [{'n': 1}, {'n': 2}, {'n': 3}])
+        kwargs = self.conn.search.call_args[1]
+        self.assertEqual(kwargs['body'], {'query': {'match': {'a': 'b'}},
+                                          '_source': ['n']})
+        self.assertEqual(kwargs['search_type'], 'scan')
+        self.assertEqual(kwargs['size'], 10)
+        self.conn.clear_scroll.assert_called_once_with(scroll_id='s3')
+
+    def test_scan_sources_stopped(self):
+        """Stopping early clears the scroll."""
+
+        sources = scan_sources(Search(using=self.conn), size=10)
+        next(sources)
+        sources.close()
+
+        self.assertEqual(self.conn.scroll.call_count, 1)
+        self.conn.clear_scroll.assert_called_once_with(scroll_id='s1')
+
+    def test_lines(self):
+        """Documents are formatted as NDJSON and CSV."""
+
+        docs = [{'a': 1, 'b': {'c': [1, 2]}}, {'a': None, 'd': 'x'}]
+
+        self.assertEqual(''.join(ndjson_lines(docs)).splitlines(),
+                         [json.dumps(doc) for doc in docs])
+        self.assertEqual(''.join(csv_lines(docs, ['a', 'b.c', 'd'])),
+                         'a,b.c,d\r\n1,"[1, 2]",\r\n,,x\r\n')
+        self.assertEqual(''.join(csv_lines(docs)),
+                         'a,b\r\n1,"{""c"": [1, 2]}"\r\n,\r\n')
+        self.assertEqual(list(csv_lines([])), [])
+
+    def test_column_spool(self):
+        """Columns found part way through are backfilled, and each part's
+        columns are zipped as separate, numbered members."""
+
+        directory = tempfile.mkdtemp()
+        try:
+            spool = ColumnSpool(directory)
+            spool.add({'a': 1})
+            spool.add({'a': 2, 'b': {'c': [3]}})
+            spool.close()
+
+            path = os.path.join(directory, 'out.zip')
+            self.assertEqual(write_columnar(path, [('p', spool)]), 2)
+
+            with zipfile.ZipFile(path) as archive:
+                self.assertEqual(archive.read('p/0.jsonl'), '1\n2\n')
+                self.assertEqual(archive.read('p/1.jsonl'), 'null\n[3]\n')
+                self.assertEqual(
+                    json.loads(archive.read('manifest.json'))['parts'],
+                    [{'name': 'p', 'rows': 2,
+                      'columns': [{'name': 'a', 'member': 'p/0.jsonl'},
+                                  {'name': 'b.c', 'member': 'p/1.jsonl'}]}])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_column_spool_buffer(self):
+        """Values are appended to the column files when the buffer fills,
+        without keeping the files open."""
+
+        directory = tempfile.mkdtemp()
+        try:
+            with self.settings(EXPORT_SPOOL_BUFFER=4):
+                spool = ColumnSpool(directory)
+                spool.add({'a': 1})
+                self.assertEqual(open(os.path.join(directory,
+                                                   '0.jsonl')).read(), '')
+                spool.add({'a': 2, 'b': 3})
+                self.assertEqual(open(os.path.join(directory,
+                                                   '0.jsonl')).read(),
+                                 '1\n2\n')
+                self.assertEqual(open(os.path.join(directory,
+                                                   '1.jsonl')).read(),
+                                 'null\n3\n')
+                spool.add({'a': 4})
+                spool.close()
+
+            self.assertEqual(open(os.path.join(directory, '1.jsonl')).read(),
+                             'null\n3\nnull\n')
+        finally:
+            shutil.rmtree(directory)
+
+
+class AggregationCacheTests(APITestCase):
+    """Tests for the aggregation result cache."""
+
+    def setUp(self):
+
+        self.cache = AggregationCache()
+        self.search = Search(index='logstash-2016.01.01')\
+            .query('range', **{'@timestamp': {'gte': 1451606401000,
+                                              'lte': '2016-01-01T01:00:09Z'}})
+        self.search.aggs.bucket('per_interval', 'date_histogram',
+                                field='@timestamp', interval='1h',
+                                extended_bounds={'min': 1451606401000})
+
+    def test_key(self):
+        """Keys align time bounds, and nothing else."""
+
+        later = Search(index='logstash-2016.01.01')\
+            .query('range', **{'@timestamp': {'gte': 1451606405000,
+                                              'lte': '2016-01-01T01:00:05Z'}})
+        later.aggs.bucket('per_interval', 'date_histogram',
+                          field='@timestamp', interval='1h',
+                          extended_bounds={'min': 1451606402000})
+
+        with self.settings(AGG_CACHE_ALIGNMENT=10):
+            self.assertEqual(self.cache.key(self.search),
+                             self.cache.key(later))
+            self.assertNotEqual(
+                self.cache.key(self.search),
+                self.cache.key(self.search.index('logstash-2016.01.02')))
+            self.assertNotEqual(
+                self.cache.key(Search().query('range', n={'gte': 1})),
+                self.cache.key(Search().query('range', n={'gte': 2})))
+
+            # Large numbers on fields that aren't times aren't aligned.
+            self.assertNotEqual(
+                self.cache.key(Search().query(
+                    'range', bytes={'gte': 1451606401000})),
+                self.cache.key(Search().query(
+                    'range', bytes={'gte': 1451606402000})))
+
+            # A date_histogram's field is a time field.
+            created = []
+            for start in [1451606401000, 1451606402000]:
+                search = Search().query('range', created={'gte': start})
+                search.aggs.bucket('per_interval', 'date_histogram',
+                                   field='created', interval='1h')
+                created.append(self.cache.key(search))
+            self.assertEqual(created[0], created[1])
+
+    def test_family_ttl(self):
+        """TTLs are per index family."""
+
+        with self.settings(AGG_CACHE_TTLS={'logstash-': 5, 'api_stats-': 60},
+                           AGG_CACHE_DEFAULT_TTL=30):
+            self.assertEqual(self.cache.family(self.search), 'logstash-')
+            self.assertEqual(self.cache.ttl('logstash-'), 5)
+            self.assertEqual(self.cache.ttl('api_stats-,logstash-'), 5)
+            self.assertEqual(self.cache.ttl('other'), 30)
+
+    @patch('goldstone.drfes.cache.AggregationCache._redis')
+    def test_execute(self, mock_redis):
+        """Misses are executed and stored, and hits are not executed."""
+
+        conn = mock_redis.return_value
+        conn.get.return_value = None
+        conn.pipeline.return_value.execute.return_value = [True, 1, 0, 3]
+        conn.zrange.return_value = ['old']
+
+        with patch.object(Search, 'execute') as execute, \
+                self.settings(AGG_CACHE_MAX_ENTRIES=2):
+            execute.return_value = Response(dummy_response())
+            response = self.cache.execute(self.search)
+            self.assertEqual(execute.call_count, 1)
+
+            key = self.cache.key(self.search)
+            pipe = conn.pipeline.return_value
+            pipe.set.assert_called_once_with(
+                key, json.dumps(dummy_response()), ex=15)
+            conn.zrange.assert_called_once_with(
+                AggregationCache.ENTRIES_KEY, 0, 0)
+            pipe.delete.assert_called_once_with('old')
+
+            conn.get.return_value = json.dumps(dummy_response())
+            cached = self.cache.execute(self.search)
+            self.assertEqual(execute.call_count, 1)
+
+        self.assertEqual(cached.to_dict(), response.to_dict())
+        self.assertEqual(
+            [c[0][1:] for c in pipe.hincrby.call_args_list],
+            [('misses', 1), ('misses:logstash-', 1),
+             ('hits', 1), ('hits:logstash-', 1)])
+
+    @patch('goldstone.drfes.cache.AggregationCache._redis')
+    def test_bypass(self, mock_redis):
+        """Searches without aggregations, and Redis errors, bypass the
+        cache."""
+        import redis
+
+        mock_redis.return_value.get.side_effect = redis.ConnectionError()
+
+        with patch.object(Search, 'execute') as execute:
+            self.cache.execute(Search())
+            self.assertFalse(mock_redis.called)
+
+            self.cache.execute(self.search)
+            self.assertEqual(execute.call_count, 2)
+
+
+class SingleFlightTests(APITestCase):
+    """Tests for the coalescing of identical in-flight searches."""
+
+    def setUp(self):
+
+        self.flight = SingleFlight()
+        self.search = Search(index='logstash-2016.01.01')\
+            .query('range', **{'@timestamp': {'gte': 1451606401000}})
+
+    def test_key(self):
+        """Keys align time bounds, and nothing else."""
+
+        later = Search(index='logstash-2016.01.01')\
+            .query('range', **{'@timestamp': {'gte': 1451606403000}})
+
+        with self.settings(SINGLE_FLIGHT_ALIGNMENT=5):
+            self.assertEqual(self.flight.key(self.search),
+                             self.flight.key(later))
+            self.assertNotEqual(
+                self.flight.key(self.search),
+                self.flight.key(self.search.index('logstash-2016.01.02')))
+
+    @patch('goldstone.drfes.flight.SingleFlight._redis')
+    def test_leader(self, mock_redis):
+        """The first search executes, publishes its result, and releases its
+        lease."""
+
+        conn = mock_redis.return_value
+        conn.set.return_value = True
+        # The lease is still held when it's released.
+        conn.get.side_effect = lambda name: conn.set.call_args_list[0][0][1]
+        key = self.flight.key(self.search)
+
+        with patch.object(Search, 'execute') as execute:
+            execute.return_value = Response(dummy_response())
+            response = self.flight.execute(self.search)
+
+        self.assertEqual(response.hits.total, 123)
+        lease, result = conn.set.call_args_list
+        self.assertEqual(lease[0][0], key)
+        self.assertEqual(lease[1], {'nx': True, 'ex': 30})
+        self.assertEqual(result[0][0], '%s:%s' % (key, lease[0][1]))
+        self.assertEqual(json.loads(result[0][1]), dummy_response())
+        conn.delete.assert_called_once_with(key)
+
+    @patch('goldstone.drfes.flight.time.sleep')
+    @patch('goldstone.drfes.flight.SingleFlight._redis')
+    def test_follower(self, mock_redis, mock_sleep):
+        """A duplicate search waits for and returns its leader's result."""
+
+        key = self.flight.key(self.search)
+        store = {key: 'abc'}
+        polls = []
+
+        def get(name):
+            """Publish the result on the second poll."""
+
+            if name == key + ':abc':
+                polls.append(name)
+                if len(polls) > 1:
+                    return json.dumps(dummy_response())
+            return store.get(name)
+
+        conn = mock_redis.return_value
+        conn.set.return_value = None
+        conn.get.side_effect = get
+
+        with patch.object(Search, 'execute') as execute:
+            response = self.flight.execute(self.search)
+            self.assertFalse(execute.called)
+
+        self.assertEqual(response.hits.total, 123)
+        self.assertEqual(mock_sleep.call_count, 1)
+
+        # If the leader releases its lease without a result, the follower
+        # executes.  The gets are of the lease's token, the result, the
+        # lease, and the result.
+        with patch.object(Search, 'execute') as execute:
+            conn.get.side_effect = ['abc', None, None, None]
+            self.flight.execute(self.search)
+            self.assertEqual(execute.call_count, 1)
+
+    @patch('goldstone.drfes.flight.time.time')
+    @patch('goldstone.drfes.flight.time.sleep')
+    @patch('goldstone.drfes.flight.SingleFlight._redis')
+    def test_follower_max_wait(self, mock_redis, mock_sleep, mock_time):
+        """A follower of a slow leader stops waiting after
+        SINGLE_FLIGHT_MAX_WAIT seconds, and executes."""
+
+        clock = [1000.0]
+        mock_time.side_effect = lambda: clock[0]
+        mock_sleep.side_effect = lambda seconds: clock.__setitem__(
+            0, clock[0] + 1)
+
+        key = self.flight.key(self.search)
+        conn = mock_redis.return_value
+        conn.set.return_value = None
+        conn.get.side_effect = lambda name: 'abc' if name == key else None
+
+        with patch.object(Search, 'execute') as execute, \
+                self.settings(SINGLE_FLIGHT_MAX_WAIT=3,
+                              SINGLE_FLIGHT_LEASE=30):
+            self.flight.execute(self.search)
+            self.assertEqual(execute.call_count, 1)
+
+        self.assertEqual(mock_sleep.call_count, 3)
+
+    @patch('goldstone.drfes.flight.SingleFlight._redis')
+    def test_bypass(self, mock_redis):
+        """Redis errors, and disabling, execute the search directly."""
+        import redis
+
+        mock_redis.return_value.set.side_effect = redis.ConnectionError()
+
+        with patch.object(Search, 'execute') as execute:
+            self.flight.execute(self.search)
+
+            with self.settings(SINGLE_FLIGHT_ENABLED=False):
+                self.flight.execute(self.search)
+
+            self.assertEqual(execute.call_count, 2)
+            self.assertEqual(mock_redis.call_count, 1)
+
+
+def histogram_response(*buckets):
+    """Return a search response with a per_interval histogram of (key,
+    doc_count) buckets."""
+
+    return {'_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'timed_out': False,
+            'hits': {'total': sum(count for _, count in buckets),
+                     'hits': []},
+            'aggregations': {'per_interval': {'buckets': [
+                {'key': key, 'doc_count': count}
+                for key, count in buckets]}}}
+
+
+class IncrementalHistogramTests(APITestCase):
+    """Tests for the incremental histogram."""
+
+    HOUR = 3600 * 1000
+
+    def setUp(self):
+
+        self.histogram = IncrementalHistogram()
+        self.store = {}
+
+        conn = MagicMock()
+        conn.hmget.side_effect = \
+            lambda key, fields: [self.store.get(f) for f in fields]
+        conn.pipeline.return_value.hmset.side_effect = \
+            lambda key, mapping: self.store.update(mapping)
+
+        patcher = patch('goldstone.drfes.histogram.IncrementalHistogram'
+                        '._redis', return_value=conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _search(self, start, end):
+        """Return a histogram search over [start, end]."""
+
+        return DailyIndexDocType.simple_datehistogram_agg(
+            Search(index='logstash-*').query(
+                'range', **{'@timestamp': {'gte': start, 'lte': end}}),
+            '1h', bounds_min=start, bounds_max=end)
+
+    def test_interval_ms(self):
+        """Only fixed-length intervals are handled."""
+
+        self.assertEqual(interval_ms('3600s'), self.HOUR)
+        self.assertEqual(interval_ms('1.5h'), self.HOUR * 3 / 2)
+        self.assertIsNone(interval_ms('1w'))
+        self.assertIsNone(interval_ms('0s'))
+
+    @patch('goldstone.drfes.histogram.agg_cache')
+    def test_refresh(self, mock_cache):
+        """A refresh only searches the buckets that aren't stored."""
+
+        def hour(n):
+            """Return the epoch ms of the nth hour of 2016."""
+            return 1451606400000 + n * self.HOUR
+
+        start, end = hour(10) + 5, hour(14) + 5
+        now = (end + 600 * 1000) / 1000.0
+
+        mock_cache.execute.return_value = Response(histogram_response(
+            *[(hour(n), n) for n in range(10, 15)]))
+        first = self.histogram.execute(self._search(start, end),
+                                       'per_interval', '@timestamp', '1h',
+                                       start, end, now=now)
+
+        # The partial first bucket and the open last one aren't stored.
+        self.assertEqual(sorted(self.store), [hour(11), hour(12), hour(13)])
+        self.assertEqual([b.doc_count
+                          for b in first.aggregations.per_interval.buckets],
+                         [10, 11, 12, 13, 14])
+
+        # An hour later, only the edges are searched.
+        mock_cache.execute.return_value = Response(histogram_response(
+            (hour(11), 111), (hour(12), 0), (hour(13), 0),
+            (hour(14), 114), (hour(15), 115)))
+        second = self.histogram.execute(
+            self._search(start + self.HOUR, end + self.HOUR), 'per_interval',
+            '@timestamp', '1h', start + self.HOUR, end + self.HOUR,
+            now=now + 3600)
+
+        searched = mock_cache.execute.call_args[0][0].to_dict()
+        self.assertEqual(
+            searched['query']['filtered']['filter'],
+            {'bool': {'should': [
+                {'range': {'@timestamp': {'gte': hour(11), 'lt': hour(12)}}},
+                {'range': {'@timestamp': {'gte': hour(14),
+                                          'lt': hour(16)}}}]}})
+        self.assertEqual([b.doc_count
+                          for b in second.aggregations.per_interval.buckets],
+                         [111, 12, 13, 114, 115])
+
+    @patch('goldstone.drfes.histogram.agg_cache')
+    def test_fallback(self, mock_cache):
+        """Calendar intervals and open ranges get a plain search."""
+
+        search = self._search(0, self.HOUR)
+
+        self.histogram.execute(search, 'per_interval', '@timestamp', '1w',
+                               0, self.HOUR)
+        self.histogram.execute(search, 'per_interval', '@timestamp', '1h',
+                               None, self.HOUR)
+
+        self.assertEqual(mock_cache.execute.call_args_list,
+                         [((search,), {}), ((search,), {})])
+        self.assertEqual(self.store, {})
+
+
+class RollupTests(APITestCase):
+    """Tests for rollups and the rollup router."""
+
+    MINUTE = 60 * 1000
+    HOUR = 3600 * 1000
+    T0 = 1451606400000
+
+    def setUp(self):
+
+        self.rollups = Rollups()
+        self.source = self.rollups.sources()['api_stats']
+        self.watermarks = {}
+
+        self.conn = MagicMock()
+        self.conn.hget.side_effect = \
+            lambda key, field: self.watermarks.get(field)
+
+        patcher = patch('goldstone.drfes.rollup.Rollups._redis',
+                        return_value=self.conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Don't ask the cluster for its indices.
+        patcher = patch('goldstone.models.es_indices_for_range',
+                        return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _search(self, start, end, interval='1h', query=None):
+        """Return an API call search over [start, end]."""
+
+        search = Search(index='api_stats-*', doc_type='api_stats').query(
+            'range', **{'@timestamp': {'gte': start, 'lte': end}})
+        if query is not None:
+            search = search.query('match', **query)
+
+        search.aggs.bucket('per_interval', 'date_histogram',
+                           field='@timestamp', interval=interval,
+                           min_doc_count=0) \
+            .metric('statistics', 'stats', field='response_time')
+        search.aggs.bucket('all_status', 'terms', field='response_status',
+                           size=0)
+        return search
+
+    def test_documents(self):
+        """A summary search's buckets become rollup documents."""
+
+        histogram = {'buckets': {'lt_0_05': {'doc_count': 1},
+                                 'inf': {'doc_count': 1}}}
+        stats = {'count': 2, 'sum': 10.5, 'min': 0.5, 'max': 10.0,
+                 'avg': 5.25}
+        summary = {'aggregations': {'per_bucket': {'buckets': [{
+            'key': self.T0,
+            'doc_count': 3,
+            '_missing_component': {'doc_count': 0},
+            'component': {'buckets': [{
+                'key': 'nova',
+                'doc_count': 3,
+                'response_status': {'buckets': [{
+                    'key': 200, 'doc_count': 2, 'stats': stats,
+                    'histogram': histogram}]},
+                '_missing_response_status': {
+                    'doc_count': 1,
+                    'stats': {'count': 0, 'sum': None, 'min': None,
+                              'max': None, 'avg': None},
+                    'histogram': {'buckets': {}}}}]}}]}}}
+
+        docs = list(self.source.documents(Response(summary), '1m'))
+
+        self.assertEqual([index for index, _, _ in docs],
+                         ['rollup_api_stats_1m-2016.01.01'] * 2)
+        self.assertEqual(len(set(doc_id for _, doc_id, _ in docs)), 2)
+        self.assertEqual(docs[0][2], {
+            '@timestamp': self.T0, 'component': 'nova',
+            'response_status': 200, 'count': 2, 'value_count': 2,
+            'sum': 10.5, 'min': 0.5, 'max': 10.0,
+            'histogram': {'lt_0_05': 1, 'inf': 1}})
+        self.assertEqual(docs[1][2], {
+            '@timestamp': self.T0, 'component': 'nova', 'count': 1,
+            'histogram': {}})
+
+    def test_update(self):
+        """An update rolls up the closed buckets since the last one."""
+
+        now = (self.T0 + 10 * self.MINUTE + 30000) / 1000.0
+        summary = MagicMock()
+        summary.execute.return_value = Response(
+            {'_shards': {'total': 1, 'successful': 1, 'failed': 0},
+             'timed_out': False,
+             'aggregations': {'per_bucket': {'buckets': []}}})
+
+        with patch('goldstone.drfes.rollup.RollupSource.summary_search',
+                   return_value=summary) as mock_search, \
+                patch('goldstone.drfes.bulk.BulkWriter') as mock_writer, \
+                self.settings(ROLLUP_INITIAL_LOOKBACK=600):
+            mock_writer.return_value.failed = 0
+            mock_writer.return_value.indexed = 0
+
+            self.rollups.update(self.source, '1m', now=now)
+
+        # The first run starts ROLLUP_INITIAL_LOOKBACK ago, and stops at
+        # the last bucket that's ROLLUP_GRACE_PERIOD old.
+        mock_search.assert_called_once_with(
+            self.T0, self.T0 + 8 * self.MINUTE, '1m')
+        self.conn.hset.assert_called_once_with(
+            Rollups.WATERMARKS_KEY, 'api_stats:1m',
+            json.dumps({'start': self.T0, 'end': self.T0 + 8 * self.MINUTE}))
+
+    @patch('goldstone.drfes.rollup.agg_cache')
+    def test_plan(self, mock_cache):
+        """The rolled-up part of a range comes from the rollups, and the rest
+        from the raw documents."""
+
+        def hour(n):
+            """Return the epoch ms of the nth hour of 2016."""
+            return self.T0 + n * self.HOUR
+
+        def stats(count, total):
+            """Return a stats result."""
+            return {'count': count, 'sum': total, 'min': 0.1, 'max': 2.0,
+                    'avg': total / count}
+
+        def rolled(key, count, total):
+            """Return a rolled-up histogram bucket."""
+            return {'key': key,
+                    'doc_count': 99,
+                    '_rollup_count': {'value': float(count)},
+                    '_rollup_count_statistics': {'value': float(count)},
+                    '_rollup_sum_statistics': {'value': total},
+                    '_rollup_min_statistics': {'value': 0.1},
+                    '_rollup_max_statistics': {'value': 2.0}}
+
+        self.watermarks['api_stats:1h'] = \
+            json.dumps({'start': hour(-24), 'end': hour(4)})
+
+        search = self._search(hour(0) + 1800000, hour(5) + 600000)
+        plan = self.rollups.plan(search, hour(0) + 1800000,
+                                 hour(5) + 600000)
+
+        # The unaligned start and the recent end are searched raw.
+        self.assertEqual((plan.resolution, plan.head_start, plan.head_end),
+                         ('1h', hour(1), hour(4)))
+        raw = plan.raw_search.to_dict()['aggs']['_rollup_raw']
+        self.assertEqual(raw['filter'], {'bool': {'must_not': [{'range': {
+            '@timestamp': {'gte': hour(1), 'lt': hour(4)}}}]}})
+        body = plan.rollup_search.to_dict()
+        self.assertEqual(plan.rollup_search._index,
+                         ['rollup_api_stats_1h-*'])
+        self.assertEqual(
+            body['aggs']['per_interval']['aggs']['_rollup_count'],
+            {'sum': {'field': 'count'}})
+
+        mock_cache.execute.return_value = Response({
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'timed_out': False,
+            'hits': {'total': 60, 'hits': []},
+            'aggregations': {
+                'per_interval': {'buckets': [rolled(hour(n), 10 * n, 1.0 * n)
+                                             for n in (1, 2, 3)]},
+                'all_status': {'buckets': [
+                    {'key': 200, 'doc_count': 2,
+                     '_rollup_count': {'value': 50.0}},
+                    {'key': 500, 'doc_count': 1,
+                     '_rollup_count': {'value': 10.0}}]}}})
+
+        response = plan.merge(Response({
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'timed_out': False,
+            'hits': {'total': 100, 'hits': []},
+            'aggregations': {'_rollup_raw': {
+                'doc_count': 40,
+                'per_interval': {'buckets': [
+                    {'key': hour(0), 'doc_count': 5,
+                     'statistics': stats(5, 2.5)},
+                    {'key': hour(4), 'doc_count': 15,
+                     'statistics': stats(15, 3.0)},
+                    {'key': hour(5), 'doc_count': 20,
+                     'statistics': stats(20, 4.0)}]},
+                'all_status': {'buckets': [
+                    {'key': 200, 'doc_count': 35},
+                    {'key': 404, 'doc_count': 5}]}}}}))
+
+        self.assertEqual(response.hits.total, 100)
+        buckets = response.aggregations.per_interval.buckets
+        self.assertEqual([(b.key, b.doc_count) for b in buckets],
+                         [(hour(n), count) for n, count in
+                          enumerate([5, 10, 20, 30, 15, 20])])
+        self.assertEqual(buckets[2].statistics.to_dict(),
+                         {'count': 20, 'sum': 2.0, 'min': 0.1, 'max': 2.0,
+                          'avg': 0.1})
+        self.assertEqual(
+            [(b.key, b.doc_count)
+             for b in response.aggregations.all_status.buckets],
+            [(200, 85), (500, 10), (404, 5)])
+        self.assertNotIn('_rollup_raw', response.aggregations)
+
+    def test_no_plan(self):
+        """Searches that the rollups can't answer aren't routed."""
+
+        start, end = self.T0, self.T0 + 24 * self.HOUR
+        self.watermarks['api_stats:1m'] = \
+            json.dumps({'start': start, 'end': end})
+        self.watermarks['api_stats:1h'] = \
+            json.dumps({'start': start, 'end': end})
+
+        self.assertIsNotNone(
+            self.rollups.plan(self._search(start, end), start, end))
+
+        # Fine intervals, fields that aren't dimensions, open ranges.
+        self.assertIsNone(self.rollups.plan(
+            self._search(start, end, interval='30s'), start, end))
+        self.assertIsNone(self.rollups.plan(
+            self._search(start, end, query={'uri': '/v2'}), start, end))
+        self.assertIsNone(self.rollups.plan(
+            self._search(start, end), None, end))
+
+        # Aggregations that aren't rolled up.
+        search = self._search(start, end)
+        search.aggs['per_interval'].metric(
+            'latency', 'percentiles', field='response_time')
+        self.assertIsNone(self.rollups.plan(search, start, end))
+
+        # Ranges that haven't been rolled up.
+        self.watermarks.clear()
+        self.assertIsNone(
+            self.rollups.plan(self._search(start, end), start, end))
@@ -18,9 +18,13 @@ from rest_framework.exceptions import ValidationError
 from rest_framework.generics import ListAPIView
 from rest_framework.response import Response
 from goldstone.drfes.filters import ElasticFilter
-from goldstone.drfes.pagination import ElasticPageNumberPagination
+from goldstone.drfes.histogram import incremental_histogram
+from goldstone.drfes.pagination import ElasticCursorPagination, \
+    ElasticPageNumberPagination
+from goldstone.drfes.rollup import rollups
 from goldstone.drfes.serializers import ReadOnlyElasticSerializer, \
     SimpleAggSerializer, DateHistogramAggSerializer
+from goldstone.models import es_route_search
 
 
 class ElasticListAPIView(ListAPIView):
@@ -28,12 +32,33 @@ class ElasticListAPIView(ListAPIView):
 
     serializer_class = ReadOnlyElasticSerializer
     pagination_class = ElasticPageNumberPagination
+    cursor_pagination_class = ElasticCursorPagination
     filter_backends = (ElasticFilter, )
     reserved_params = ['page_size', 'page']
 
     class Meta:            # pylint: disable=C0111,C1001,W0232
         model = None
 
+    @property
+    def paginator(self):
+        """The paginator instance for this request.
+
+        A request with a cursor parameter is paged by cursor, and any other
+        request by page number.
+
+        """
+
+        if not hasattr(self, '_paginator'):
+            cursor_class = self.cursor_pagination_class
+            if cursor_class is not None and \
+                    cursor_class.cursor_query_param in \
+                    self.request.query_params:
+                self._paginator = cursor_class()
+            else:
+                return super(ElasticListAPIView, self).paginator
+
+        return self._paginator
+
     def get_queryset(self):
         """Gets a search object from the model."""
 
@@ -75,7 +100,16 @@ class DateHistogramAggView(ElasticListAPIView):
         """Handle get request."""
 
         search = self._get_search(request)
-        serializer = self.serializer_class(search.execute().aggregations)
+
+        # Coarse intervals are answered from rollups where there are any.
+        plan = rollups.plan(search, self.start, self.end)
+        if plan is not None:
+            response = plan.execute()
+        else:
+            response = incremental_histogram.execute(
+                search, self.AGG_NAME, self.AGG_FIELD, self.interval,
+                self.start, self.end)
+        serializer = self.serializer_class(response.aggregations)
         return Response(serializer.data)
 
     def _get_search(self, request):
@@ -95,6 +129,13 @@ class DateHistogramAggView(ElasticListAPIView):
 
         bounds_min, bounds_max = (None, None) if range_param is None else \
             self._extract_time_range(range_param)
+        self.start, self.end = bounds_min, bounds_max
+
+        # only search the daily indices that overlap the requested range.
+        prefix = getattr(self.Meta.model, 'INDEX_PREFIX', None)
+        if range_param is not None and prefix is not None:
+            base_queryset = es_route_search(base_queryset, prefix,
+                                            bounds_min, bounds_max)
 
         return self.Meta.model.simple_datehistogram_agg(
             base_queryset,
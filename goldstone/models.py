@@ -13,55 +13,541 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import logging
+import os
+import re
+import threading
+import time
+
 from django.conf import settings
+from elasticsearch import Elasticsearch, ElasticsearchException, \
+    Urllib3HttpConnection
 from elasticsearch_dsl.connections import connections
 import redis
 
 logger = logging.getLogger(__name__)
 
 
+class PooledHttpConnection(Urllib3HttpConnection):
+    """An Elasticsearch HTTP connection that survives forks and counts its
+    traffic.
+
+    The urllib3 pool is rebuilt the first time the connection is used in a
+    new process, so a client created before a gunicorn or Celery fork never
+    shares sockets with its parent.
+
+    :arg keepalive: keep connections open between requests
+    :arg http_compress: ask Elasticsearch for gzip-compressed responses
+
+    """
+
+    def __init__(self, keepalive=True, http_compress=False, **kwargs):
+
+        self._init_kwargs = kwargs
+        self._pid = os.getpid()
+        self.keepalive = keepalive
+        self.http_compress = http_compress
+        self.maxsize = kwargs.get('maxsize', 10)
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._build()
+
+    def _build(self):
+        """(Re)create the underlying urllib3 pool."""
+
+        super(PooledHttpConnection, self).__init__(**self._init_kwargs)
+
+        self.headers['connection'] = \
+            'keep-alive' if self.keepalive else 'close'
+        if self.http_compress:
+            self.headers['accept-encoding'] = 'gzip,deflate'
+
+    def perform_request(self, *args, **kwargs):
+        """Perform a request, rebuilding the pool first if we were forked."""
+
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.requests = self.in_flight = self.peak_in_flight = 0
+            self._build()
+
+        self.requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+        try:
+            return super(PooledHttpConnection, self).perform_request(
+                *args, **kwargs)
+        finally:
+            self.in_flight -= 1
+
+    def stats(self):
+        """Return the utilization of this connection's pool.
+
+        :rtype: dict
+
+        """
+
+        idle = [conn for conn in list(getattr(self.pool.pool, 'queue', []))
+                if conn is not None] if self.pool.pool is not None else []
+
+        return {'host': self.host,
+                'maxsize': self.maxsize,
+                'opened': getattr(self.pool, 'num_connections', 0),
+                'idle': len(idle),
+                'in_use': self.in_flight,
+                'peak_in_use': self.peak_in_flight,
+                'requests': self.requests}
+
+
+class ConnectionManager(object):
+    """Hands out one long-lived Elasticsearch client per process and server
+    definition.
+
+    Clients are configured from the ES_POOL_MAXSIZE, ES_KEEPALIVE,
+    ES_HTTP_COMPRESS, ES_TIMEOUT, ES_MAX_RETRIES and ES_SNIFF_* settings.  The
+    client for settings.ES_SERVER is also registered as elasticsearch_dsl's
+    default connection.
+
+    """
+
+    def __init__(self):
+
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(server):
+        """Return a hashable key for a server definition."""
+
+        return os.getpid(), json.dumps(server, sort_keys=True)
+
+    @staticmethod
+    def _build(server):
+        """Return a new client for a server definition."""
+
+        kwargs = {
+            'connection_class': PooledHttpConnection,
+            'maxsize': settings.ES_POOL_MAXSIZE,
+            'keepalive': settings.ES_KEEPALIVE,
+            'http_compress': settings.ES_HTTP_COMPRESS,
+            'timeout': settings.ES_TIMEOUT,
+            'max_retries': settings.ES_MAX_RETRIES,
+            'sniff_on_start': settings.ES_SNIFF_ON_START,
+            'sniff_on_connection_fail': settings.ES_SNIFF_ON_CONNECTION_FAIL,
+            'sniffer_timeout': settings.ES_SNIFFER_TIMEOUT,
+        }
+        kwargs.update(server)
+
+        return Elasticsearch(**kwargs)
+
+    def get(self, server):
+        """Return this process's client for a server definition."""
+
+        key = self._key(server)
+        client = self._clients.get(key)
+
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    # drop clients inherited from a parent process.
+                    for stale in [k for k in self._clients
+                                  if k[0] != key[0]]:
+                        del self._clients[stale]
+
+                    client = self._build(server)
+                    self._clients[key] = client
+
+                    if server == settings.ES_SERVER:
+                        connections.add_connection('default', client)
+
+        return client
+
+    def stats(self):
+        """Return pool utilization for this process's clients.
+
+        :rtype: dict
+
+        """
+
+        pid = os.getpid()
+        result = {'pid': pid, 'clients': []}
+
+        for key, client in self._clients.items():
+            if key[0] != pid:
+                continue
+
+            result['clients'].append({
+                'server': json.loads(key[1]),
+                'connections': [
+                    conn.stats()
+                    for conn in client.transport.connection_pool.connections
+                    if isinstance(conn, PooledHttpConnection)]
+            })
+
+        return result
+
+# The process-wide instance.
+es_connection_manager = ConnectionManager()      # pylint: disable=C0103
+
+
 def es_conn(server=settings.ES_SERVER):
     """Standardized connection to the ES cluster.
 
+    The client is created once per process and server definition, so its
+    connection pool and keep-alive connections are reused across calls.
+
     :param server: a server definition of the form [host:port, ...].  See
     https://elasticsearch-py.readthedocs.org/en/master/api.html#elasticsearch
     for alternate host specification options.
     :return: an Elasticsearch connection instance
     """
 
-    connections.configure(default=server,
-                          max_retries=1,
-                          sniff_on_start=False)
-    return connections.get_connection()
+    return es_connection_manager.get(server)
+
+
+def es_conn_stats():
+    """Return connection pool utilization for this process.
+
+    :rtype: dict
+
+    """
+
+    return es_connection_manager.stats()
 
 
-def es_indices(prefix="", conn=None):
+def es_indices(prefix="", conn=None, new_days=True):
     """ es_indices gets a potentially filtered list of index names.
 
+    Index names are served from the index catalog, so this only talks to the
+    cluster when the catalog is stale.  Daily indices newer than the
+    catalog's newest one are included as wildcards, since they may have been
+    created after the catalog was built.
+
     :type prefix: str
     :param prefix: the prefix to filter for
     :type conn: Elasticsearch
     :param conn: an ES connection object
-    :return: _all or list of index names
+    :type new_days: bool
+    :param new_days: include the wildcards.  Requests that fail on a wildcard
+                     that matches nothing (allow_no_indices=False) pass False
+    :return: _all, a list of index names, or None if nothing matches
 
     """
 
     if prefix is not "":
-        if prefix.endswith("*"):
-            prefix = prefix.replace("*", "")
-        if conn is None:
-            conn = es_conn()
-
-        all_indices = conn.indices.status()['indices'].keys()
-        for index in all_indices:
-            if index.startswith(prefix):
-                return index
-        return None
+        entries = index_catalog.indices(prefix, conn=conn)
+        names = [entry['name'] for entry in entries]
+        dated = [entry for entry in entries if entry['date'] is not None]
+        if dated and new_days:
+            names.extend(_new_day_patterns(dated[-1]))
+        return names if names else None
     else:
         return "_all"
 
 
+def es_latest_index(prefix, conn=None):
+    """Return the newest index name that matches a prefix.
+
+    This is used where Elasticsearch needs exactly one index, such as getting
+    or deleting a document by id.
+
+    :type prefix: str
+    :param prefix: the prefix to filter for
+    :type conn: Elasticsearch
+    :param conn: an ES connection object
+    :return: an index name, or None if nothing matches
+
+    """
+
+    names = index_catalog.names(prefix, conn=conn)
+    return names[-1] if names else None
+
+
+def _as_arrow(value):
+    """Return a time bound as an Arrow object, or None if it can't be parsed.
+
+    Bounds can be Arrow or datetime objects, ISO 8601 strings, or epoch
+    seconds or milliseconds (the client sends milliseconds).
+
+    """
+    import arrow
+    from arrow import Arrow
+
+    if value is None or value == '':
+        return None
+
+    if isinstance(value, Arrow):
+        return value
+
+    try:
+        if isinstance(value, basestring) and value.isdigit():
+            value = int(value)
+
+        if isinstance(value, (int, long, float)):
+            return arrow.get(value / 1000.0 if value > 1e11 else value)
+
+        return arrow.get(value)
+    except Exception:         # pylint: disable=W0703
+        return None
+
+
+def es_indices_for_range(prefix, start=None, end=None, conn=None):
+    """Return the daily indices of a prefix that can hold documents in a time
+    range.
+
+    The range is widened by ES_INDEX_ROUTING_MARGIN seconds on each side to
+    allow for late-arriving documents.  Indices without a date suffix are
+    always included.  Daily indices newer than the catalog's newest one are
+    included as wildcards, since they may have been created after the catalog
+    was built; many such days are collapsed into per-month wildcards, or one
+    for the whole prefix.
+
+    :type prefix: str
+    :param prefix: the index prefix, with or without a wildcard
+    :param start: the start of the range, or None for an open start
+    :param end: the end of the range, or None for an open end
+    :type conn: Elasticsearch
+    :param conn: an ES connection object
+    :return: a list of index names, or None if the search can't be narrowed
+
+    """
+
+    start = _as_arrow(start)
+    end = _as_arrow(end)
+
+    if start is None and end is None:
+        return None
+
+    try:
+        entries = index_catalog.indices(prefix, conn=conn)
+    except (ElasticsearchException, redis.RedisError):
+        logger.warning("could not route %s by time range", prefix)
+        return None
+
+    dated = [entry for entry in entries if entry['date'] is not None]
+    if not dated:
+        return None
+
+    margin = settings.ES_INDEX_ROUTING_MARGIN
+    first = None if start is None \
+        else start.replace(seconds=-margin).format('YYYY-MM-DD')
+    last = None if end is None \
+        else end.replace(seconds=margin).format('YYYY-MM-DD')
+
+    names = [entry['name'] for entry in entries
+             if entry['date'] is None or
+             ((first is None or entry['date'] >= first) and
+              (last is None or entry['date'] <= last))]
+
+    # Add wildcards for days that the catalog doesn't know about yet.
+    names.extend(_new_day_patterns(dated[-1], first, last))
+
+    return names if names else None
+
+
+def _new_day_patterns(newest, first=None, last=None):
+    """Return the wildcards that cover the daily indices newer than the
+    catalog's newest one, up to today.
+
+    :type newest: dict
+    :param newest: the catalog entry of the newest daily index
+    :type first: str
+    :param first: the first day (YYYY-MM-DD) to cover, or None
+    :type last: str
+    :param last: the last day (YYYY-MM-DD) to cover, or None for today
+    :rtype: list
+
+    """
+    import arrow
+
+    index_prefix = IndexCatalog.index_prefix(newest['name'])
+    separator = '-' if newest['name'][-6] == '-' else '.'
+    today = arrow.utcnow().format('YYYY-MM-DD')
+    day = arrow.get(newest['date']).replace(days=1)
+    if first is not None and day.format('YYYY-MM-DD') < first:
+        day = arrow.get(first)
+
+    missing = []
+    while day.format('YYYY-MM-DD') <= min(last or today, today):
+        missing.append(day)
+        day = day.replace(days=1)
+
+    return _missing_day_patterns(index_prefix, separator, missing)
+
+
+def _missing_day_patterns(index_prefix, separator, days):
+    """Return the wildcards that cover the daily indices of some days.
+
+    There is one wildcard per day, per month if there are more than
+    ES_INDEX_ROUTING_MAX_WILDCARDS days, or one for the whole prefix if there
+    are also more than that many months.
+
+    :type index_prefix: str
+    :param index_prefix: the daily indices' name before the date
+    :type separator: str
+    :param separator: the separator of the date's parts
+    :type days: list
+    :param days: the days, as Arrow objects in ascending order
+    :rtype: list
+
+    """
+
+    limit = settings.ES_INDEX_ROUTING_MAX_WILDCARDS
+    day_fmt = separator.join(['YYYY', 'MM', 'DD'])
+    month_fmt = separator.join(['YYYY', 'MM'])
+
+    if len(days) <= limit:
+        return [index_prefix + day.format(day_fmt) + '*' for day in days]
+
+    months = []
+    for day in days:
+        month = day.format(month_fmt)
+        if not months or months[-1] != month:
+            months.append(month)
+
+    if len(months) <= limit:
+        return [index_prefix + month + separator + '*' for month in months]
+
+    return [index_prefix + '*']
+
+
+def es_route_search(search, prefix, start=None, end=None, conn=None):
+    """Return a search restricted to the daily indices of a prefix that
+    overlap a time range.
+
+    If the indices can't be narrowed, the search is returned unchanged.
+
+    :type search: Search
+    :param search: the search to route
+    :type prefix: str
+    :param prefix: the index prefix, with or without a wildcard
+    :param start: the start of the range, or None for an open start
+    :param end: the end of the range, or None for an open end
+    :rtype: Search
+
+    """
+
+    indices = es_indices_for_range(prefix, start, end, conn=conn)
+
+    if indices is None:
+        return search
+
+    return search.index().index(*indices)
+
+
+def es_snap_range(start=None, end=None, granularity=None, round_end='up'):
+    """Return a time range with its bounds snapped to whole multiples of a
+    granularity.
+
+    Ranges that end "now" are otherwise different in every request, so ES
+    can never answer them from its caches.  The start is rounded down, and
+    the end is rounded up (which covers the original range) or down (which
+    leaves the remainder for the next window of a sliding search).
+
+    :param start: the start of the range, or None for an open start
+    :type start: Arrow
+    :param end: the end of the range, or None for an open end
+    :type end: Arrow
+    :param granularity: seconds, or a fixed-length interval such as "5m".
+                        If None, or a calendar interval, ES_RANGE_GRANULARITY
+    :param round_end: "up" or "down"
+    :type round_end: str
+    :return: the snapped start and end
+    :rtype: tuple of Arrow
+
+    """
+    from arrow import Arrow
+    from goldstone.drfes.histogram import interval_ms
+
+    if isinstance(granularity, basestring):
+        step = interval_ms(granularity)
+        granularity = step // 1000 if step is not None else None
+    if not granularity:
+        granularity = settings.ES_RANGE_GRANULARITY
+    if not granularity:
+        return start, end
+
+    def _snap(bound, up):
+        """Round a bound to the granularity."""
+
+        if bound is None:
+            return None
+
+        seconds = bound.timestamp - bound.timestamp % granularity
+        if up and (seconds != bound.timestamp or bound.microsecond):
+            seconds += granularity
+
+        return Arrow.utcfromtimestamp(seconds).to(bound.tzinfo)
+
+    return _snap(start, False), _snap(end, round_end == 'up')
+
+
+def es_aggregation_only(search):
+    """Return a search that only returns aggregations, and can be answered
+    from ES's shard request cache.
+
+    :type search: Search
+    :rtype: Search
+
+    """
+
+    return search.extra(size=0).params(**settings.ES_REQUEST_CACHE_PARAMS)
+
+
+def es_multi_search(searches, conn=None, chunk_size=None):
+    """Run several searches through the _msearch endpoint.
+
+    The searches are sent in requests of up to chunk_size searches each.  The
+    result is a list of raw response dicts in the same order as the searches.
+    A search that failed, or that was in a request that failed, gets a dict
+    with an 'error' key instead of a response.
+
+    :type searches: list of Search
+    :param searches: the searches to run
+    :param conn: the ES client.  If None, es_conn() is used
+    :type chunk_size: int
+    :param chunk_size: the most searches to send in one request.  If None,
+                       ES_MSEARCH_CHUNK_SIZE is used
+    :rtype: list of dict
+
+    """
+
+    if conn is None:
+        conn = es_conn()
+
+    if chunk_size is None:
+        chunk_size = settings.ES_MSEARCH_CHUNK_SIZE
+
+    responses = []
+
+    for offset in range(0, len(searches), chunk_size):
+        chunk = searches[offset:offset + chunk_size]
+        body = []
+
+        for search in chunk:
+            header = dict((k, v) for k, v in search._params.items()
+                          if k in ('search_type', 'preference', 'routing',
+                                   'query_cache', 'request_cache'))
+            if search._index:
+                header['index'] = ','.join(search._index)
+            if search._doc_type:
+                header['type'] = ','.join(search._doc_type)
+
+            body.extend([header, search.to_dict()])
+
+        try:
+            responses.extend(conn.msearch(body)['responses'])
+        except ElasticsearchException as exc:
+            logger.warning("multi-search of %d searches failed: %s",
+                           len(chunk), exc)
+            responses.extend({'error': str(exc)} for _ in chunk)
+
+    return responses
+
+
 def daily_index(prefix=""):
     """Generate a daily index name of the form prefix-yyyy.mm.dd. When calling
     the index method of an ES connection, the target index will be created if
@@ -90,3 +576,164 @@ class RedisConnection(object):
                  db=settings.REDIS_DB):
 
         self.conn = redis.StrictRedis(host=host, port=port, db=db)
+
+
+class IndexCatalog(object):
+    """A cached catalog of the cluster's indices.
+
+    Each entry records an index's name, its date (parsed from a YYYY.MM.DD or
+    YYYY-MM-DD suffix), and its primary doc count and store size.  Lookups are
+    served from process memory.  When that copy is older than
+    ES_INDEX_CATALOG_TTL seconds, the copy published to Redis by the
+    refresh_index_catalog task is used, and only if that is stale too is the
+    cluster asked directly.
+
+    """
+
+    REDIS_KEY = 'goldstone:index_catalog'
+    DATE_SUFFIX = re.compile(r'(\d{4})[.-](\d{2})[.-](\d{2})$')
+
+    def __init__(self, ttl=None):
+
+        self.ttl = ttl
+        self._indices = None
+        self._refreshed = 0
+        self._lock = threading.Lock()
+
+    def _ttl(self):
+        """Return the catalog lifetime in seconds."""
+
+        return settings.ES_INDEX_CATALOG_TTL if self.ttl is None else self.ttl
+
+    @classmethod
+    def index_date(cls, name):
+        """Return the YYYY-MM-DD date of a daily index name, or None."""
+
+        match = cls.DATE_SUFFIX.search(name)
+        return '-'.join(match.groups()) if match else None
+
+    @classmethod
+    def index_prefix(cls, name):
+        """Return the prefix of a daily index name, or None."""
+
+        match = cls.DATE_SUFFIX.search(name)
+        return name[:match.start()] if match else None
+
+    def _fresh(self, refreshed):
+        """Return True if a catalog built at refreshed is still usable."""
+
+        return refreshed + self._ttl() > time.time()
+
+    def _install(self, indices, refreshed):
+        """Make a catalog the current in-memory copy, and invalidate cached
+        field mappings for prefixes that gained an index."""
+        from goldstone.drfes.mappings import field_mapping_cache
+
+        with self._lock:
+            previous = self._indices
+            self._indices = indices
+            self._refreshed = refreshed
+
+        if previous is not None:
+            for name in set(indices) - set(previous):
+                prefix = self.index_prefix(name)
+                if prefix is not None:
+                    field_mapping_cache.invalidate(prefix)
+
+    def refresh(self, conn=None):
+        """Rebuild the catalog from the cluster and publish it to Redis.
+
+        :type conn: Elasticsearch
+        :param conn: an ES connection object
+        :return: the catalog, keyed by index name
+        :rtype: dict
+
+        """
+
+        if conn is None:
+            conn = es_conn()
+
+        stats = conn.indices.stats(metric='docs,store')
+        indices = {}
+
+        for name, info in stats.get('indices', {}).items():
+            primaries = info.get('primaries', {})
+            indices[name] = {
+                'name': name,
+                'date': self.index_date(name),
+                'docs': primaries.get('docs', {}).get('count', 0),
+                'size': primaries.get('store', {}).get('size_in_bytes', 0),
+            }
+
+        refreshed = time.time()
+        self._install(indices, refreshed)
+
+        try:
+            RedisConnection().conn.set(
+                self.REDIS_KEY,
+                json.dumps({'refreshed': refreshed, 'indices': indices}),
+                ex=self._ttl())
+        except redis.RedisError:
+            logger.warning("could not publish the index catalog to redis")
+
+        return indices
+
+    def _load(self, conn=None):
+        """Return a usable catalog from memory, Redis, or the cluster."""
+
+        with self._lock:
+            indices, refreshed = self._indices, self._refreshed
+
+        if indices is not None and self._fresh(refreshed):
+            return indices
+
+        try:
+            published = RedisConnection().conn.get(self.REDIS_KEY)
+        except redis.RedisError:
+            published = None
+
+        if published is not None:
+            published = json.loads(published)
+            if self._fresh(published['refreshed']):
+                self._install(published['indices'], published['refreshed'])
+                return published['indices']
+
+        return self.refresh(conn=conn)
+
+    def indices(self, prefix="", conn=None):
+        """Return the catalog entries whose names start with a prefix, oldest
+        first.
+
+        :type prefix: str
+        :param prefix: the prefix to filter for, with or without a wildcard
+        :type conn: Elasticsearch
+        :param conn: an ES connection object, used if the cluster is asked
+        :rtype: list of dict
+
+        """
+
+        prefix = prefix.replace("*", "")
+
+        return sorted((entry for name, entry in self._load(conn).items()
+                       if name.startswith(prefix)),
+                      key=lambda entry: (entry['date'], entry['name']))
+
+    def names(self, prefix="", conn=None):
+        """Return the index names that start with a prefix, oldest first."""
+
+        return [entry['name'] for entry in self.indices(prefix, conn=conn)]
+
+    def invalidate(self):
+        """Forget the catalog in this process and in Redis."""
+
+        with self._lock:
+            self._indices = None
+            self._refreshed = 0
+
+        try:
+            RedisConnection().conn.delete(self.REDIS_KEY)
+        except redis.RedisError:
+            logger.warning("could not remove the index catalog from redis")
+
+# The process-wide instance.
+index_catalog = IndexCatalog()          # pylint: disable=C0103
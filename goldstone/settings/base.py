@@ -172,12 +172,60 @@ BROKER_TRANSPORT_OPTIONS = {
 CELERY_DEFAULT_QUEUE = 'default'
 CELERY_QUEUES = (
     Queue('default', Exchange('default'), routing_key='default'),
+    Queue('alerts', Exchange('alerts'), routing_key='alerts'),
+    Queue('alert_delivery', Exchange('alert_delivery'),
+          routing_key='alert_delivery'),
 )
+CELERY_ROUTES = {
+    'goldstone.core.tasks.evaluate_alert_definitions': {'queue': 'alerts'},
+    'goldstone.core.tasks.deliver_alerts': {'queue': 'alert_delivery'},
+}
+
+# The process_alerts task splits the due alert definitions into at most this
+# many subtasks.  Subtasks that haven't started within ALERT_TASK_EXPIRES
+# seconds are dropped, since the next run will pick their definitions up.
+ALERT_MAX_CONCURRENCY = 8
+ALERT_TASK_EXPIRES = 60
+
+# How long (in seconds) a task may hold a saved search's window lease before
+# another task may claim the window again.
+SEARCH_LEASE_DURATION = 300
+
+# Alert searches whose templates don't use the hit documents only count their
+# hits.  If this is set, each shard stops counting after this many documents,
+# which makes the search cheaper, but caps the {{_search_hits}} count.
+ALERT_TERMINATE_AFTER = None
+
+# The number of compiled alert templates kept in each process, and whether
+# they're rendered in Jinja's sandbox.
+ALERT_TEMPLATE_CACHE_SIZE = 256
+ALERT_TEMPLATE_SANDBOXED = False
+
+# Alert deliveries that fail are retried this many times, after
+# ALERT_DELIVERY_RETRY_BACKOFF seconds and then twice as long each time.
+# Deliveries that still fail are recorded as UndeliveredAlerts.
+ALERT_DELIVERY_MAX_RETRIES = 5
+ALERT_DELIVERY_RETRY_BACKOFF = 30
+
+# The service status check aggregates and reconciles this many hosts at a
+# time.
+SERVICE_STATUS_PAGE_SIZE = 100
 
 # Definitions for the prune task. Indices older than this number of this number
 # of days are pruned from ES
 PRUNE_OLDER_THAN = 30
 
+# Refresh-ahead.  Every REFRESH_AHEAD_PERIOD seconds, the refresh_dashboards
+# task recomputes the first page of each dashboard shortcut search over the
+# default window, at each of REFRESH_AHEAD_INTERVALS (None is the search's
+# own interval).  A request is served from those pages if its range is the
+# default window's length and ends within REFRESH_AHEAD_TOLERANCE seconds of
+# a page's.
+REFRESH_AHEAD_ENABLED = True
+REFRESH_AHEAD_PERIOD = 30
+REFRESH_AHEAD_TOLERANCE = 60
+REFRESH_AHEAD_INTERVALS = [None, '3600s']
+
 
 # how often should alerts be checked
 EVERY_MINUTE = crontab(minute='*/1')
@@ -189,14 +237,26 @@ CELERYBEAT_SCHEDULE = {
         'task': 'goldstone.core.tasks.prune_es_indices',
         'schedule': EVERY_MIDNIGHT,
     },
+    'prune_export_jobs': {
+        'task': 'goldstone.core.tasks.prune_export_jobs',
+        'schedule': EVERY_MIDNIGHT,
+    },
     'expire_auth_tokens': {
         'task': 'goldstone.core.tasks.expire_auth_tokens',
         'schedule': EVERY_MIDNIGHT
     },
+    'refresh_index_catalog': {
+        'task': 'goldstone.core.tasks.refresh_index_catalog',
+        'schedule': EVERY_MINUTE
+    },
     'process_alerts': {
         'task': 'goldstone.core.tasks.process_alerts',
         'schedule': EVERY_MINUTE
     },
+    'deliver_alert_digests': {
+        'task': 'goldstone.core.tasks.deliver_alert_digests',
+        'schedule': EVERY_MINUTE
+    },
     'service_status_check': {
         'task': 'goldstone.core.tasks.service_status_check',
         'schedule': EVERY_MINUTE
@@ -205,6 +265,20 @@ CELERYBEAT_SCHEDULE = {
         'task': 'goldstone.core.tasks.nova_hypervisors_stats',
         'schedule': EVERY_MINUTE,
     },
+    'update_minute_rollups': {
+        'task': 'goldstone.core.tasks.update_rollups',
+        'schedule': EVERY_MINUTE,
+        'args': ('1m', ),
+    },
+    'update_hour_rollups': {
+        'task': 'goldstone.core.tasks.update_rollups',
+        'schedule': EVERY_5_MINUTES,
+        'args': ('1h', ),
+    },
+    'refresh_dashboards': {
+        'task': 'goldstone.core.tasks.refresh_dashboards',
+        'schedule': timedelta(seconds=REFRESH_AHEAD_PERIOD),
+    },
 }
 
 
@@ -297,6 +371,159 @@ ES_HOST = "127.0.0.1"
 ES_PORT = "9200"
 ES_SERVER = {'hosts': [ES_HOST + ":" + ES_PORT]}
 
+# Elasticsearch client tuning.  Each process keeps one client per server
+# definition.  ES_POOL_MAXSIZE is the number of pooled HTTP connections per
+# node, and ES_TIMEOUT is the default per-request timeout in seconds.
+ES_POOL_MAXSIZE = 10
+ES_KEEPALIVE = True
+ES_HTTP_COMPRESS = True
+ES_TIMEOUT = 30
+ES_MAX_RETRIES = 1
+ES_SNIFF_ON_START = False
+ES_SNIFF_ON_CONNECTION_FAIL = False
+ES_SNIFFER_TIMEOUT = None
+
+# How long (in seconds) a field mapping lookup is cached in each process.
+# Entries are also dropped when a new daily index appears.
+ES_FIELD_MAPPING_CACHE_TTL = 300
+
+# How long (in seconds) the index catalog is trusted before it is rebuilt.
+# The refresh_index_catalog task republishes it to Redis every minute.
+ES_INDEX_CATALOG_TTL = 120
+
+# Searches with a time range only go to the daily indices that overlap the
+# range, widened by this many seconds on each side for late-arriving documents.
+ES_INDEX_ROUTING_MARGIN = 3600
+
+# Days newer than the index catalog are searched with one wildcard per day, up
+# to this many; more are collapsed into one wildcard per month, and more months
+# than this into one wildcard for the whole prefix.
+ES_INDEX_ROUTING_MAX_WILDCARDS = 3
+
+# Buffered bulk writes.  A BulkWriter flushes when it holds ES_BULK_MAX_DOCS
+# documents or ES_BULK_MAX_BYTES bytes, or when its oldest document is
+# ES_BULK_MAX_AGE seconds old.  Items rejected because ES is busy are retried
+# up to ES_BULK_MAX_RETRIES times, with an exponential backoff starting at
+# ES_BULK_RETRY_BACKOFF seconds.
+ES_BULK_MAX_DOCS = 500
+ES_BULK_MAX_BYTES = 5 * 1024 * 1024
+ES_BULK_MAX_AGE = 5
+ES_BULK_MAX_RETRIES = 3
+ES_BULK_RETRY_BACKOFF = 0.5
+
+# The most searches sent in one _msearch request.
+ES_MSEARCH_CHUNK_SIZE = 100
+
+# Time range bounds are snapped to whole multiples of this many seconds (or
+# of the aggregation interval), so that repeated requests for a moving window
+# are identical and can be answered from ES's caches.
+ES_RANGE_GRANULARITY = 60
+
+# The parameters that let ES cache an aggregation-only search.  ES 1.x's
+# shard query cache only caches count searches; on ES 2.x and later this is
+# {'request_cache': 'true'}.
+ES_REQUEST_CACHE_PARAMS = {'search_type': 'count', 'query_cache': 'true'}
+
+# The aggregation result cache.  Entries live for their index family's TTL in
+# seconds, and range bounds are aligned to AGG_CACHE_ALIGNMENT seconds when
+# they're keyed.  At most AGG_CACHE_MAX_ENTRIES results of up to
+# AGG_CACHE_MAX_ENTRY_SIZE bytes are kept.
+AGG_CACHE_ENABLED = True
+AGG_CACHE_DEFAULT_TTL = 30
+AGG_CACHE_TTLS = {
+    'logstash-': 15,
+    'events_': 15,
+    'api_stats-': 60,
+    'goldstone_metrics-': 60,
+}
+AGG_CACHE_ALIGNMENT = 10
+# Besides the fields of a search's date_histograms, only ranges on these
+# fields are aligned.
+AGG_CACHE_TIME_FIELDS = ('@timestamp', 'timestamp')
+AGG_CACHE_MAX_ENTRIES = 1000
+AGG_CACHE_MAX_ENTRY_SIZE = 1024 * 1024
+
+# Single-flight searches.  Identical searches (with time bounds aligned to
+# SINGLE_FLIGHT_ALIGNMENT seconds) that are in flight at once execute once,
+# and the others poll for its result every SINGLE_FLIGHT_POLL_INTERVAL
+# seconds, for at most SINGLE_FLIGHT_MAX_WAIT seconds before executing it
+# themselves.  A lease on an in-flight search expires after
+# SINGLE_FLIGHT_LEASE seconds.
+SINGLE_FLIGHT_ENABLED = True
+SINGLE_FLIGHT_ALIGNMENT = 5
+SINGLE_FLIGHT_LEASE = 30
+SINGLE_FLIGHT_POLL_INTERVAL = 0.05
+SINGLE_FLIGHT_MAX_WAIT = 3
+
+# Incremental date histograms.  A bucket is stored once it ends more than
+# HISTOGRAM_GRACE_PERIOD seconds ago, and stored buckets are kept for
+# HISTOGRAM_STORE_TTL seconds after their histogram was last refreshed.
+# Histograms of more than HISTOGRAM_MAX_BUCKETS buckets aren't stored.
+HISTOGRAM_STORE_ENABLED = True
+HISTOGRAM_GRACE_PERIOD = 300
+HISTOGRAM_STORE_TTL = 8 * 24 * 3600
+HISTOGRAM_MAX_BUCKETS = 2000
+
+# Rollups.  The update_rollups task summarizes each ROLLUP_SOURCES doc type
+# into per-minute and per-hour daily rollup indices (ROLLUP_INDEX_PREFIX +
+# doc type + resolution), with one document per time bucket and combination
+# of dimension values.  A bucket is rolled up ROLLUP_GRACE_PERIOD seconds
+# after it ends, and a task run rolls up at most ROLLUP_MAX_BUCKETS_PER_RUN
+# buckets per source.  The first run starts ROLLUP_INITIAL_LOOKBACK seconds
+# ago.  Date histograms with intervals of whole minutes or hours are answered
+# from the rollups where they exist.
+ROLLUP_ENABLED = True
+ROLLUP_INDEX_PREFIX = 'rollup_'
+ROLLUP_GRACE_PERIOD = 120
+ROLLUP_MAX_BUCKETS_PER_RUN = 60
+ROLLUP_INITIAL_LOOKBACK = DEFAULT_LOOKBACK_DAYS * 24 * 3600
+
+# The upper bounds of the latency histogram buckets, in the value field's
+# units (seconds for API response times).
+ROLLUP_LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# The rolled-up doc types.  Dimensions map field names to the fields that are
+# aggregated on.
+ROLLUP_SOURCES = {
+    'api_stats': {
+        'index_prefix': 'api_stats-',
+        'timestamp_field': '@timestamp',
+        'dimensions': {'component': 'component.raw',
+                       'response_status': 'response_status'},
+        'value_field': 'response_time',
+        'latency_histogram': True,
+    },
+    'core_metric': {
+        'index_prefix': 'goldstone_metrics-',
+        'timestamp_field': '@timestamp',
+        'dimensions': {'name': 'name.raw',
+                       'node': 'node.raw',
+                       'unit': 'unit.raw'},
+        'value_field': 'value',
+    },
+    'nova_spawns': {
+        'index_prefix': 'goldstone-',
+        'timestamp_field': '@timestamp',
+        'dimensions': {'event': 'event.raw',
+                       'success': 'success.raw'},
+    },
+}
+
+# Streaming exports scroll this many hits per shard per page, and keep the
+# scroll alive this long between pages.
+ES_EXPORT_SCROLL_SIZE = 500
+ES_EXPORT_SCROLL = '1m'
+
+# Export jobs write their files here, scroll up to EXPORT_JOB_WORKERS daily
+# index slices at once, and are deleted after EXPORT_JOB_RETENTION days.
+EXPORT_JOB_DIR = '/var/tmp/goldstone/exports'
+EXPORT_JOB_WORKERS = 4
+EXPORT_JOB_RETENTION = 7
+
+# Each slice buffers up to this many bytes of column values before appending
+# them to its column files.
+EXPORT_SPOOL_BUFFER = 1024 * 1024
+
 
 class ConstantDict(object):
     """An enumeration class with 'real' members and testing methods.
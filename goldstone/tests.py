@@ -12,22 +12,29 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import json
 import os
 import sys
+import time
 
 import arrow
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.test import SimpleTestCase
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, ConnectionError, \
+    Urllib3HttpConnection
 
 # This is needed here for mock to work.
 from elasticsearch.client import IndicesClient
-from elasticsearch_dsl.connections import connections, Connections
+from elasticsearch_dsl import Search
+from elasticsearch_dsl.connections import connections
 from mock import patch
 import mock
 
-from goldstone.models import es_conn, daily_index, es_indices
+from goldstone.models import es_conn, es_conn_stats, daily_index, \
+    es_indices, es_latest_index, es_indices_for_range, es_route_search, \
+    es_multi_search, es_snap_range, es_aggregation_only, index_catalog, \
+    ConnectionManager, IndexCatalog, PooledHttpConnection
 from goldstone.tenants.models import Tenant
 from goldstone.test_utils import Setup
 
@@ -111,52 +118,92 @@ class TenantInit(Setup):
 class ElasticSearchTests(SimpleTestCase):
     """Test some Elasticsearch operations."""
 
-    @patch.object(connections, 'get_connection')
-    @patch.object(connections, 'configure')
-    def test_connection(self, mock_conf, mock_es):
+    def test_connection(self):
         """Connection tests."""
 
-        mock_es.return_value = None
-        mock_conf.return_value = None
+        conn = es_conn()
+        self.assertIsInstance(conn, Elasticsearch)
 
-        es_conn()
-        self.assertEqual(mock_es.call_count, 1)
-        mock_conf.assert_called_with(default=settings.ES_SERVER,
-                                     sniff_on_start=False,
-                                     max_retries=1)
+        # the same client is returned on every call, and it is registered as
+        # the default elasticsearch_dsl connection.
+        self.assertIs(es_conn(), conn)
+        self.assertIs(connections.get_connection(), conn)
 
-        mock_conf.reset_mock()
-        mock_es.reset_mock()
+        other = es_conn(server={'hosts': ['abc', 'def']})
+        self.assertIsNot(other, conn)
+        self.assertIs(es_conn(server={'hosts': ['abc', 'def']}), other)
+        self.assertIs(connections.get_connection(), conn)
 
-        es_conn(server={'hosts': ['abc', 'def']})
-        self.assertEqual(mock_es.call_count, 1)
-        mock_conf.assert_called_with(default={'hosts': ['abc', 'def']},
-                                     sniff_on_start=False,
-                                     max_retries=1)
+        pool = other.transport.connection_pool
+        self.assertEqual(len(pool.connections), 2)
+        for node in pool.connections:
+            self.assertIsInstance(node, PooledHttpConnection)
+            self.assertEqual(node.maxsize, settings.ES_POOL_MAXSIZE)
+            self.assertEqual(node.timeout, settings.ES_TIMEOUT)
+
+    def test_connection_after_fork(self):
+        """A new process gets its own client and pool."""
+
+        conn = es_conn()
+        node = conn.transport.get_connection()
+        old_pool = node.pool
+
+        with patch('goldstone.models.os.getpid') as getpid, \
+                patch.object(Urllib3HttpConnection, 'perform_request'):
+            getpid.return_value = -1
+
+            self.assertIsNot(es_conn(), conn)
+
+            # a client created before the fork rebuilds its pool on use.
+            node.perform_request('GET', '/')
+            self.assertIsNot(node.pool, old_pool)
+            self.assertEqual(node.requests, 1)
+
+    def test_connection_stats(self):
+        """Pool utilization is reported per client and node."""
+
+        conn = es_conn()
+
+        with patch.object(Urllib3HttpConnection, 'perform_request'):
+            conn.transport.get_connection().perform_request('GET', '/')
+
+        stats = es_conn_stats()
+        self.assertEqual(stats['pid'], os.getpid())
+
+        client = [c for c in stats['clients']
+                  if c['server'] == settings.ES_SERVER][0]
+        node = client['connections'][0]
+        self.assertEqual(node['maxsize'], settings.ES_POOL_MAXSIZE)
+        self.assertEqual(node['in_use'], 0)
+        self.assertGreaterEqual(node['requests'], 1)
 
     def test_daily_index(self):
         """Date string test."""
         date_str = arrow.utcnow().format('YYYY.MM.DD')
         self.assertEqual(daily_index("xyz-"), "xyz-" + date_str)
 
-    @patch.object(Connections, 'get_connection')
-    def test_es_indices(self, m_conn):
+    @patch('goldstone.models.RedisConnection')
+    @patch.object(ConnectionManager, 'get')
+    def test_es_indices(self, m_conn, m_redis):
         """Indices tests.
 
-        To avoid Elasticsearch calls, we mock out the get_connection call, then
+        To avoid Elasticsearch calls, we mock out the client lookup, then
         set up additional mocks for the resulting ES connection.
 
         """
 
+        m_redis.return_value.conn.get.return_value = None
+        index_catalog.invalidate()
+
         m_es = mock.Mock(Elasticsearch, name='es')
         m_indices = mock.MagicMock(IndicesClient, name='indices')
         m_es.indices = m_indices
-        m_es.indices.status.return_value = {
+        m_es.indices.stats.return_value = {
             'indices': {
-                'index1': 'value1',
-                'not_index1': 'value1',
-                'index2-': 'value2',
-                'not_index2-': 'value2'
+                'index1': {},
+                'not_index1': {},
+                'index2-': {},
+                'not_index2-': {}
             }
         }
 
@@ -170,7 +217,7 @@ class ElasticSearchTests(SimpleTestCase):
 
         # test with no conn, prefix has neither dash nor wildcard
         result = es_indices(prefix='index1')
-        self.assertTrue(m_es.indices.status.called)
+        self.assertTrue(m_es.indices.stats.called)
         self.assertIn('index1', result)
         self.assertNotIn('not_index1', result)
 
@@ -181,7 +228,7 @@ class ElasticSearchTests(SimpleTestCase):
 
         # test with no conn, prefix has wildcard but no dash
         result = es_indices(prefix='index1*')
-        self.assertTrue(m_es.indices.status.called)
+        self.assertTrue(m_es.indices.stats.called)
         self.assertIn('index1', result)
         self.assertNotIn('not_index1', result)
 
@@ -192,7 +239,7 @@ class ElasticSearchTests(SimpleTestCase):
 
         # test with no conn, prefix has dash but no wildcard
         result = es_indices(prefix='index2-')
-        self.assertTrue(m_es.indices.status.called)
+        self.assertTrue(m_es.indices.stats.called)
         self.assertIn('index2-', result)
         self.assertNotIn('not_index2-', result)
 
@@ -203,7 +250,7 @@ class ElasticSearchTests(SimpleTestCase):
 
         # test with no conn, prefix has dash and wildcard
         result = es_indices(prefix='index2-*')
-        self.assertTrue(m_es.indices.status.called)
+        self.assertTrue(m_es.indices.stats.called)
         self.assertIn('index2-', result)
         self.assertNotIn('not_index2-', result)
 
@@ -211,3 +258,309 @@ class ElasticSearchTests(SimpleTestCase):
         result = es_indices('index2-*', es_conn())
         self.assertIn('index2-', result)
         self.assertNotIn('not_index2-', result)
+
+        # the catalog was only built once.
+        self.assertEqual(m_es.indices.stats.call_count, 1)
+
+        # test with a prefix that matches nothing
+        self.assertIsNone(es_indices('index3-'))
+
+
+class IndexCatalogTests(SimpleTestCase):
+    """Test the index catalog."""
+
+    STATS = {
+        'indices': {
+            'logstash-2016.06.02': {
+                'primaries': {'docs': {'count': 20},
+                              'store': {'size_in_bytes': 2000}}},
+            'logstash-2016.06.01': {
+                'primaries': {'docs': {'count': 10},
+                              'store': {'size_in_bytes': 1000}}},
+            'events_2016-06-01': {
+                'primaries': {'docs': {'count': 5},
+                              'store': {'size_in_bytes': 500}}},
+        }
+    }
+
+    def setUp(self):
+
+        self.m_es = mock.Mock(Elasticsearch, name='es')
+        self.m_es.indices = mock.MagicMock(IndicesClient, name='indices')
+        self.m_es.indices.stats.return_value = self.STATS
+
+    @patch('goldstone.models.RedisConnection')
+    def test_refresh(self, m_redis):
+        """The catalog records names, dates, doc counts and sizes, and is
+        published to Redis."""
+
+        catalog = IndexCatalog(ttl=60)
+        catalog.refresh(conn=self.m_es)
+
+        self.assertEqual(
+            catalog.indices('logstash-*'),
+            [{'name': 'logstash-2016.06.01', 'date': '2016-06-01',
+              'docs': 10, 'size': 1000},
+             {'name': 'logstash-2016.06.02', 'date': '2016-06-02',
+              'docs': 20, 'size': 2000}])
+        self.assertEqual(catalog.names('events_'), ['events_2016-06-01'])
+        self.assertEqual(self.m_es.indices.stats.call_count, 1)
+
+        published = json.loads(m_redis.return_value.conn.set.call_args[0][1])
+        self.assertItemsEqual(published['indices'].keys(),
+                              self.STATS['indices'].keys())
+
+    @patch('goldstone.models.RedisConnection')
+    def test_load_from_redis(self, m_redis):
+        """A fresh catalog published to Redis is used instead of asking the
+        cluster."""
+
+        m_redis.return_value.conn.get.return_value = json.dumps(
+            {'refreshed': time.time(),
+             'indices': {'logstash-2016.06.01': {
+                 'name': 'logstash-2016.06.01', 'date': '2016-06-01',
+                 'docs': 10, 'size': 1000}}})
+
+        catalog = IndexCatalog(ttl=60)
+        self.assertEqual(catalog.names('logstash-', conn=self.m_es),
+                         ['logstash-2016.06.01'])
+        self.assertFalse(self.m_es.indices.stats.called)
+
+        # a stale copy in Redis is ignored.
+        m_redis.return_value.conn.get.return_value = json.dumps(
+            {'refreshed': time.time() - 120, 'indices': {}})
+
+        catalog = IndexCatalog(ttl=60)
+        self.assertEqual(catalog.names('logstash-', conn=self.m_es),
+                         ['logstash-2016.06.01', 'logstash-2016.06.02'])
+        self.assertTrue(self.m_es.indices.stats.called)
+
+    @patch('goldstone.models.RedisConnection')
+    def test_latest_index(self, m_redis):
+        """es_latest_index returns the newest matching index."""
+
+        m_redis.return_value.conn.get.return_value = None
+        index_catalog.invalidate()
+
+        self.assertEqual(es_latest_index('logstash-*', conn=self.m_es),
+                         'logstash-2016.06.02')
+        self.assertIsNone(es_latest_index('nothing-*', conn=self.m_es))
+
+
+class IndexRoutingTests(SimpleTestCase):
+    """Test routing searches to the daily indices that overlap a time
+    range."""
+
+    ENTRIES = [
+        {'name': 'logstash-2016.06.01', 'date': '2016-06-01'},
+        {'name': 'logstash-2016.06.02', 'date': '2016-06-02'},
+        {'name': 'logstash-2016.06.03', 'date': '2016-06-03'},
+        {'name': 'logstash-2016.06.04', 'date': '2016-06-04'},
+    ]
+
+    @patch.object(index_catalog, 'indices')
+    def test_overlapping_days(self, m_indices):
+        """Only the days that overlap the range (plus margin) are used."""
+
+        m_indices.return_value = self.ENTRIES
+
+        with self.settings(ES_INDEX_ROUTING_MARGIN=0):
+            self.assertEqual(
+                es_indices_for_range('logstash-*',
+                                     arrow.get('2016-06-02T10:00:00+00:00'),
+                                     arrow.get('2016-06-02T10:15:00+00:00')),
+                ['logstash-2016.06.02'])
+
+            # epoch milliseconds, as sent by the client.
+            self.assertEqual(
+                es_indices_for_range('logstash-*',
+                                     1464861600000,
+                                     '1464948000000'),
+                ['logstash-2016.06.02', 'logstash-2016.06.03'])
+
+        with self.settings(ES_INDEX_ROUTING_MARGIN=3600):
+            self.assertEqual(
+                es_indices_for_range('logstash-*',
+                                     '2016-06-03T00:30:00+00:00',
+                                     '2016-06-03T00:45:00+00:00'),
+                ['logstash-2016.06.02', 'logstash-2016.06.03'])
+
+            # an open start.
+            self.assertEqual(
+                es_indices_for_range('logstash-*', None,
+                                     '2016-06-02T10:00:00+00:00'),
+                ['logstash-2016.06.01', 'logstash-2016.06.02'])
+
+    @patch.object(index_catalog, 'indices')
+    def test_not_routed(self, m_indices):
+        """Searches that can't be narrowed are left alone."""
+
+        m_indices.return_value = self.ENTRIES
+        search = Search(index='logstash-*')
+
+        # no range at all.
+        self.assertIsNone(es_indices_for_range('logstash-*'))
+        self.assertIs(es_route_search(search, 'logstash-*'), search)
+
+        # a range that no index overlaps.
+        self.assertIsNone(
+            es_indices_for_range('logstash-*', '2015-01-01', '2015-01-02'))
+
+        # no dated indices.
+        m_indices.return_value = [{'name': 'logstash', 'date': None}]
+        self.assertIsNone(es_indices_for_range('logstash', '2015-01-01'))
+
+        # the catalog isn't available.
+        m_indices.side_effect = ConnectionError
+        self.assertIsNone(es_indices_for_range('logstash-*', '2015-01-01'))
+
+    @patch.object(index_catalog, 'indices')
+    def test_new_days(self, m_indices):
+        """Days newer than the catalog are searched with wildcards."""
+
+        yesterday = arrow.utcnow().replace(days=-1)
+        today = arrow.utcnow()
+
+        m_indices.return_value = [
+            {'name': 'events_' + yesterday.format('YYYY-MM-DD'),
+             'date': yesterday.format('YYYY-MM-DD')}]
+
+        search = es_route_search(Search(index='events_*'), 'events_*',
+                                 yesterday, today)
+
+        self.assertEqual(search._index,          # pylint: disable=W0212
+                         ['events_' + yesterday.format('YYYY-MM-DD'),
+                          'events_' + today.format('YYYY-MM-DD') + '*'])
+
+    @patch.object(index_catalog, 'indices')
+    def test_es_indices_new_days(self, m_indices):
+        """Unrouted searches also cover days newer than the catalog."""
+
+        yesterday = arrow.utcnow().replace(days=-1)
+        today = arrow.utcnow()
+
+        m_indices.return_value = [
+            {'name': 'logstash', 'date': None},
+            {'name': 'logstash-' + yesterday.format('YYYY.MM.DD'),
+             'date': yesterday.format('YYYY-MM-DD')}]
+
+        self.assertEqual(es_indices('logstash'),
+                         ['logstash',
+                          'logstash-' + yesterday.format('YYYY.MM.DD'),
+                          'logstash-' + today.format('YYYY.MM.DD') + '*'])
+
+        self.assertEqual(es_indices('logstash', new_days=False),
+                         ['logstash',
+                          'logstash-' + yesterday.format('YYYY.MM.DD')])
+
+        # A catalog that's up to date adds no wildcards.
+        m_indices.return_value = m_indices.return_value[:1] + [
+            {'name': 'logstash-' + today.format('YYYY.MM.DD'),
+             'date': today.format('YYYY-MM-DD')}]
+        self.assertEqual(es_indices('logstash'),
+                         ['logstash',
+                          'logstash-' + today.format('YYYY.MM.DD')])
+
+    @patch.object(index_catalog, 'indices')
+    def test_stale_catalog(self, m_indices):
+        """Many days newer than the catalog are collapsed into per-month, or
+        per-prefix, wildcards."""
+
+        m_indices.return_value = self.ENTRIES
+
+        with self.settings(ES_INDEX_ROUTING_MARGIN=0,
+                           ES_INDEX_ROUTING_MAX_WILDCARDS=3):
+            self.assertEqual(
+                es_indices_for_range('logstash-*', '2016-06-04T10:00:00',
+                                     '2016-06-07T10:00:00'),
+                ['logstash-2016.06.04', 'logstash-2016.06.05*',
+                 'logstash-2016.06.06*', 'logstash-2016.06.07*'])
+
+            self.assertEqual(
+                es_indices_for_range('logstash-*', '2016-06-20T10:00:00',
+                                     '2016-07-10T10:00:00'),
+                ['logstash-2016.06.*', 'logstash-2016.07.*'])
+
+            self.assertEqual(
+                es_indices_for_range('logstash-*', '2016-06-04T10:00:00'),
+                ['logstash-2016.06.04', 'logstash-*'])
+
+
+class TimeRangeTests(SimpleTestCase):
+    """Test the time range normalization."""
+
+    def test_snap_range(self):
+        """Bounds are snapped to the granularity or interval."""
+
+        start = arrow.get('2016-01-01T00:05:30.500000+00:00')
+        end = arrow.get('2016-01-01T01:10:00+00:00')
+
+        with self.settings(ES_RANGE_GRANULARITY=60):
+            self.assertEqual(
+                es_snap_range(start, end),
+                (arrow.get('2016-01-01T00:05:00+00:00'), end))
+            self.assertEqual(
+                es_snap_range(start, end, '1h'),
+                (arrow.get('2016-01-01T00:00:00+00:00'),
+                 arrow.get('2016-01-01T02:00:00+00:00')))
+            self.assertEqual(
+                es_snap_range(start, end, 3600, round_end='down'),
+                (arrow.get('2016-01-01T00:00:00+00:00'),
+                 arrow.get('2016-01-01T01:00:00+00:00')))
+            # Calendar intervals get the default granularity.
+            self.assertEqual(es_snap_range(None, start, '1w'),
+                             (None, arrow.get('2016-01-01T00:06:00+00:00')))
+
+        with self.settings(ES_RANGE_GRANULARITY=0):
+            self.assertEqual(es_snap_range(start, end), (start, end))
+
+    def test_aggregation_only(self):
+        """Aggregation-only searches return no hits, and can be cached."""
+
+        with self.settings(ES_REQUEST_CACHE_PARAMS={'request_cache': 'true'}):
+            search = es_aggregation_only(Search())
+
+        self.assertEqual(search.to_dict(), {'query': {'match_all': {}},
+                                            'size': 0})
+        self.assertEqual(search._params,          # pylint: disable=W0212
+                         {'request_cache': 'true'})
+
+
+class MultiSearchTests(SimpleTestCase):
+    """Test running several searches through _msearch."""
+
+    def test_body_and_chunks(self):
+        """Searches are sent as header/body pairs, in chunks."""
+
+        conn = mock.MagicMock()
+        conn.msearch.side_effect = lambda body: {
+            'responses': [{'hits': {'total': i}}
+                          for i in range(len(body) / 2)]}
+
+        searches = [Search(index=['a-1', 'a-2'], doc_type='t')
+                    .params(search_type='count'),
+                    Search(),
+                    Search(index='b')]
+
+        result = es_multi_search(searches, conn=conn, chunk_size=2)
+
+        self.assertEqual(conn.msearch.call_count, 2)
+        body = conn.msearch.call_args_list[0][0][0]
+        self.assertEqual(body[0], {'index': 'a-1,a-2', 'type': 't',
+                                   'search_type': 'count'})
+        self.assertEqual(body[1], searches[0].to_dict())
+        self.assertEqual(body[2], {})
+        self.assertEqual([r['hits']['total'] for r in result], [0, 1, 0])
+
+    def test_failed_request(self):
+        """A failed request turns into an error for each of its searches."""
+
+        conn = mock.MagicMock()
+        conn.msearch.side_effect = [ConnectionError('N/A', 'down', None),
+                                    {'responses': [{'error': 'bad query'}]}]
+
+        result = es_multi_search([Search(), Search(), Search()], conn=conn,
+                                 chunk_size=2)
+
+        self.assertEqual(len(result), 3)
+        self.assertTrue(all('error' in r for r in result))